@@ -1,3 +1,14 @@
+from Acquisition import Implicit
+from Acquisition import aq_parent
+from DateTime import DateTime
+from Missing import MV
+from Products.PluginIndexes.common import safe_callable
+
+
+# name of the elastic search field the catalog metadata is stored in
+METADATA_FIELD = 'catalog_metadata'
+DATETIME_KEY = '__DateTime__'
+MISSING_KEY = '__Missing__'
 
 
 def BrainFactory(catalog):
@@ -12,3 +23,122 @@ def BrainFactory(catalog):
             except:
                 return None
     return factory
+
+
+def ElasticBrainFactory(catalogtool):
+    '''
+    build brains from the metadata stored with the elastic search document
+    and only fall back to the catalog for documents indexed without it
+    '''
+    fallback = BrainFactory(catalogtool._catalog)
+
+    def factory(result):
+        metadata = result.get('_source', {}).get(METADATA_FIELD)
+        path = result.get('fields', {}).get('path.path', None)
+        if type(path) in (list, tuple, set) and len(path) > 0:
+            path = path[0]
+        if metadata is None or not path:
+            return fallback(result)
+        return ElasticBrain(path, metadata, result.get('_score')).__of__(
+            catalogtool)
+    return factory
+
+
+def encode_value(value):
+    if value is MV:
+        return {MISSING_KEY: True}
+    if isinstance(value, DateTime):
+        # ISO8601 drops the microseconds, keep the exact time
+        return {DATETIME_KEY: [value.micros(), value.timezone()]}
+    if isinstance(value, str):
+        return unicode(value, 'utf-8', 'ignore')
+    if isinstance(value, (list, tuple, set)):
+        return [encode_value(v) for v in value]
+    if isinstance(value, dict):
+        return dict([(k, encode_value(v)) for k, v in value.items()])
+    if value is None or isinstance(value, (unicode, bool, int, long, float)):
+        return value
+    # can not be serialized, brain will not provide the value
+    return {MISSING_KEY: True}
+
+
+def decode_value(value):
+    if isinstance(value, unicode):
+        # catalog brains provide encoded strings
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return tuple([decode_value(v) for v in value])
+    if isinstance(value, dict):
+        if DATETIME_KEY in value:
+            micros, tz = value[DATETIME_KEY]
+            return DateTime(micros / 1000000.0, tz)
+        if MISSING_KEY in value:
+            return MV
+        return dict([(k, decode_value(v)) for k, v in value.items()])
+    return value
+
+
+def get_metadata(catalog, obj):
+    '''
+    same values the catalog stores for an object's metadata record
+    '''
+    metadata = {}
+    for name in catalog.names:
+        value = getattr(obj, name, MV)
+        if value is not MV and safe_callable(value):
+            try:
+                value = value()
+            except Exception:
+                value = MV
+        metadata[name] = encode_value(value)
+    return metadata
+
+
+class ElasticBrain(Implicit):
+    '''
+    catalog brain filled from the metadata stored in elastic search so
+    results can be rendered without touching the catalog
+    '''
+    __allow_access_to_unprotected_subobjects__ = True
+
+    def __init__(self, path, metadata, score=None):
+        self._path = path
+        self._metadata = metadata
+        self.data_record_score_ = score
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._metadata:
+            raise AttributeError(name)
+        value = decode_value(self._metadata[name])
+        self.__dict__[name] = value
+        return value
+
+    def has_key(self, key):
+        return key in self._metadata
+
+    __contains__ = has_key
+
+    def getPath(self):
+        return self._path
+
+    def getURL(self, relative=0):
+        return self.REQUEST.physicalPathToURL(self.getPath(), relative)
+
+    def _unrestrictedGetObject(self):
+        return aq_parent(self).unrestrictedTraverse(self.getPath())
+
+    def getObject(self, REQUEST=None):
+        path = self.getPath().split('/')
+        if not path:
+            return None
+        parent = aq_parent(self)
+        if len(path) > 1:
+            parent = parent.unrestrictedTraverse(path[:-1])
+        return parent.restrictedTraverse(path[-1])
+
+    def getRID(self):
+        return aq_parent(self)._catalog.uids.get(self.getPath())
+
+    @property
+    def data_record_id_(self):
+        return self.getRID()
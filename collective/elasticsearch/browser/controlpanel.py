@@ -1,3 +1,5 @@
+from DateTime import DateTime
+from collective.elasticsearch import slowlog
 from collective.elasticsearch.es import ElasticSearchCatalog
 from collective.elasticsearch.interfaces import IElasticSettings
 from plone.app.registry.browser.controlpanel import ControlPanelFormWrapper
@@ -52,5 +54,22 @@ class ElasticControlPanelFormWrapper(ControlPanelFormWrapper):
     def active(self):
         return self.es.get_setting('enabled')
 
+    @property
+    def slow_queries(self):
+        '''
+        slow searches of this instance, newest first
+        '''
+        entries = []
+        for entry in slowlog.log.get():
+            entry = entry.copy()
+            entry['time'] = DateTime(entry['time']).ISO8601()
+            entry['search'] = '%s sorted on %s\n%s\n\n%s' % (
+                entry['kind'], entry['sort'], entry['query'], entry['body'])
+            entry['profile'] = '\n\n'.join([
+                'shard %s\n%s' % (shard['id'], '\n'.join(shard['breakdown']))
+                for shard in entry['profile'] or []])
+            entries.append(entry)
+        return entries
+
 ElasticControlPanelView = layout.wrap_form(ElasticControlPanelForm,
                                            ElasticControlPanelFormWrapper)
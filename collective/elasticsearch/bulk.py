@@ -0,0 +1,300 @@
+from collective.elasticsearch import fingerprint
+from collective.elasticsearch import resultcache
+from collective.elasticsearch import timing
+from elasticsearch.exceptions import ConnectionError
+from elasticsearch.exceptions import TransportError
+from Queue import Queue
+
+import json
+import logging
+import random
+import threading
+import time
+
+
+logger = logging.getLogger('collective.elasticsearch')
+# items elastic search kept rejecting, one json record per line
+deadletter = logging.getLogger('collective.elasticsearch.deadletter')
+
+_stop = object()
+
+# bulk item and response statuses worth sending again, besides server
+# errors: timeouts and elastic search being overloaded
+RETRY_STATUSES = (408, 429)
+BACKOFF_BASE = 0.5
+
+
+def _chunk_actions(actions, serializer, index_name, doc_type,
+                   chunk_size, max_chunk_bytes, version=None):
+    '''
+    serialize (op_type, uid, source) actions into bulk request bodies
+    that hold at most `chunk_size` actions and `max_chunk_bytes` bytes.
+    With `version` the actions are externally versioned.
+    '''
+    chunk = []
+    lines = []
+    size = 0
+    for op_type, uid, source in actions:
+        meta = {
+            '_index': index_name,
+            '_type': doc_type,
+            '_id': uid
+        }
+        if version is not None:
+            meta['_version'] = version
+            meta['_version_type'] = 'external'
+        data = [serializer.dumps({op_type: meta})]
+        if source is not None:
+            data.append(serializer.dumps(source))
+        data_size = sum([len(line) + 1 for line in data])
+        if chunk and (len(chunk) >= chunk_size or
+                      size + data_size > max_chunk_bytes):
+            yield chunk, lines
+            chunk = []
+            lines = []
+            size = 0
+        chunk.append((op_type, uid))
+        lines.extend(data)
+        size += data_size
+    if chunk:
+        yield chunk, lines
+
+
+def _send_chunk(conn, index_name, doc_type, chunk, lines):
+    '''
+    send one bulk request and return the items that failed
+    '''
+    body = '\n'.join(lines) + '\n'
+    result = conn.bulk(index=index_name, doc_type=doc_type, body=body)
+    # sent from the index queue and outbox well after the commit
+    resultcache.invalidate()
+    errors = []
+    if not result.get('errors'):
+        return errors
+    for (op_type, uid), item in zip(chunk, result['items']):
+        info = item.get(op_type, {})
+        if 'error' in info:
+            errors.append({
+                'op_type': op_type,
+                'uid': uid,
+                'status': info.get('status'),
+                'error': info['error']
+            })
+    return errors
+
+
+def backoff(attempt, maximum):
+    '''
+    capped exponential backoff with full jitter
+    '''
+    return random.uniform(0, min(maximum, BACKOFF_BASE * 2 ** attempt))
+
+
+def _retryable_status(status):
+    '''
+    client errors fail the same way every time, anything else may not
+    '''
+    return status in RETRY_STATUSES or \
+        (isinstance(status, int) and status >= 500)
+
+
+def _retryable(ex):
+    if isinstance(ex, ConnectionError):
+        return True
+    return isinstance(ex, TransportError) and \
+        _retryable_status(ex.status_code)
+
+
+def _item_lines(chunk, lines):
+    idx = 0
+    for op_type, uid in chunk:
+        size = op_type == 'delete' and 1 or 2
+        yield (op_type, uid), lines[idx:idx + size]
+        idx += size
+
+
+def _send_chunk_retrying(conn, index_name, doc_type, chunk, lines,
+                         attempts, backoff_max):
+    '''
+    Send one bulk request, sending the items elastic search rejected
+    because it is overloaded or failing again, up to `attempts` times in
+    total.
+    Items that succeeded are not sent again. When the request itself
+    keeps failing the items not accepted yet are recorded with
+    `dead_letter` before the error is raised.
+    '''
+    errors = []
+    attempt = 0
+    while True:
+        try:
+            result = _send_chunk(conn, index_name, doc_type, chunk, lines)
+        except Exception as ex:
+            if not _retryable(ex) or attempt + 1 >= attempts:
+                dead_letter(index_name, _chunk_errors(chunk, ex))
+                raise
+            time.sleep(backoff(attempt, backoff_max))
+            attempt += 1
+            continue
+        retry = set([(e['op_type'], e['uid']) for e in result
+                     if _retryable_status(e['status'])])
+        if not retry or attempt + 1 >= attempts:
+            errors.extend(result)
+            return errors
+        errors.extend([e for e in result
+                       if (e['op_type'], e['uid']) not in retry])
+        items = [(item, item_lines)
+                 for item, item_lines in _item_lines(chunk, lines)
+                 if item in retry]
+        chunk = [item for item, _ in items]
+        lines = [line for _, item_lines in items for line in item_lines]
+        time.sleep(backoff(attempt, backoff_max))
+        attempt += 1
+
+
+def send_actions(es, actions, index_name=None, version=None):
+    '''
+    Stream (op_type, uid, source) actions to elastic search.
+
+    Actions are serialized and chunked by count and size in the calling
+    thread, which is the one allowed to touch the ZODB, while up to
+    `bulk_threads` worker threads send the chunks. Items rejected because
+    elastic search is overloaded or failing are sent again up to
+    `bulk_retries` times
+    and recorded with `dead_letter` if they keep failing. So are the items
+    of a request that keeps failing and of all actions not sent after it,
+    before its error is raised. Returns the list of items elastic
+    search reported an error for, see `log_errors`. `version` sends the
+    actions with that external version.
+    '''
+    conn = es.connection
+    if index_name is None:
+        index_name = es.index_name
+    doc_type = es.doc_type
+    # uid -> fingerprint, cached once elastic search accepted the document
+    fingerprints = {}
+    if es.settings.skip_unchanged:
+        actions = fingerprint.collect(actions, fingerprints)
+    chunks = _chunk_actions(actions, conn.transport.serializer, index_name,
+                            doc_type, es.settings.bulk_size,
+                            es.settings.bulk_max_bytes, version)
+    threads = es.settings.bulk_threads
+    attempts = es.settings.bulk_retries + 1
+    backoff_max = es.settings.bulk_backoff_max
+    errors = []
+    timed = es.settings.timing
+    # (seconds, data) of every request, recorded by the calling thread
+    # which the timings of the current request belong to
+    requests = []
+
+    def send(chunk, lines):
+        started = time.time()
+        result = _send_chunk_retrying(conn, index_name, doc_type, chunk,
+                                      lines, attempts, backoff_max)
+        fingerprint.remember(index_name, chunk, result, fingerprints)
+        if timed:
+            requests.append((time.time() - started, {
+                'items': len(chunk),
+                'errors': len(result),
+                'bytes': sum([len(line) + 1 for line in lines])
+            }))
+        dead_letter(index_name, [e for e in result
+                                 if _retryable_status(e['status'])])
+        return result
+
+    def drop(chunk, ex):
+        dead_letter(index_name, _chunk_errors(chunk, ex))
+
+    try:
+        if threads <= 1:
+            failure = None
+            for chunk, lines in chunks:
+                if failure is not None:
+                    drop(chunk, failure)
+                    continue
+                try:
+                    errors.extend(send(chunk, lines))
+                except Exception as ex:
+                    failure = ex
+            if failure is not None:
+                raise failure
+        else:
+            _send_threaded(chunks, send, threads, errors, drop)
+    finally:
+        for seconds, data in requests:
+            timing.record(es, 'bulk', seconds, **data)
+    return errors
+
+
+def _send_threaded(chunks, send, threads, errors, drop):
+    '''
+    send chunks from `threads` worker threads, adding the items that
+    failed to `errors`. Once a request failed the chunks not sent are
+    passed to `drop` with its error
+    '''
+    # bounded so serialized chunks do not pile up in memory when
+    # elastic search is slower than we produce them
+    queue = Queue(maxsize=threads * 2)
+    failures = []
+
+    def worker():
+        while True:
+            item = queue.get()
+            if item is _stop:
+                break
+            if failures:
+                # give up on the rest once a request failed
+                drop(item[0], failures[0])
+                continue
+            try:
+                errors.extend(send(*item))
+            except Exception as ex:
+                failures.append(ex)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    try:
+        for item in chunks:
+            if failures:
+                drop(item[0], failures[0])
+                continue
+            queue.put(item)
+    finally:
+        for _ in workers:
+            queue.put(_stop)
+        for thread in workers:
+            thread.join()
+
+    if failures:
+        raise failures[0]
+
+
+def log_errors(errors):
+    for error in errors:
+        logger.warn('Error indexing %s(%s): %s %r' % (
+            error['uid'], error['op_type'], error['status'], error['error']))
+
+
+def _chunk_errors(chunk, ex):
+    '''
+    errors for the items of a chunk whose request failed with `ex`
+    '''
+    status = getattr(ex, 'status_code', None)
+    return [{
+        'op_type': op_type,
+        'uid': uid,
+        'status': status,
+        'error': str(ex)
+    } for op_type, uid in chunk]
+
+
+def dead_letter(index_name, errors):
+    for error in errors:
+        deadletter.error(json.dumps({
+            'index': index_name,
+            'op_type': error['op_type'],
+            'uid': error['uid'],
+            'status': error['status'],
+            'error': error['error']
+        }, default=str))
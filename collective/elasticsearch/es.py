@@ -1,23 +1,34 @@
+from contextlib import contextmanager
 from logging import getLogger
+import threading
+import time
 import traceback
+import transaction
 
 from DateTime import DateTime
 from Products.CMFCore.permissions import AccessInactivePortalContent
 from Products.CMFCore.utils import _checkPermission
 from Products.CMFCore.utils import _getAuthenticatedUser
 from Products.ZCatalog.Lazy import LazyMap
+from collective.elasticsearch import fingerprint
 from collective.elasticsearch import hook
+from collective.elasticsearch import resultcache
+from collective.elasticsearch import slowlog
+from collective.elasticsearch import timing
 from collective.elasticsearch.brain import BrainFactory
+from collective.elasticsearch.brain import ElasticBrainFactory
+from collective.elasticsearch.brain import METADATA_FIELD
 from collective.elasticsearch.interfaces import IElasticSearchCatalog
-from collective.elasticsearch.interfaces import IElasticSettings
 from collective.elasticsearch.interfaces import IMappingProvider
 from collective.elasticsearch.interfaces import IQueryAssembler
+from collective.elasticsearch.interfaces import ISearchRouter
+from collective.elasticsearch.routing import ROUTING_HINT
+from collective.elasticsearch.settings import get_settings
 from elasticsearch import Elasticsearch
 from elasticsearch.exceptions import NotFoundError
-from plone.registry.interfaces import IRegistry
-from zope.component import ComponentLookupError
+from elasticsearch.exceptions import TransportError
+from transaction.interfaces import IDataManager
 from zope.component import getMultiAdapter
-from zope.component import getUtility
 from zope.globalrequest import getRequest
 from zope.interface import implements
 
@@ -29,42 +40,334 @@ warn = logger.warn
 CONVERTED_ATTR = '_elasticconverted'
 CUSTOM_INDEX_NAME_ATTR = '_elasticcustomindex'
 INDEX_VERSION_ATTR = '_elasticindexversion'
+SCROLL_TIMEOUT = '1m'
+# how long an index being rebuilt remembers deleted documents, so the
+# rebuild can not add back what was deleted while it ran
+REBUILD_GC_DELETES = '7d'
+GC_DELETES = '60s'
+# read timeout, in seconds, of index admin requests like merging segments
+# which take much longer than searches
+ADMIN_TIMEOUT = 600
+
+# settings that define how a client talks to the cluster.
+# Changing any of them rebuilds the shared client.
+CONNECTION_SETTINGS = (
+    'timeout',
+    'sniff_on_start',
+    'sniff_on_connection_fail',
+    'sniffer_timeout',
+    'retry_on_timeout',
+    'pool_maxsize',
+    'keep_alive',
+)
+
+# hosts -> (options, client)
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+def get_connection(hosts, **options):
+    '''
+    Return the Elasticsearch client shared by this process for `hosts`.
+
+    Clients (and their urllib3 connection pools) are thread safe so a
+    single instance is used by every ZServer thread. The client is
+    rebuilt whenever the connection options for the hosts change.
+    '''
+    hosts = tuple(hosts)
+    key = tuple(sorted(options.items()))
+    cached = _connections.get(hosts)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    with _connections_lock:
+        cached = _connections.get(hosts)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        kwargs = options.copy()
+        kwargs['maxsize'] = kwargs.pop('pool_maxsize', 10)
+        if not kwargs.pop('keep_alive', True):
+            kwargs['headers'] = {'connection': 'close'}
+        conn = Elasticsearch(list(hosts), **kwargs)
+        _connections[hosts] = (key, conn)
+        return conn
+
+
+def parse_sort(sort):
+    '''
+    convert a `field,field:order` sort string into the
+    list form used in a search body
+    '''
+    result = []
+    for item in (sort or '').split(','):
+        if not item:
+            continue
+        if ':' in item:
+            name, order = item.split(':', 1)
+            result.append({name: {'order': order}})
+        else:
+            result.append(item)
+    return result
 
 
 class ElasticResult(object):
 
     def __init__(self, es, query):
         self.es = es
-        self.bulk_size = es.get_setting('bulk_size', 50)
-        qassembler = getMultiAdapter((getRequest(), es), IQueryAssembler)
-        dquery, sort = qassembler.normalize(query)
-        equery = qassembler(dquery)
+        self.bulk_size = es.settings.bulk_size
+        self.cursor = es.settings.cursor_pagination
+        self.prefetch_pages = es.settings.prefetch_pages
+        if resultcache.enabled(es):
+            resultcache.round_effective(query)
+        # normalizing removes sorting and batching
+        self.catalog_query = query.copy()
+        # catalog results served when loading hits fails after the count
+        self.fallback = None
+        with timing.timed(es, 'query'):
+            qassembler = getMultiAdapter((getRequest(), es), IQueryAssembler)
+            dquery, sort = qassembler.normalize(query)
+            equery = qassembler(dquery)
+        if self.cursor:
+            # search_after needs a unique sort value for every hit
+            sort += ',_uid'
 
         # results are stored in a dictionary, keyed
         # but the start index of the bulk size for the
         # results it holds. This way we can skip around
         # for result data in a result object
         self.query = equery
-        result = es._search(self.query, sort=sort)['hits']
-        self.results = {
-            0: result['hits']
-        }
-        self.count = result['total']
         self.sort = sort
+        key = resultcache.make_key(es, es._search_body(equery, sort=sort))
+        cached = resultcache.get(es, key)
+        if cached is not None:
+            # pages loaded by any result of the same search are shared
+            self.count, self.results = cached
+            return
+        self.results = {}
+        # only count the hits, callers that just need len() do not
+        # pay for loading them
+        body = es._search_body(self.query, size=0)
+        started = time.time()
+        with timing.timed(es, 'search.count') as data:
+            response = es.connection.search(
+                index=es.index_name, doc_type=es.doc_type, body=body)
+            timing.describe(data, body, response,
+                            hits=response['hits']['total'])
+        self.count = response['hits']['total']
+        slowlog.record(es, 'count', self.catalog_query, self.sort, body,
+                       response, time.time() - started)
+        resultcache.store(es, key, (self.count, self.results))
+
+    def _fetch(self, keys):
+        '''
+        load the pages starting at `keys`. Adjacent pages are loaded
+        with one search, separate runs of pages in one msearch
+        '''
+        runs = []
+        for key in sorted(keys):
+            if runs and runs[-1][-1] + self.bulk_size == key:
+                runs[-1].append(key)
+            else:
+                runs.append([key])
+
+        bodies = []
+        for run in runs:
+            size = len(run) * self.bulk_size
+            previous = self.results.get(run[0] - self.bulk_size)
+            # pages served from the catalog have no sort values
+            search_after = previous and previous[-1].get('sort')
+            if self.cursor and search_after:
+                # sequential access, continue after the last hit of the
+                # previous page instead of making elastic skip `from` hits
+                bodies.append(self.es._search_body(
+                    self.query, sort=self.sort, size=size,
+                    search_after=search_after))
+            else:
+                bodies.append(self.es._search_body(
+                    self.query, sort=self.sort, size=size, start=run[0]))
+
+        started = time.time()
+        try:
+            with timing.timed(self.es, 'search.page') as data:
+                if len(bodies) == 1:
+                    responses = [self.es.connection.search(
+                        index=self.es.index_name, doc_type=self.es.doc_type,
+                        body=bodies[0])]
+                else:
+                    responses = self.es._msearch(bodies)
+                for body, response in zip(bodies, responses):
+                    timing.describe(data, body, response)
+        except Exception:
+            # the search already returned its count, the page must not
+            # fail now, serve it from the catalog like a failed search
+            warn('Error loading results of %r, using the catalog' % (
+                self.catalog_query,), exc_info=True)
+            self._fetch_catalog(keys)
+            return
+        seconds = time.time() - started
+        for body, response in zip(bodies, responses):
+            slowlog.record(self.es, 'page', self.catalog_query, self.sort,
+                           body, response, seconds)
+
+        for run, response in zip(runs, responses):
+            hits = response['hits']['hits']
+            for idx, key in enumerate(run):
+                start = idx * self.bulk_size
+                self.results[key] = hits[start:start + self.bulk_size]
+
+    def _fetch_catalog(self, keys):
+        '''
+        load the pages starting at `keys` from the catalog
+        '''
+        if self.fallback is None:
+            query = dict([(name, value)
+                          for name, value in self.catalog_query.items()
+                          if name not in ('b_start', 'b_size')])
+            with timing.timed(self.es, 'catalog.fallback'):
+                self.fallback = \
+                    self.es.catalogtool._old_unrestrictedSearchResults(
+                        **query)
+            # do not share these pages with other results of the search
+            self.results = self.results.copy()
+        for key in keys:
+            size = min(self.bulk_size, self.count - key)
+            hits = [{'fields': {'path.path': [brain.getPath()]}}
+                    for brain in self.fallback[key:key + size]]
+            # elastic search counted hits the catalog does not have
+            hits.extend([{}] * (size - len(hits)))
+            self.results[key] = hits
 
     def __getitem__(self, key):
         if isinstance(key, slice):
-            return [self[i] for i in range(key.start, key.end)]
+            indexes = range(*key.indices(self.count))
+            keys = set([(idx / self.bulk_size) * self.bulk_size
+                        for idx in indexes])
+            keys = [k for k in keys if k not in self.results]
+            if keys:
+                self._fetch(keys)
+            return [self[i] for i in indexes]
         else:
-            if key >= self.count:
+            if key < 0:
+                key += self.count
+            if key < 0 or key >= self.count:
                 raise IndexError
             result_key = (key / self.bulk_size) * self.bulk_size
             if result_key not in self.results:
-                self.results[result_key] = self.es._search(
-                    self.query, sort=self.sort, start=result_key)['hits']['hits']
+                keys = [result_key]
+                if (result_key - self.bulk_size) in self.results:
+                    # sequential access, read ahead the next pages
+                    # in the same round-trip
+                    for idx in range(1, self.prefetch_pages + 1):
+                        next_key = result_key + idx * self.bulk_size
+                        if next_key >= self.count or next_key in self.results:
+                            break
+                        keys.append(next_key)
+                self._fetch(keys)
             result_index = key % self.bulk_size
             return self.results[result_key][result_index]
 
+    def __iter__(self):
+        if not self.cursor or self.count <= self.bulk_size:
+            for idx in xrange(self.count):
+                yield self[idx]
+            return
+
+        # walking the full result set, let elastic keep a scroll
+        # context around instead of paging through it
+        body = self.es._search_body(self.query, sort=self.sort)
+        started = time.time()
+        try:
+            with timing.timed(self.es, 'search.scroll') as data:
+                result = self.es.connection.search(
+                    index=self.es.index_name, doc_type=self.es.doc_type,
+                    body=body, scroll=SCROLL_TIMEOUT)
+                timing.describe(data, body, result)
+        except Exception:
+            warn('Error scrolling results of %r, loading pages' % (
+                self.catalog_query,), exc_info=True)
+            for idx in xrange(self.count):
+                yield self[idx]
+            return
+        slowlog.record(self.es, 'scroll', self.catalog_query, self.sort, body,
+                       result, time.time() - started)
+        scroll_id = result.get('_scroll_id')
+        result_key = 0
+        try:
+            while True:
+                hits = result['hits']['hits']
+                if not hits:
+                    break
+                self.results.setdefault(result_key, hits)
+                for hit in hits:
+                    yield hit
+                result_key += len(hits)
+                if result_key >= self.count:
+                    break
+                try:
+                    with timing.timed(self.es, 'search.scroll') as data:
+                        result = self.es.connection.scroll(
+                            scroll_id=scroll_id, scroll=SCROLL_TIMEOUT)
+                        timing.describe(data, {'scroll_id': scroll_id},
+                                        result)
+                except Exception:
+                    warn('Error scrolling results of %r, loading pages' % (
+                        self.catalog_query,), exc_info=True)
+                    for idx in xrange(result_key, self.count):
+                        yield self[idx]
+                    return
+                scroll_id = result.get('_scroll_id', scroll_id)
+        finally:
+            if scroll_id:
+                try:
+                    self.es.connection.clear_scroll(scroll_id=scroll_id)
+                except Exception:
+                    pass
+
+
+class RebuiltIndexCleanup(object):
+    '''
+    drops an index rebuilt by a transaction that is aborted, the after
+    commit hook swapping it in does not run then
+    '''
+    implements(IDataManager)
+
+    def __init__(self, es, index_name):
+        self.es = es
+        self.index_name = index_name
+        self.transaction_manager = transaction.manager
+
+    def abort(self, trns):
+        hook.set_rebuild_index(self.es.index_name, None)
+        self.es.dropIndex(self.index_name)
+
+    tpc_abort = abort
+
+    def tpc_begin(self, trns):
+        pass
+
+    def commit(self, trns):
+        pass
+
+    def tpc_vote(self, trns):
+        pass
+
+    def tpc_finish(self, trns):
+        pass
+
+    def sortKey(self):
+        return 'collective.elasticsearch:%s' % self.index_name
+
+
+class ElasticLazyMap(LazyMap):
+    '''
+    LazyMap only uses item access, iterate over the
+    result itself so it can pick the cheapest strategy
+    '''
+
+    def __iter__(self):
+        for result in self._seq:
+            yield self._func(result)
+
 
 class ElasticSearchCatalog(object):
     '''
@@ -83,48 +386,71 @@ class ElasticSearchCatalog(object):
     def __init__(self, catalogtool):
         self.catalogtool = catalogtool
         self.catalog = catalogtool._catalog
-
-        try:
-            registry = getUtility(IRegistry)
-            try:
-                self.registry = registry.forInterface(IElasticSettings)
-            except:
-                self.registry = None
-        except ComponentLookupError:
-            self.registry = None
-
+        self.settings = get_settings(catalogtool)
         self._conn = None
 
     @property
     def connection(self):
         if self._conn is None:
-            self._conn = Elasticsearch(
-                self.registry.hosts,
-                timeout=self.get_setting('timeout', 0.5),
-                sniff_on_start=self.get_setting('sniff_on_start', False),
-                sniff_on_connection_fail=self.get_setting('sniff_on_connection_fail',
-                                                          False),
-                sniffer_timeout=self.get_setting('sniffer_timeout', 0.1),
-                retry_on_timeout=self.get_setting('retry_on_timeout', False))
+            options = dict([(name, getattr(self.settings, name))
+                            for name in CONNECTION_SETTINGS])
+            self._conn = get_connection(self.settings.hosts, **options)
         return self._conn
 
-    def _search(self, query, **query_params):
+    def _search_body(self, query, sort=None, start=None, size=None,
+                     search_after=None):
+        body = {
+            'query': query,
+            'stored_fields': ['path.path'],
+            'size': self.settings.bulk_size if size is None else size
+        }
+        if self.settings.native_brains:
+            body['_source'] = [METADATA_FIELD]
+        if sort:
+            body['sort'] = parse_sort(sort)
+        if start:
+            body['from'] = start
+        if search_after is not None:
+            body['search_after'] = search_after
+        return body
+
+    def _search(self, query, sort=None, start=None, size=None,
+                search_after=None, **query_params):
         '''
         '''
-        if 'start' in query_params:
-            query_params['from_'] = query_params.pop('start')
-        query_params['stored_fields'] = 'path.path'
-        query_params['size'] = self.get_setting('bulk_size', 50)
-
+        body = self._search_body(query, sort=sort, start=start, size=size,
+                                 search_after=search_after)
         return self.connection.search(index=self.index_name,
                                       doc_type=self.doc_type,
-                                      body={'query': query},
+                                      body=body,
                                       **query_params)
 
+    def _msearch(self, bodies):
+        '''
+        run several search bodies in one round-trip
+        '''
+        data = []
+        for body in bodies:
+            data.extend([{}, body])
+        responses = self.connection.msearch(index=self.index_name,
+                                            doc_type=self.doc_type,
+                                            body=data)['responses']
+        for response in responses:
+            if 'error' in response:
+                raise TransportError(response.get('status', 500),
+                                     response['error'])
+        return responses
+
     def search(self, query):
-        result = ElasticResult(self, query)
-        factory = BrainFactory(self.catalog)
-        return LazyMap(factory, result, result.count)
+        with timing.timed(self, 'search'):
+            result = ElasticResult(self, query)
+        if self.settings.native_brains:
+            factory = ElasticBrainFactory(self.catalogtool)
+        else:
+            factory = BrainFactory(self.catalog)
+        if self.settings.timing:
+            factory = timing.timed_factory(self, factory)
+        return ElasticLazyMap(factory, result, result.count)
 
     @property
     def catalog_converted(self):
@@ -132,10 +458,10 @@ class ElasticSearchCatalog(object):
 
     @property
     def enabled(self):
-        return self.registry and self.registry.enabled and self.catalog_converted
+        return self.settings.enabled and self.catalog_converted
 
     def get_setting(self, name, default=None):
-        return getattr(self.registry, name, default)
+        return getattr(self.settings, name, default)
 
     def catalog_object(self, obj, uid=None, idxs=[], update_metadata=1, pghandler=None):
         if idxs != ['getObjPositionInParent']:
@@ -144,7 +470,7 @@ class ElasticSearchCatalog(object):
 
         if not self.enabled:
             return
-        hook.add_object(self, obj)
+        hook.add_object(self, obj, idxs)
 
     def uncatalog_object(self, uid, obj=None, *args, **kwargs):
         # always need to uncatalog to remove brains, etc
@@ -156,17 +482,25 @@ class ElasticSearchCatalog(object):
 
     def manage_catalogRebuild(self, *args, **kwargs):
         if self.enabled:
+            if self.settings.zero_downtime_rebuild and self.index_version:
+                return self.rebuildAndSwap(*args, **kwargs)
             self.recreateCatalog()
+            with self.ingest_mode(self.index_name):
+                with hook.rebuilding(self, self.index_name):
+                    return self.catalogtool._old_manage_catalogRebuild(
+                        *args, **kwargs)
 
         return self.catalogtool._old_manage_catalogRebuild(*args, **kwargs)
 
     def manage_catalogClear(self, *args, **kwargs):
-        if self.enabled:
+        if self.enabled and hook.get_rebuild_indexer(self) is None:
+            # the rebuild manages the elastic index itself
             self.recreateCatalog()
 
         return self.catalogtool._old_manage_catalogClear(*args, **kwargs)
 
     def recreateCatalog(self):
+        fingerprint.cache.clear()
         conn = self.connection
         try:
             conn.indices.delete(index=self.real_index_name)
@@ -179,26 +513,157 @@ class ElasticSearchCatalog(object):
                 pass
         self.convertToElastic()
 
-    def searchResults(self, REQUEST=None, check_perms=False, **kw):
-        enabled = False
-        if self.enabled:
-            # need to also check is it is a search result we care about
-            # using EL for
-            if 'Title' in kw or 'SearchableText' in kw or 'Description' in kw:
-                # XXX need a smarter check here...
-                enabled = True
-        if not enabled:
-            if check_perms:
-                return self.catalogtool._old_searchResults(REQUEST, **kw)
-            else:
-                return self.catalogtool._old_unrestrictedSearchResults(REQUEST, **kw)
+    @contextmanager
+    def ingest_mode(self, index_name):
+        '''
+        tune an index for bulk ingest while the block runs: no refreshes,
+        no replicas and async translog. The previous settings are restored
+        even if the block fails, segments are merged if it succeeds.
+
+        Refreshing and merging only speed up searches, failing to do either
+        is logged and does not fail the block.
+        '''
+        conn = self.connection
+        current = conn.indices.get_settings(index=index_name)
+        current = current.values()[0]['settings']['index']
+        restore = {
+            'refresh_interval': current.get('refresh_interval', '1s'),
+            'number_of_replicas': current.get('number_of_replicas', 1),
+            'translog.durability': current.get('translog', {}).get(
+                'durability', 'request')
+        }
+        conn.indices.put_settings(index=index_name, body={'index': {
+            'refresh_interval': '-1',
+            'number_of_replicas': 0,
+            'translog.durability': 'async'
+        }}, request_timeout=ADMIN_TIMEOUT)
+        try:
+            yield
+        finally:
+            conn.indices.put_settings(index=index_name,
+                                      body={'index': restore},
+                                      request_timeout=ADMIN_TIMEOUT)
+            try:
+                conn.indices.refresh(index=index_name,
+                                     request_timeout=ADMIN_TIMEOUT)
+            except TransportError:
+                logger.warn('Error refreshing index %s' % index_name,
+                            exc_info=True)
+        try:
+            conn.indices.forcemerge(index=index_name,
+                                    request_timeout=ADMIN_TIMEOUT)
+        except TransportError:
+            logger.warn('Error merging segments of index %s' % index_name,
+                        exc_info=True)
+
+    def rebuildAndSwap(self, *args, **kwargs):
+        '''
+        Rebuild into the next index version while searches keep using the
+        current one. Once the rebuild is committed the alias points to the
+        new version in one atomic operation and the old version is removed.
+
+        While the rebuild runs every process also sends its changes to the
+        new version, see `hook.rebuild_batch`.
+        '''
+        conn = self.connection
+        live = conn.indices.get_alias(name=self.index_name).keys()
+        version = self.index_version + 1
+        new_index = '%s_%i' % (self.index_name, version)
+        while new_index in live:
+            version += 1
+            new_index = '%s_%i' % (self.index_name, version)
+        if conn.indices.exists(new_index):
+            # left over from a rebuild that did not finish
+            conn.indices.delete(index=new_index)
+
+        current = conn.indices.get_settings(index=self.index_name)
+        current = current.values()[0]['settings']['index']
+        settings = {}
+        for name in ('number_of_shards', 'number_of_replicas', 'analysis'):
+            if name in current:
+                settings[name] = current[name]
+        adapter = getMultiAdapter((getRequest(), self), IMappingProvider)
+        settings['gc_deletes'] = REBUILD_GC_DELETES
+        conn.indices.create(index=new_index, body={
+            'settings': {'index': settings},
+            'mappings': {self.doc_type: adapter()}
+        })
+        conn.indices.put_alias(index=new_index,
+                               name=hook.REBUILD_ALIAS % self.index_name)
+        hook.set_rebuild_index(self.index_name, new_index)
+
+        try:
+            with self.ingest_mode(new_index):
+                with hook.rebuilding(self, new_index):
+                    result = self.catalogtool._old_manage_catalogRebuild(
+                        *args, **kwargs)
+        except:
+            # keep serving the current version
+            hook.set_rebuild_index(self.index_name, None)
+            conn.indices.delete(index=new_index)
+            raise
+
+        setattr(self.catalogtool, INDEX_VERSION_ATTR, version)
+        trns = transaction.get()
+        trns.join(RebuiltIndexCleanup(self, new_index))
+        trns.addAfterCommitHook(self.swapIndex, args=(live, new_index))
+        return result
+
+    def dropIndex(self, index_name):
+        try:
+            self.connection.indices.delete(index=index_name)
+        except NotFoundError:
+            pass
 
+    def swapIndex(self, success, live, new_index):
+        '''
+        point the alias to the rebuilt index once the rebuild is committed,
+        drop it if the commit failed
+        '''
+        conn = self.connection
+        hook.set_rebuild_index(self.index_name, None)
+        if not success:
+            self.dropIndex(new_index)
+            return
+        actions = [{'remove': {'index': index, 'alias': self.index_name}}
+                   for index in live]
+        actions.extend([
+            {'add': {'index': new_index, 'alias': self.index_name}},
+            {'remove': {'index': new_index,
+                        'alias': hook.REBUILD_ALIAS % self.index_name}}
+        ])
+        conn.indices.update_aliases(body={'actions': actions})
+        conn.indices.put_settings(index=new_index,
+                                  body={'index': {'gc_deletes': GC_DELETES}})
+        resultcache.invalidate()
+        for index in live:
+            conn.indices.delete(index=index)
+
+    def searchResults(self, REQUEST=None, check_perms=False, **kw):
         if isinstance(REQUEST, dict):
+            if ROUTING_HINT in REQUEST:
+                REQUEST = REQUEST.copy()
+                kw.setdefault(ROUTING_HINT, REQUEST.pop(ROUTING_HINT))
             query = REQUEST.copy()
         else:
             query = {}
         query.update(kw)
 
+        enabled = False
+        if self.enabled:
+            router = getMultiAdapter((getRequest(), self), ISearchRouter)
+            enabled = router(query)
+        kw.pop(ROUTING_HINT, None)
+        query.pop(ROUTING_HINT, None)
+
+        if not enabled:
+            with timing.timed(self, 'catalog'):
+                if check_perms:
+                    return self.catalogtool._old_searchResults(REQUEST, **kw)
+                else:
+                    return self.catalogtool._old_unrestrictedSearchResults(
+                        REQUEST, **kw)
+
         if check_perms:
             show_inactive = query.get('show_inactive', False)
             if isinstance(REQUEST, dict) and not show_inactive:
@@ -212,14 +677,14 @@ class ElasticSearchCatalog(object):
                     AccessInactivePortalContent, self.catalogtool):
                 query['effectiveRange'] = DateTime()
         orig_query = query.copy()
-        # info('Running query: %s' % repr(orig_query))
         try:
             return self.search(query)
         except:
             info('Error running Query: %s\n%s' % (
                 repr(orig_query),
                 traceback.format_exc()))
-            return self.catalogtool._old_searchResults(REQUEST, **kw)
+            with timing.timed(self, 'catalog.fallback'):
+                return self.catalogtool._old_searchResults(REQUEST, **kw)
 
     def convertToElastic(self):
         setattr(self.catalogtool, CONVERTED_ATTR, True)
@@ -0,0 +1,804 @@
+'''
+In-process stand-in for the parts of the elastic search HTTP api this
+package uses, to run tests and benchmarks without a cluster.
+
+    server = FakeElasticServer(latency=0.005)
+    server.start()
+    # use server.url as the `hosts` setting
+    ...
+    server.stop()
+
+It keeps documents in memory and only approximates elastic search
+scoring and text analysis. Writes honor external versions, deleted
+documents are remembered for that until the index is removed. `latency`
+delays every request, `failure_rate`
+answers that share of requests with a 503 and `reject_rate` rejects that
+share of bulk items with a 429.
+'''
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs
+from urlparse import urlparse
+
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+
+class FakeError(Exception):
+
+    def __init__(self, status, reason):
+        self.status = status
+        self.reason = reason
+
+
+def _tokens(value):
+    if not isinstance(value, basestring):
+        value = unicode(value)
+    return re.findall(r'\w+', value.lower(), re.UNICODE)
+
+
+def _values(source, field):
+    '''
+    all values of a, possibly dotted, field in a document
+    '''
+    values = [source]
+    for part in field.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, dict) and part in value:
+                value = value[part]
+                if isinstance(value, list):
+                    found.extend(value)
+                else:
+                    found.append(value)
+        values = found
+    return [v for v in values if v is not None]
+
+
+def _field_query(query):
+    field, value = query.items()[0]
+    if isinstance(value, dict):
+        return field, value.get('query', value.get('value'))
+    return field, value
+
+
+def _text(source, field):
+    tokens = []
+    for value in _values(source, field):
+        tokens.extend(_tokens(value))
+    return tokens
+
+
+def _phrase(tokens, phrase, prefix=False):
+    if not phrase:
+        return False
+    for idx in range(len(tokens) - len(phrase) + 1):
+        window = tokens[idx:idx + len(phrase)]
+        if window[:-1] != phrase[:-1]:
+            continue
+        if window[-1] == phrase[-1] or (
+                prefix and window[-1].startswith(phrase[-1])):
+            return True
+    return False
+
+
+def _range(values, spec):
+    for value in values:
+        if 'gte' in spec and not value >= spec['gte']:
+            continue
+        if 'gt' in spec and not value > spec['gt']:
+            continue
+        if 'lte' in spec and not value <= spec['lte']:
+            continue
+        if 'lt' in spec and not value < spec['lt']:
+            continue
+        return True
+    return False
+
+
+def score(query, source):
+    '''
+    score of a document for a query, None if it does not match
+    '''
+    kind, spec = query.items()[0]
+    if kind == 'match_all':
+        return 1.0
+    if kind == 'bool':
+        total = 0.0
+        for clause in _clauses(spec.get('must')):
+            value = score(clause, source)
+            if value is None:
+                return None
+            total += value
+        for clause in _clauses(spec.get('filter')):
+            if score(clause, source) is None:
+                return None
+        for clause in _clauses(spec.get('must_not')):
+            if score(clause, source) is not None:
+                return None
+        should = _clauses(spec.get('should'))
+        matched = 0
+        for clause in should:
+            value = score(clause, source)
+            if value is not None:
+                matched += 1
+                total += value
+        minimum = spec.get('minimum_should_match')
+        if minimum is None:
+            only_should = not (spec.get('must') or spec.get('filter'))
+            minimum = should and only_should and 1 or 0
+        if matched < int(minimum):
+            return None
+        return total or 1.0
+    if kind == 'term':
+        field, value = _field_query(spec)
+        return value in _values(source, field) and 1.0 or None
+    if kind == 'terms':
+        field, value = spec.items()[0]
+        values = _values(source, field)
+        return any([v in values for v in value]) and 1.0 or None
+    if kind == 'prefix':
+        field, value = _field_query(spec)
+        return any([isinstance(v, basestring) and v.startswith(value)
+                    for v in _values(source, field)]) and 1.0 or None
+    if kind == 'range':
+        field, value = spec.items()[0]
+        return _range(_values(source, field), value) and 1.0 or None
+    if kind == 'match':
+        field, value = _field_query(spec)
+        tokens = set(_text(source, field))
+        matched = len([t for t in _tokens(value) if t in tokens])
+        return matched and float(matched) or None
+    if kind in ('match_phrase', 'match_phrase_prefix'):
+        field, value = _field_query(spec)
+        prefix = kind == 'match_phrase_prefix'
+        return _phrase(_text(source, field), _tokens(value),
+                       prefix) and 2.0 or None
+    raise FakeError(400, 'unsupported query %s' % kind)
+
+
+def _clauses(value):
+    if value is None:
+        return []
+    if isinstance(value, dict):
+        return [value]
+    return value
+
+
+def _parse_sort(sort):
+    result = []
+    for item in sort or []:
+        if isinstance(item, basestring):
+            result.append((item, item == '_score' and 'desc' or 'asc'))
+            continue
+        field, order = item.items()[0]
+        if isinstance(order, dict):
+            order = order.get('order', 'asc')
+        result.append((field, order))
+    return result
+
+
+def _flatten(settings, prefix=''):
+    '''
+    nested or dotted settings as a dict of dotted names
+    '''
+    result = {}
+    for key, value in settings.items():
+        key = prefix + key
+        if isinstance(value, dict):
+            result.update(_flatten(value, key + '.'))
+        else:
+            result[key] = value
+    if not prefix:
+        result = dict([(k[6:] if k.startswith('index.') else k, v)
+                       for k, v in result.items()])
+    return result
+
+
+def _nest(settings):
+    result = {}
+    for key, value in settings.items():
+        parts = key.split('.')
+        current = result
+        for part in parts[:-1]:
+            current = current.setdefault(part, {})
+        if not isinstance(value, list):
+            value = unicode(value)
+        current[parts[-1]] = value
+    return result
+
+
+class Index(object):
+
+    def __init__(self, name, body=None):
+        body = body or {}
+        self.name = name
+        self.settings = {
+            'number_of_shards': 5,
+            'number_of_replicas': 1
+        }
+        self.settings.update(_flatten(body.get('settings', {})))
+        self.mappings = body.get('mappings', {})
+        # doc type -> id -> (version, source)
+        self.docs = {}
+        # doc type -> id -> version of deleted documents
+        self.deleted = {}
+
+    def get_settings(self):
+        return {self.name: {'settings': {'index': _nest(self.settings)}}}
+
+
+class Store(object):
+    '''
+    indices, aliases and scroll contexts of a fake server
+    '''
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.indices = {}
+        self.aliases = {}
+        self.scrolls = {}
+
+    def resolve(self, name):
+        names = []
+        for part in (name or '_all').split(','):
+            if part in ('_all', '*'):
+                names.extend(self.indices.keys())
+            elif part in self.indices:
+                names.append(part)
+            elif part in self.aliases:
+                names.extend(self.aliases[part])
+            else:
+                raise FakeError(404, 'index_not_found_exception')
+        return [self.indices[n] for n in names]
+
+    def write_index(self, name):
+        if name not in self.indices and name not in self.aliases:
+            # elastic search creates missing indices on write
+            self.indices[name] = Index(name)
+        indices = self.resolve(name)
+        if len(indices) != 1:
+            raise FakeError(400, 'alias points to more than one index')
+        return indices[0]
+
+    def documents(self, name, doc_type=None):
+        for index in self.resolve(name):
+            for _type, docs in index.docs.items():
+                if doc_type and _type != doc_type:
+                    continue
+                for _id, (version, source) in docs.items():
+                    yield index, _type, _id, version, source
+
+    def search(self, name, doc_type, body):
+        query = body.get('query') or {'match_all': {}}
+        hits = []
+        for index, _type, _id, version, source in self.documents(
+                name, doc_type):
+            value = score(query, source)
+            if value is not None:
+                hits.append({
+                    '_index': index.name,
+                    '_type': _type,
+                    '_id': _id,
+                    '_score': value,
+                    'source': source
+                })
+
+        sort = _parse_sort(body.get('sort'))
+        for field, order in reversed(sort):
+            hits.sort(key=lambda hit: self._sort_value(hit, field),
+                      reverse=order == 'desc')
+        for hit in hits:
+            hit['sort'] = [self._sort_value(hit, field)[1]
+                           for field, order in sort]
+
+        search_after = body.get('search_after')
+        if search_after is not None:
+            position = len(hits)
+            for idx, hit in enumerate(hits):
+                if self._after(hit, sort, search_after):
+                    position = idx
+                    break
+        else:
+            position = body.get('from', 0)
+        # hits from the requested position and the total
+        return hits[position:], len(hits)
+
+    def _sort_value(self, hit, field):
+        if field == '_score':
+            value = hit['_score']
+        elif field == '_uid':
+            value = '%s#%s' % (hit['_type'], hit['_id'])
+        else:
+            values = _values(hit['source'], field)
+            value = values and values[0] or None
+        # documents without a value sort last
+        return (value is None, value)
+
+    def _after(self, hit, sort, search_after):
+        '''
+        whether a hit sorts after the `search_after` values
+        '''
+        for (field, order), after in zip(sort, search_after):
+            value = self._sort_value(hit, field)
+            after = (after is None, after)
+            if value == after:
+                continue
+            if order == 'desc':
+                return value < after
+            return value > after
+        return False
+
+
+def render_hits(hits, body, total):
+    size = body.get('size', 10)
+    stored = body.get('stored_fields')
+    source = body.get('_source', stored is None)
+    result = []
+    for hit in hits[:size]:
+        item = dict([(k, v) for k, v in hit.items() if k != 'source'])
+        if not body.get('sort'):
+            del item['sort']
+        if stored:
+            fields = {}
+            for field in stored:
+                values = _values(hit['source'], field)
+                if values:
+                    fields[field] = values
+            if fields:
+                item['fields'] = fields
+        if source is True:
+            item['_source'] = hit['source']
+        elif source:
+            item['_source'] = dict([(k, v) for k, v in hit['source'].items()
+                                    if k in source])
+        result.append(item)
+    scores = [h['_score'] for h in result]
+    return {
+        'total': total,
+        'max_score': scores and max(scores) or None,
+        'hits': result
+    }
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def do_HEAD(self):
+        self.dispatch('HEAD')
+
+    def dispatch(self, method):
+        server = self.server.fake
+        url = urlparse(self.path)
+        params = dict([(k, v[-1]) for k, v in parse_qs(url.query).items()])
+        parts = [p for p in url.path.split('/') if p]
+        length = int(self.headers.get('content-length') or 0)
+        body = length and self.rfile.read(length) or ''
+        started = time.time()
+        if server.latency:
+            time.sleep(server.latency)
+        try:
+            if server.failure_rate and random.random() < server.failure_rate:
+                raise FakeError(503, 'injected failure')
+            with server.store.lock:
+                status, result = server.api.handle(method, parts, params,
+                                                   body)
+        except FakeError as ex:
+            status, result = ex.status, {
+                'error': {'type': ex.reason, 'reason': ex.reason},
+                'status': ex.status}
+        except Exception as ex:
+            status, result = 500, {
+                'error': {'type': 'exception', 'reason': repr(ex)},
+                'status': 500}
+        server.requests.append((method, url.path, time.time() - started))
+        if isinstance(result, dict) and 'took' in result:
+            result['took'] = int((time.time() - started) * 1000)
+        data = method != 'HEAD' and json.dumps(result) or ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class Api(object):
+    '''
+    maps requests to the store, returns (status, result)
+    '''
+
+    def __init__(self, server):
+        self.server = server
+        self.store = server.store
+
+    def handle(self, method, parts, params, body):
+        if not parts:
+            return 200, {'name': 'fake', 'cluster_name': 'fake',
+                         'version': {'number': '5.5.3'}}
+        name = None
+        if not parts[0].startswith('_') or parts[0] == '_all':
+            name = parts.pop(0)
+        endpoint = parts and parts[-1].startswith('_') and parts.pop() or None
+        if parts and parts[0].startswith('_'):
+            # /_search/scroll, /_alias/name
+            endpoint, parts = parts[0], parts[1:] + (
+                endpoint and [endpoint] or [])
+        doc_type = parts and parts.pop(0) or None
+        doc_id = parts and parts.pop(0) or None
+
+        if endpoint == '_search' and doc_type == 'scroll':
+            return self.scroll(method, params, body)
+        if endpoint is None:
+            if doc_id is not None:
+                return self.document(method, name, doc_type, doc_id, body,
+                                     params)
+            return self.index(method, name, doc_type, body)
+        handler = getattr(self, 'api_%s' % endpoint[1:], None)
+        if handler is None:
+            raise FakeError(400, 'unsupported endpoint %s' % endpoint)
+        return handler(method, name, doc_type, params, body)
+
+    def _json(self, body):
+        return body and json.loads(body) or {}
+
+    def _ndjson(self, body):
+        return [json.loads(line) for line in body.splitlines() if line]
+
+    def index(self, method, name, doc_type, body):
+        store = self.store
+        if method == 'HEAD':
+            exists = name in store.indices or bool(store.aliases.get(name))
+            return exists and 200 or 404, {}
+        if method == 'PUT':
+            if name in store.indices:
+                raise FakeError(400, 'index_already_exists_exception')
+            store.indices[name] = Index(name, self._json(body))
+            return 200, {'acknowledged': True}
+        if method == 'DELETE':
+            for index in store.resolve(name):
+                del store.indices[index.name]
+                for indices in store.aliases.values():
+                    indices.discard(index.name)
+            return 200, {'acknowledged': True}
+        return 200, dict([(index.name, {
+            'settings': index.get_settings()[index.name]['settings'],
+            'mappings': index.mappings,
+            'aliases': dict([(alias, {}) for alias, names
+                             in store.aliases.items()
+                             if index.name in names])})
+            for index in store.resolve(name)])
+
+    def document(self, method, name, doc_type, doc_id, body, params=None):
+        params = params or {}
+        version = params.get('version')
+        version = version is not None and int(version) or None
+        version_type = params.get('version_type')
+        if method in ('PUT', 'POST'):
+            item = self.write('index', name, doc_type, doc_id,
+                              self._json(body), version, version_type)
+            return item['status'], item
+        if method == 'DELETE':
+            item = self.write('delete', name, doc_type, doc_id, None,
+                              version, version_type)
+            return item['status'], item
+        for index in self.store.resolve(name):
+            found = index.docs.get(doc_type, {}).get(doc_id)
+            if found is not None:
+                return 200, {'_index': index.name, '_type': doc_type,
+                             '_id': doc_id, '_version': found[0],
+                             'found': True, '_source': found[1]}
+        return 404, {'_index': name, '_type': doc_type, '_id': doc_id,
+                     'found': False}
+
+    def write(self, op_type, name, doc_type, doc_id, source, version=None,
+              version_type=None):
+        index = self.store.write_index(name)
+        docs = index.docs.setdefault(doc_type, {})
+        deleted = index.deleted.setdefault(doc_type, {})
+        current = docs.get(doc_id)
+        item = {'_index': index.name, '_type': doc_type, '_id': doc_id}
+        if version_type == 'external':
+            if op_type not in ('index', 'delete') or version is None:
+                item.update({'status': 400, 'error': {
+                    'type': 'action_request_validation_exception'}})
+                return item
+            known = current and current[0] or deleted.get(doc_id)
+            if known is not None and version <= known:
+                item.update({'_version': known, 'status': 409, 'error': {
+                    'type': 'version_conflict_engine_exception'}})
+                return item
+        else:
+            version = current and current[0] + 1 or 1
+        item['_version'] = version
+        if op_type == 'delete':
+            deleted[doc_id] = version
+            if current is None:
+                item.update({'status': 404, 'result': 'not_found'})
+            else:
+                del docs[doc_id]
+                item.update({'status': 200, 'result': 'deleted'})
+        elif op_type == 'update':
+            if current is None:
+                if not source.get('doc_as_upsert'):
+                    item.update({'status': 404, 'error': {
+                        'type': 'document_missing_exception'}})
+                    return item
+                current = (0, {})
+            data = dict(current[1])
+            data.update(source.get('doc', {}))
+            docs[doc_id] = (version, data)
+            item.update({'status': 200, 'result': 'updated'})
+        else:
+            if op_type == 'create' and current is not None:
+                item.update({'status': 409, 'error': {
+                    'type': 'version_conflict_engine_exception'}})
+                return item
+            docs[doc_id] = (version, source)
+            deleted.pop(doc_id, None)
+            item.update({'status': current and 200 or 201,
+                         'result': current and 'updated' or 'created'})
+        return item
+
+    def api_bulk(self, method, name, doc_type, params, body):
+        lines = self._ndjson(body)
+        items = []
+        errors = False
+        lines = iter(lines)
+        for action in lines:
+            op_type, meta = action.items()[0]
+            source = None
+            if op_type != 'delete':
+                source = next(lines)
+            index_name = meta.get('_index', name)
+            _type = meta.get('_type', doc_type)
+            _id = meta.get('_id') or uuid.uuid4().hex
+            if self.server.reject_rate and \
+                    random.random() < self.server.reject_rate:
+                item = {'_index': index_name, '_type': _type, '_id': _id,
+                        'status': 429, 'error': {
+                            'type': 'es_rejected_execution_exception'}}
+            else:
+                item = self.write(
+                    op_type, index_name, _type, _id, source,
+                    meta.get('_version', meta.get('version')),
+                    meta.get('_version_type', meta.get('version_type')))
+            errors = errors or 'error' in item
+            items.append({op_type: item})
+        return 200, {'took': 0, 'errors': errors, 'items': items}
+
+    def _search(self, name, doc_type, params, body):
+        body = dict(body)
+        for key in ('size', 'from'):
+            if key in params:
+                body[key] = int(params[key])
+        hits, total = self.store.search(name, doc_type, body)
+        result = {
+            'took': 0,
+            'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+            'hits': render_hits(hits, body, total)
+        }
+        if 'scroll' in params:
+            scroll_id = uuid.uuid4().hex
+            size = body.get('size', 10)
+            self.store.scrolls[scroll_id] = (hits[size:], total, body)
+            result['_scroll_id'] = scroll_id
+        return result
+
+    def api_search(self, method, name, doc_type, params, body):
+        return 200, self._search(name, doc_type, params, self._json(body))
+
+    def api_msearch(self, method, name, doc_type, params, body):
+        lines = self._ndjson(body)
+        responses = []
+        for header, search in zip(lines[::2], lines[1::2]):
+            try:
+                responses.append(self._search(
+                    header.get('index', name), header.get('type', doc_type),
+                    {}, search))
+            except FakeError as ex:
+                responses.append({'error': {'type': ex.reason},
+                                  'status': ex.status})
+        return 200, {'responses': responses}
+
+    def api_count(self, method, name, doc_type, params, body):
+        hits, total = self.store.search(name, doc_type, self._json(body))
+        return 200, {'count': total,
+                     '_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+
+    def scroll(self, method, params, body):
+        body = self._json(body)
+        scroll_ids = body.get('scroll_id') or params.get('scroll_id')
+        if method == 'DELETE':
+            if isinstance(scroll_ids, basestring):
+                scroll_ids = [scroll_ids]
+            for scroll_id in scroll_ids or []:
+                self.store.scrolls.pop(scroll_id, None)
+            return 200, {'succeeded': True}
+        try:
+            hits, total, search = self.store.scrolls[scroll_ids]
+        except KeyError:
+            raise FakeError(404, 'search_context_missing_exception')
+        size = search.get('size', 10)
+        self.store.scrolls[scroll_ids] = (hits[size:], total, search)
+        return 200, {'took': 0, '_scroll_id': scroll_ids,
+                     'hits': render_hits(hits, search, total)}
+
+    def api_mget(self, method, name, doc_type, params, body):
+        include = params.get('_source_include')
+        docs = []
+        for doc_id in self._json(body).get('ids', []):
+            status, doc = self.document('GET', name, doc_type, doc_id, None)
+            if include and doc.get('found'):
+                fields = include.split(',')
+                doc['_source'] = dict([(k, v) for k, v
+                                       in doc['_source'].items()
+                                       if k in fields])
+            docs.append(doc)
+        return 200, {'docs': docs}
+
+    def api_settings(self, method, name, doc_type, params, body):
+        indices = self.store.resolve(name)
+        if method == 'PUT':
+            settings = _flatten(self._json(body))
+            for index in indices:
+                index.settings.update(settings)
+            return 200, {'acknowledged': True}
+        result = {}
+        for index in indices:
+            result.update(index.get_settings())
+        return 200, result
+
+    def api_mapping(self, method, name, doc_type, params, body):
+        indices = self.store.resolve(name)
+        if method == 'PUT':
+            for index in indices:
+                mapping = index.mappings.setdefault(doc_type, {})
+                mapping.setdefault('properties', {}).update(
+                    self._json(body).get('properties', {}))
+            return 200, {'acknowledged': True}
+        return 200, dict([(index.name, {'mappings': index.mappings})
+                          for index in indices])
+
+    def _acknowledge(self, method, name, doc_type, params, body):
+        self.store.resolve(name)
+        return 200, {'_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+
+    api_refresh = api_flush = api_forcemerge = _acknowledge
+
+    def api_alias(self, method, name, doc_type, params, body):
+        # /index/_alias/name or /_alias/name
+        alias = doc_type
+        store = self.store
+        if method in ('PUT', 'POST', 'DELETE'):
+            for index in store.resolve(name):
+                names = store.aliases.setdefault(alias, set())
+                if method == 'DELETE':
+                    if index.name not in names:
+                        raise FakeError(404, 'aliases_not_found_exception')
+                    names.discard(index.name)
+                else:
+                    names.add(index.name)
+            return 200, {'acknowledged': True}
+        result = {}
+        for index_name in store.indices:
+            if name and index_name not in [
+                    i.name for i in store.resolve(name)]:
+                continue
+            aliases = dict([(a, {}) for a, names in store.aliases.items()
+                            if index_name in names and
+                            (alias is None or a == alias)])
+            if aliases:
+                result[index_name] = {'aliases': aliases}
+        if not result and (alias or name):
+            return 404, {'error': 'alias missing', 'status': 404}
+        return 200, result
+
+    def api_aliases(self, method, name, doc_type, params, body):
+        if method != 'POST':
+            return self.api_alias(method, name, doc_type, params, body)
+        store = self.store
+        for action in self._json(body).get('actions', []):
+            kind, spec = action.items()[0]
+            indices = spec.get('indices') or [spec['index']]
+            for index_name in indices:
+                if index_name not in store.indices:
+                    raise FakeError(404, 'index_not_found_exception')
+                names = store.aliases.setdefault(spec['alias'], set())
+                if kind == 'add':
+                    names.add(index_name)
+                else:
+                    names.discard(index_name)
+        return 200, {'acknowledged': True}
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # clients dropping keep-alive connections, request errors are
+        # answered by the handler
+        pass
+
+
+class FakeElasticServer(object):
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0,
+                 failure_rate=0, reject_rate=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.reject_rate = reject_rate
+        self.store = Store()
+        self.api = Api(self)
+        # (method, path, seconds) of every request served
+        self.requests = []
+        self.httpd = _Server((host, port), Handler)
+        self.httpd.fake = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://%s:%i' % (host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def reset(self):
+        with self.store.lock:
+            self.store.__init__()
+            del self.requests[:]
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9200)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds to delay every request')
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help='share of requests answered with a 503')
+    parser.add_argument('--reject-rate', type=float, default=0,
+                        help='share of bulk items rejected with a 429')
+    args = parser.parse_args(argv)
+    server = FakeElasticServer(args.host, args.port, args.latency,
+                               args.failure_rate, args.reject_rate)
+    print 'Serving fake elastic search on %s' % server.url
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
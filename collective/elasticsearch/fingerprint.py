@@ -0,0 +1,161 @@
+from collections import OrderedDict
+from itertools import islice
+
+import hashlib
+import json
+import logging
+import threading
+
+
+logger = logging.getLogger('collective.elasticsearch')
+
+# stored with every document indexed while `skip_unchanged` is on
+FINGERPRINT_FIELD = 'index_fingerprint'
+
+
+class FingerprintCache(object):
+    '''
+    thread safe LRU of (index name, uid) -> fingerprint of the data last
+    sent to elastic search
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.skipped = 0
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                return None
+            self.data[key] = value
+            return value
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+cache = FingerprintCache(0)
+
+
+def fingerprint(data):
+    return hashlib.sha1(
+        json.dumps(data, sort_keys=True, default=str)).hexdigest()
+
+
+def _remote_fingerprints(es, index_name, uids):
+    result = es.connection.mget(
+        index=index_name, doc_type=es.doc_type, body={'ids': uids},
+        _source_include=FINGERPRINT_FIELD)
+    fingerprints = {}
+    for doc in result['docs']:
+        if doc.get('found'):
+            fingerprints[doc['_id']] = doc['_source'].get(FINGERPRINT_FIELD)
+    return fingerprints
+
+
+def filter_unchanged(es, actions, index_name=None):
+    '''
+    Drop index actions whose data is the same as what was last sent for
+    the document, according to the local cache or, with
+    `fingerprint_check_elastic`, the fingerprint stored in elastic search.
+    The local cache does not see what other ZEO clients send so it is
+    only trusted on its own when elastic search is not checked. Any other
+    action invalidates the cached fingerprint of its document. The
+    fingerprints of the actions passed on are cached by `remember` once
+    they were accepted.
+    '''
+    if index_name is None:
+        index_name = es.index_name
+    settings = es.settings
+    cache.size = settings.fingerprint_cache_size
+    check_elastic = settings.fingerprint_check_elastic
+    actions = iter(actions)
+    while True:
+        batch = list(islice(actions, settings.bulk_size))
+        if not batch:
+            break
+
+        unknown = []
+        for idx, (op_type, uid, source) in enumerate(batch):
+            key = (index_name, uid)
+            if op_type != 'index':
+                cache.discard(key)
+                continue
+            value = fingerprint(source)
+            if not check_elastic and cache.get(key) == value:
+                batch[idx] = None
+                continue
+            source[FINGERPRINT_FIELD] = value
+            unknown.append(uid)
+
+        remote = {}
+        if unknown and check_elastic:
+            remote = _remote_fingerprints(es, index_name, unknown)
+
+        skipped = 0
+        for action in batch:
+            if action is None:
+                skipped += 1
+                continue
+            op_type, uid, source = action
+            if op_type == 'index':
+                value = source[FINGERPRINT_FIELD]
+                if remote.get(uid) == value:
+                    cache.set((index_name, uid), value)
+                    skipped += 1
+                    continue
+            yield action
+
+        if skipped:
+            with cache.lock:
+                cache.skipped += skipped
+            logger.info('Skipped %i unchanged documents' % skipped)
+
+
+def collect(actions, fingerprints):
+    '''
+    pass actions on, noting the fingerprints of index actions by uid
+    '''
+    for action in actions:
+        op_type, uid, source = action
+        if op_type == 'index' and source and source.get(FINGERPRINT_FIELD):
+            fingerprints[uid] = source[FINGERPRINT_FIELD]
+        yield action
+
+
+def remember(index_name, chunk, errors, fingerprints):
+    '''
+    cache the fingerprints noted by `collect` of the documents of a bulk
+    chunk elastic search accepted
+    '''
+    failed = set([e['uid'] for e in errors])
+    for op_type, uid in chunk:
+        value = fingerprints.pop(uid, None)
+        if value is not None and uid not in failed:
+            cache.set((index_name, uid), value)
+
+
+def forget(errors, index_name):
+    '''
+    documents that failed to index may not match their cached fingerprint
+    '''
+    for error in errors:
+        cache.discard((index_name, error['uid']))
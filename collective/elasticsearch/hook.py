@@ -1,106 +1,285 @@
-from collective.elasticsearch.indexes import getIndex
+from collective.elasticsearch import fingerprint
+from collective.elasticsearch import resultcache
+from collective.elasticsearch import timing
+from collective.elasticsearch.brain import get_metadata
+from collective.elasticsearch.brain import METADATA_FIELD
+from collective.elasticsearch.bulk import log_errors
+from collective.elasticsearch.bulk import send_actions
+from collective.elasticsearch.indexes import get_index_plan
+from collective.elasticsearch.indexqueue import get_queue
 from collective.elasticsearch.interfaces import IAdditionalIndexDataProvider
+from collective.elasticsearch.outbox import get_outbox
+from collective.elasticsearch.outbox import get_outbox_path
 from collective.elasticsearch.utils import getUID
+from elasticsearch.exceptions import NotFoundError
 from plone import api
 from plone.app.uuid.utils import uuidToObject
 from plone.indexer.interfaces import IIndexableObject
 from plone.indexer.interfaces import IIndexer
 from plone.uuid.interfaces import IUUID
-from Products.CMFCore.interfaces import ISiteRoot
 from zope.component import getAdapters
 from zope.component import queryMultiAdapter
+from contextlib import contextmanager
 from zope.component.hooks import getSite
+from zope.component.hooks import setSite
 
+import atexit
+import itertools
 import logging
-import random
+import threading
 import time
 import traceback
 import transaction
-import urllib3
 
 
 logger = logging.getLogger('collective.elasticsearch')
 
 
-def index_batch(remove, index, positions, es=None):
+def index_batch(remove, index, positions, es=None, idxs=None):
+    '''
+    `idxs` maps uids in `index` to the list of indexes to update,
+    other objects are indexed in full
+    '''
     if es is None:
         from collective.elasticsearch.es import ElasticSearchCatalog
         es = ElasticSearchCatalog(api.portal.get_tool('portal_catalog'))
-    conn = es.connection
-    bulk_size = es.get_setting('bulk_size', 50)
-
+    if idxs is None:
+        idxs = {}
+    errors = []
+
+    def send(actions):
+        if not es.settings.skip_unchanged:
+            return send_actions(es, actions)
+        result = send_actions(es, fingerprint.filter_unchanged(es, actions))
+        fingerprint.forget(result, es.index_name)
+        return result
+
+    # each kind is sent separately so a delete can not overtake
+    # the index operation of a re-added object
     if len(remove) > 0:
-        bulk_data = []
-        for uid in remove:
-            bulk_data.append({
-                'delete': {
-                    '_index': es.index_name,
-                    '_type': es.doc_type,
-                    '_id': uid
-                }
-            })
-        es.connection.bulk(index=es.index_name, doc_type=es.doc_type, body=bulk_data)
+        errors.extend(send([('delete', uid, None) for uid in remove]))
 
     if len(index) > 0:
         if type(index) in (list, tuple, set):
-            # does not contain objects, must be async, convert to dict
-            index = dict([(k, None) for k in index])
-        bulk_data = []
+            # does not contain objects, must be async
+            index = resolve_uids(index, es)
+        index_errors = send(get_index_actions(index, es, idxs))
+        # partial updates of documents elastic search does not have yet
+        missing = dict([(e['uid'], index[e['uid']]) for e in index_errors
+                        if e['op_type'] == 'update' and e['status'] == 404])
+        if missing:
+            index_errors = [e for e in index_errors if e['uid'] not in missing]
+            index_errors.extend(send(get_index_actions(missing, es)))
+        errors.extend(index_errors)
+
+    if len(positions) > 0:
+        errors.extend(send(get_position_actions(positions, es)))
+
+    log_errors(errors)
+    rebuild_batch(remove, index, positions, es)
+    return errors
+
+
+# alias of the index a zero downtime rebuild builds, which every process
+# also sends its changes to while the rebuild runs
+REBUILD_ALIAS = '%s_rebuild'
+# seconds a looked up rebuild index is used for, so commits do not wait
+# for elastic search. Other instances start sending their changes to a
+# rebuild up to this long after it started.
+REBUILD_CHECK_INTERVAL = 5.0
+
+# index name -> (expires, name of the index being rebuilt or None)
+_rebuild_indexes = {}
+
+
+def set_rebuild_index(index_name, rebuild_index):
+    _rebuild_indexes[index_name] = (
+        time.time() + REBUILD_CHECK_INTERVAL, rebuild_index)
+
+
+def get_rebuild_index(es):
+    '''
+    name of the index a rebuild running in any process builds, if any.
+    Never raises, elastic search being down must not fail the commit.
+    '''
+    if not es.index_version:
+        # only versioned indexes are rebuilt next to the live one
+        return None
+    cached = _rebuild_indexes.get(es.index_name)
+    if cached is not None and cached[0] > time.time():
+        return cached[1]
+    rebuild_index = None
+    try:
+        aliases = es.connection.indices.get_alias(
+            name=REBUILD_ALIAS % es.index_name)
+        rebuild_index = aliases and aliases.keys()[0] or None
+    except NotFoundError:
+        pass
+    except Exception:
+        logger.warn('Could not look up the rebuild index of %s' %
+                    es.index_name, exc_info=True)
+    set_rebuild_index(es.index_name, rebuild_index)
+    return rebuild_index
+
+
+def external_version():
+    '''
+    Writes to an index being rebuilt are versioned with the time they are
+    sent. The rebuild uses the time it started, so the objects it indexes
+    as they were back then do not overwrite changes committed since.
+    '''
+    return int(time.time() * 1000)
+
+
+def rebuild_batch(remove, index, positions, es):
+    '''
+    Send the changes of a batch to the index a rebuild builds as full
+    documents, partial updates can not be versioned. Errors are logged,
+    the changes were handled for the live index already.
+    '''
+    index_name = get_rebuild_index(es)
+    if index_name is None:
+        return
+    try:
+        _rebuild_batch(remove, index, positions, es, index_name)
+    except Exception:
+        logger.error('Error sending changes to rebuilt index %s' %
+                     index_name, exc_info=True)
+
 
-        for uid, obj in index.items():
+def _rebuild_batch(remove, index, positions, es, index_name):
+    if type(index) in (list, tuple, set):
+        index = resolve_uids(index, es)
+    else:
+        index = dict(index)
+    site = getSite()
+    for path, ids in positions.items():
+        for _id in ids:
+            obj = site.unrestrictedTraverse('%s/%s' % (path, _id), None)
+            uid = obj is not None and IUUID(obj, None)
+            if uid and uid not in index:
+                index[uid] = obj
+    actions = itertools.chain(
+        [('delete', uid, None) for uid in remove],
+        get_index_actions(index, es))
+    errors = send_actions(es, actions, index_name=index_name,
+                          version=external_version())
+    # 404: deleted before the rebuild reached it, 409: changed again since
+    log_errors([e for e in errors if e['status'] not in (404, 409)])
+
+
+def batch_actions(remove, index, positions, es, idxs=None):
+    actions = itertools.chain(
+        [('delete', uid, None) for uid in remove],
+        get_index_actions(index, es, idxs),
+        get_position_actions(positions, es))
+    if es.settings.skip_unchanged:
+        actions = fingerprint.filter_unchanged(es, actions)
+    return actions
+
+
+def queue_batch(remove, index, positions, es, idxs=None):
+    '''
+    Compute the actions of a batch and leave sending them to the process
+    wide index queue. Partial updates of documents elastic search does not
+    have yet are only logged, there is no object to fall back to once the
+    queue sends them.
+    '''
+    queue = get_queue(es)
+    for op_type, uid, source in batch_actions(remove, index, positions, es,
+                                              idxs):
+        queue.put(es.index_name, es.doc_type, op_type, uid, source)
+
+
+def outbox_batch(remove, index, positions, es, idxs=None):
+    '''
+    Compute the actions of a batch and store them in the outbox, which
+    sends them from a background thread until elastic search accepts them
+    '''
+    get_outbox(es).add([
+        (es.index_name, es.doc_type) + action
+        for action in batch_actions(remove, index, positions, es, idxs)])
+
+
+def get_index_actions(index, es, idxs=None):
+    for uid, obj in index.items():
+        if obj is None:
+            obj = uuidToObject(uid)
             if obj is None:
-                obj = uuidToObject(uid)
-                if obj is None:
+                continue
+        names = idxs and idxs.get(uid)
+        if names:
+            doc = get_index_data(uid, obj, es, names)
+            # the stored fingerprint no longer describes the document
+            doc[fingerprint.FINGERPRINT_FIELD] = None
+            yield 'update', uid, {'doc': doc}
+        else:
+            yield 'index', uid, get_index_data(uid, obj, es)
+
+
+def resolve_uids(uids, es):
+    '''
+    Map uids to their objects, traversing to the paths the catalog has for
+    them instead of searching the catalog for every uid. Objects that can
+    not be found this way map to None.
+    '''
+    catalog = es.catalogtool._catalog
+    uid_index = catalog.indexes.get('UID')
+    rids = getattr(uid_index, '_index', {})
+    site = getSite()
+    objects = {}
+    for uid in uids:
+        obj = None
+        rid = rids.get(uid)
+        if rid is not None:
+            path = catalog.paths.get(rid)
+            if path is not None:
+                obj = site.unrestrictedTraverse(path, None)
+        objects[uid] = obj
+    return objects
+
+
+def get_position_actions(positions, es):
+    '''
+    `positions` maps parent paths to the new positions of the children
+    that moved. The children are not loaded, their uids come from the
+    catalog metadata.
+    '''
+    catalog = es.catalogtool._catalog
+    uid_column = catalog.schema.get('UID')
+    site = getSite()
+    for path, ids in positions.items():
+        for _id, position in ids.items():
+            child_path = '%s/%s' % (path, _id)
+            uid = None
+            rid = catalog.uids.get(child_path)
+            if rid is not None and uid_column is not None:
+                uid = catalog.data[rid][uid_column]
+            if not uid:
+                ob = site.unrestrictedTraverse(child_path, None)
+                if ob is None:
+                    logger.warn('could not find object to index positions')
+                    continue
+                uid = IUUID(ob, None)
+                if not uid:
                     continue
-            bulk_data.extend([{
-                'index': {
-                    '_index': es.index_name,
-                    '_type': es.doc_type,
-                    '_id': uid
+            yield 'update', uid, {
+                'doc': {
+                    'getObjPositionInParent': position,
+                    fingerprint.FINGERPRINT_FIELD: None
                 }
-            }, get_index_data(uid, obj, es)])
-            if len(bulk_data) % bulk_size == 0:
-                conn.bulk(index=es.index_name, doc_type=es.doc_type, body=bulk_data)
-                bulk_data = []
+            }
 
-        if len(bulk_data) > 0:
-            conn.bulk(index=es.index_name, doc_type=es.doc_type, body=bulk_data)
 
-    if len(positions) > 0:
-        bulk_data = []
-        index = getIndex(es.catalogtool._catalog, 'getObjPositionInParent')
-        for uid, ids in positions.items():
-            if uid == '/':
-                parent = getSite()
-            else:
-                parent = uuidToObject(uid)
-            if parent is None:
-                logger.warn('could not find object to index positions')
-                continue
-            for _id in ids:
-                ob = parent[_id]
-                wrapped_object = get_wrapped_object(ob, es)
-                try:
-                    value = index.get_value(wrapped_object)
-                except:
-                    continue
-                bulk_data.extend([{
-                    'update': {
-                        '_index': es.index_name,
-                        '_type': es.doc_type,
-                        '_id': IUUID(ob)
-                    }
-                }, {
-                    'doc': {
-                        'getObjPositionInParent': value
-                    }
-                }])
-                if len(bulk_data) % bulk_size == 0:
-                    conn.bulk(index=es.index_name, doc_type=es.doc_type, body=bulk_data)
-                    bulk_data = []
-
-        if len(bulk_data) > 0:
-            conn.bulk(index=es.index_name, doc_type=es.doc_type, body=bulk_data)
+def changed_positions(before, after):
+    '''
+    positions of the ids in `after` that are not where they were in `before`
+    '''
+    positions = {}
+    for idx, _id in enumerate(after):
+        if idx >= len(before) or before[idx] != _id:
+            positions[_id] = idx
+    return positions
 
 
 def get_wrapped_object(obj, es):
@@ -119,42 +298,57 @@ def get_wrapped_object(obj, es):
     return wrapped_object
 
 
-def get_index_data(uid, obj, es):
+def get_index_data(uid, obj, es, idxs=None):
+    '''
+    data to index for `obj`, limited to the `idxs` indexes if given
+    '''
     catalog = es.catalogtool._catalog
 
     wrapped_object = get_wrapped_object(obj, es)
     index_data = {}
-    for index_name in catalog.indexes.keys():
-        index = getIndex(catalog, index_name)
-        if index is not None:
-            try:
-                value = index.get_value(wrapped_object)
-            except:
-                logger.info('Error indexing value: %s: %s\n%s' % (
-                    '/'.join(obj.getPhysicalPath()),
-                    index_name,
-                    traceback.format_exc()))
-                value = None
-            if value in (None, 'None'):
-                # yes, we'll index null data...
-                value = None
-
-            # Ignore errors in converting to unicode, so json.dumps
-            # does not barf when we're trying to send data to ES.
-            if isinstance(value, str):
-                value = unicode(value, 'utf-8', 'ignore')
-
-            index_data[index_name] = value
+    timed = es.settings.timing
+    plan = get_index_plan(catalog)
+    if idxs:
+        items = [(name, plan.indexes[name]) for name in idxs
+                 if name in plan.indexes]
+    else:
+        items = plan.items
+    for index_name, index in items:
+        if timed:
+            started = time.time()
+        try:
+            value = index.get_value(wrapped_object)
+        except:
+            logger.info('Error indexing value: %s: %s\n%s' % (
+                '/'.join(obj.getPhysicalPath()),
+                index_name,
+                traceback.format_exc()))
+            value = None
+        if value in (None, 'None'):
+            # yes, we'll index null data...
+            value = None
+
+        # Ignore errors in converting to unicode, so json.dumps
+        # does not barf when we're trying to send data to ES.
+        if isinstance(value, str):
+            value = unicode(value, 'utf-8', 'ignore')
+
+        index_data[index_name] = value
+        if timed:
+            timing.record(es, 'index_data.' + index_name,
+                          time.time() - started)
 
     # in case these indexes are deleted(to increase performance and improve ram usage)
     for name in ('SearchableText', 'Title', 'Description'):
-        if name in index_data:
+        if name in index_data or (idxs and name not in idxs):
             continue
+        if timed:
+            started = time.time()
         indexer = queryMultiAdapter((obj, es.catalogtool), IIndexer, name=name)
         if indexer is not None:
             try:
                 val = indexer()
-                if isinstance(value, str):
+                if isinstance(val, str):
                     val = unicode(val, 'utf-8', 'ignore')
                 index_data[name] = val
             except:
@@ -167,6 +361,11 @@ def get_index_data(uid, obj, es):
             if callable(val):
                 val = val()
             index_data[name] = val
+        if timed:
+            timing.record(es, 'index_data.' + name, time.time() - started)
+
+    if es.settings.native_brains:
+        index_data[METADATA_FIELD] = get_metadata(catalog, wrapped_object)
 
     for _, adapter in getAdapters((obj,), IAdditionalIndexDataProvider):
         index_data.update(adapter(es, index_data))
@@ -178,51 +377,177 @@ try:
     from collective.celery import task
 
     @task()
-    def index_batch_async(remove, index, positions):
-        retries = 0
-        while True:
-            # if doing batch updates, this can give ES problems
-            if retries < 4:
-                try:
-                    index_batch(remove, index, positions)
-                    break
-                except urllib3.exceptions.ReadTimeoutError:
-                    retries += 1
-                    if retries >= 4:
-                        raise
-                    time.sleep(random.choice([0.5, 0.75, 1, 1.25, 1.5]))
+    def index_batch_async(remove, index, positions, idxs=None):
+        # items elastic search fails on are retried by send_actions, the
+        # whole batch is not computed and sent again
+        index_batch(remove, index, positions, idxs=idxs)
 
     CELERY_INSTALLED = True
 except ImportError:
     CELERY_INSTALLED = False
 
 
+class CeleryBatch(object):
+    '''
+    operations pending for the catalog of one site
+    '''
+
+    def __init__(self):
+        self.remove = set()
+        self.index = set()
+        self.idxs = {}
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.remove) + len(self.index) + sum(
+            [len(ids) for ids in self.positions.values()])
+
+    def add(self, hook):
+        for uid in hook.remove:
+            self.index.discard(uid)
+            self.idxs.pop(uid, None)
+            self.remove.add(uid)
+        partial = hook.partial
+        for uid in hook.index:
+            self.remove.discard(uid)
+            names = partial.get(uid)
+            if uid in self.index:
+                current = self.idxs.get(uid)
+                if current is None or names is None:
+                    self.idxs.pop(uid, None)
+                else:
+                    current.update(names)
+            else:
+                self.index.add(uid)
+                if names is not None:
+                    self.idxs[uid] = set(names)
+        for path, ids in hook.positions.items():
+            self.positions.setdefault(path, {}).update(ids)
+
+
+class CeleryBatcher(object):
+    '''
+    Collect the operations of transactions committed within
+    `celery_batch_window` seconds into tasks of at most `celery_batch_size`
+    documents. Operations on the same uid are coalesced, the last one wins.
+    Every site gets batches of its own, a task indexes into the catalog
+    of the site it was scheduled from.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timer = None
+        # site path -> CeleryBatch
+        self.batches = {}
+
+    def __len__(self):
+        return sum([len(batch) for batch in self.batches.values()])
+
+    def add(self, hook, settings):
+        site_path = getSite().getPhysicalPath()
+        with self.lock:
+            batch = self.batches.get(site_path)
+            if batch is None:
+                batch = self.batches[site_path] = CeleryBatch()
+            batch.add(hook)
+
+            if len(batch) >= settings.celery_batch_size:
+                # scheduled from the site of the batch
+                self._schedule(site_path)
+            elif self.timer is None:
+                self.timer = threading.Timer(settings.celery_batch_window,
+                                             self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        '''
+        schedule what is pending from a thread without a site, like the
+        one of the timer, using a connection of its own
+        '''
+        with self.lock:
+            if not self.batches:
+                return
+            import Zope2
+            app = Zope2.app()
+            try:
+                for site_path in self.batches.keys():
+                    setSite(app.unrestrictedTraverse(site_path))
+                    self._schedule(site_path)
+            finally:
+                setSite(None)
+                app._p_jar.close()
+
+    def _schedule(self, site_path):
+        batch = self.batches.pop(site_path)
+        if not self.batches and self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not len(batch):
+            return
+        index_batch_async.apply_async(
+            args=[list(batch.remove), list(batch.index), batch.positions],
+            kwargs={'idxs': dict([(uid, list(names))
+                                  for uid, names in batch.idxs.items()])},
+            without_transaction=True)
+
+
+celery_batcher = CeleryBatcher()
+atexit.register(celery_batcher.flush)
+
+
 class CommitHook(object):
 
     def __init__(self, es):
         self.remove = []
         self.index = {}
+        # uid -> set of indexes to update, None for the full document
+        self.idxs = {}
         self.positions = {}
         self.es = es
 
+    @property
+    def partial(self):
+        return dict([(uid, list(idxs)) for uid, idxs in self.idxs.items()
+                     if idxs is not None and uid in self.index])
+
     def schedule_celery(self):
+        settings = self.es.settings
+        if settings.celery_batch_size > 0:
+            celery_batcher.add(self, settings)
+            return
         index_batch_async.apply_async(
             args=[self.remove, self.index.keys(), self.positions],
-            kwargs={},
+            kwargs={'idxs': self.partial},
             without_transaction=True)
 
     def __call__(self, trns):
         if not trns:
             return
 
-        if CELERY_INSTALLED:
-            self.schedule_celery()
-        else:
-            index_batch(self.remove, self.index, self.positions, self.es)
+        try:
+            if CELERY_INSTALLED:
+                self.schedule_celery()
+            elif get_outbox_path():
+                outbox_batch(self.remove, self.index, self.positions,
+                             self.es, self.partial)
+                rebuild_batch(self.remove, self.index, self.positions,
+                              self.es)
+            elif self.es.settings.index_queue:
+                queue_batch(self.remove, self.index, self.positions, self.es,
+                            self.partial)
+                rebuild_batch(self.remove, self.index, self.positions,
+                              self.es)
+            else:
+                index_batch(self.remove, self.index, self.positions,
+                            self.es, self.partial)
+        finally:
+            resultcache.invalidate()
 
-        self.index = {}
-        self.remove = []
-        self.positions = {}
+            self.index = {}
+            self.idxs = {}
+            self.remove = []
+            self.positions = {}
 
 
 def getHook(es=None):
@@ -250,16 +575,97 @@ def remove_object(es, obj):
     hook.remove.append(uid)
     if uid in hook.index:
         del hook.index[uid]
+    hook.idxs.pop(uid, None)
 
 
-def add_object(es, obj):
+def add_object(es, obj, idxs=None):
+    '''
+    `idxs` lists the indexes to update, all of them if empty
+    '''
+    indexer = get_rebuild_indexer(es)
+    if indexer is not None:
+        indexer.add(getUID(obj), obj)
+        return
     hook = getHook(es)
-    hook.index[getUID(obj)] = obj
+    uid = getUID(obj)
+    hook.index[uid] = obj
+    if not idxs:
+        hook.idxs[uid] = None
+    elif uid not in hook.idxs:
+        hook.idxs[uid] = set(idxs)
+    elif hook.idxs[uid] is not None:
+        hook.idxs[uid].update(idxs)
+
+
+def index_positions(obj, positions):
+    '''
+    `positions` maps ids of children of `obj` to their new position
+    '''
+    if not positions:
+        return
+    hook = getHook()
+    path = '/'.join(obj.getPhysicalPath())
+    hook.positions.setdefault(path, {}).update(positions)
 
 
-def index_positions(obj, ids):
-    hook = getHook()
-    if ISiteRoot.providedBy(obj):
-        hook.positions['/'] = ids
-    else:
-        hook.positions[getUID(obj)] = ids
+# catalog path -> RebuildIndexer for rebuilds running in this thread
+_rebuilding = threading.local()
+
+
+class RebuildIndexer(object):
+    '''
+    sends the index operations of a catalog rebuild straight to the
+    index being built instead of holding on to every object until the
+    transaction commits
+    '''
+
+    def __init__(self, es, index_name):
+        self.es = es
+        self.index_name = index_name
+        self.version = external_version()
+        self.pending = {}
+        self.errors = []
+
+    def add(self, uid, obj):
+        self.pending[uid] = obj
+        settings = self.es.settings
+        if len(self.pending) >= settings.bulk_size * max(settings.bulk_threads, 1):
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending = self.pending
+        self.pending = {}
+        errors = send_actions(self.es, get_index_actions(pending, self.es),
+                              index_name=self.index_name,
+                              version=self.version)
+        # changed or deleted by another transaction since the rebuild
+        # started, that change was sent to the index already
+        errors = [e for e in errors if e['status'] != 409]
+        log_errors(errors)
+        self.errors.extend(errors)
+
+
+def get_rebuild_indexer(es):
+    indexers = getattr(_rebuilding, 'indexers', None)
+    if indexers:
+        return indexers.get(es.catalogtool.getPhysicalPath())
+
+
+@contextmanager
+def rebuilding(es, index_name):
+    '''
+    index every object cataloged while the block runs into `index_name`
+    '''
+    if getattr(_rebuilding, 'indexers', None) is None:
+        _rebuilding.indexers = {}
+    key = es.catalogtool.getPhysicalPath()
+    indexer = RebuildIndexer(es, index_name)
+    _rebuilding.indexers[key] = indexer
+    try:
+        yield indexer
+        indexer.flush()
+    finally:
+        del _rebuilding.indexers[key]
+        resultcache.invalidate()
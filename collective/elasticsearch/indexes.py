@@ -81,12 +81,7 @@ class BaseIndex(object):
         elif type(value) in (list, tuple, set):
             if len(value) == 0:
                 return
-            queries = []
-            for val in value:
-                queries.append({'term': {name: val}})
-            return {
-                'or': queries
-            }
+            return {'terms': {name: list(value)}}
         else:
             return {'term': {name: value}}
 
@@ -144,12 +139,10 @@ class EDateIndex(BaseIndex):
             return {'range': {name: {'lte': first}}}
         elif range_ == 'min:max' and type(query) in (list, tuple) and \
                 len(query) == 2:
-            return {
-                'and': [
-                    {'range': {name: {'gte': first}}},
-                    {'range': {name: {'lte': _zdt(query[1]).ISO8601()}}}
-                ]
-            }
+            return {'range': {name: {
+                'gte': first,
+                'lte': _zdt(query[1]).ISO8601()
+            }}}
 
     def extract(self, name, data):
         try:
@@ -320,10 +313,13 @@ class EExtendedPathIndex(BaseIndex):
             if depth != -1:
                 filters.append(
                     {'range': {name + '.depth': {'lte': end}}})
-            andfilters.append({'and': filters})
+            andfilters.append({'bool': {'filter': filters}})
         if len(andfilters) > 1:
             return {
-                'or': andfilters
+                'bool': {
+                    'should': andfilters,
+                    'minimum_should_match': 1
+                }
             }
         else:
             return andfilters[0]
@@ -381,10 +377,12 @@ class EDateRangeIndex(BaseIndex):
         value = self._normalize_query(value)
         date = value.ISO8601()
         return {
-            'and': [
-                {'range': {'%s.%s1' % (name, name): {'lte': date}}},
-                {'range': {'%s.%s2' % (name, name): {'gte': date}}}
-            ]
+            'bool': {
+                'filter': [
+                    {'range': {'%s.%s1' % (name, name): {'lte': date}}},
+                    {'range': {'%s.%s2' % (name, name): {'gte': date}}}
+                ]
+            }
         }
 
 
@@ -411,7 +409,43 @@ except ImportError:
     pass
 
 
-def getIndex(catalog, name):
+class IndexPlan(object):
+    '''
+    index wrappers for every index of a catalog, built once instead of
+    looking the index up and wrapping it for every object and query
+    '''
+
+    def __init__(self, catalog):
+        self.names = tuple(catalog.indexes.keys())
+        items = []
+        missing = []
+        for name in self.names:
+            index = _wrapIndex(catalog, name)
+            if index is None:
+                missing.append(name)
+            else:
+                items.append((name, index))
+        # (name, index wrapper) pairs for supported indexes
+        self.items = tuple(items)
+        self.indexes = dict(items)
+        # indexes of a type we do not support
+        self.missing = tuple(missing)
+
+
+def get_index_plan(catalog):
+    '''
+    The plan is kept on the catalog as a volatile attribute so it follows
+    the catalog's connection and is dropped when another transaction
+    changes the catalog. It is rebuilt when indexes are added or removed.
+    '''
+    plan = getattr(catalog, '_v_elasticindexplan', None)
+    if plan is None or plan.names != tuple(catalog.indexes.keys()):
+        plan = IndexPlan(catalog)
+        catalog._v_elasticindexplan = plan
+    return plan
+
+
+def _wrapIndex(catalog, name):
     try:
         index = aq_base(catalog.getIndex(name))
     except KeyError:
@@ -419,3 +453,7 @@ def getIndex(catalog, name):
     index_type = type(index)
     if index_type in INDEX_MAPPING:
         return INDEX_MAPPING[index_type](catalog, index)
+
+
+def getIndex(catalog, name):
+    return get_index_plan(catalog).indexes.get(name)
@@ -0,0 +1,223 @@
+from collections import OrderedDict
+from collective.elasticsearch import fingerprint
+from collective.elasticsearch.bulk import _chunk_actions
+from collective.elasticsearch.bulk import _retryable
+from collective.elasticsearch.bulk import _retryable_status
+from collective.elasticsearch.bulk import _send_chunk_retrying
+from collective.elasticsearch.bulk import backoff
+from collective.elasticsearch.bulk import dead_letter
+from collective.elasticsearch.bulk import log_errors
+from elasticsearch.exceptions import TransportError
+
+import atexit
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger('collective.elasticsearch')
+
+
+class IndexQueue(object):
+    '''
+    Process wide queue of index operations, sent by a worker thread.
+
+    Operations are coalesced by document: the last write wins, a delete
+    replaces an earlier index and partial updates are merged into the
+    pending operation. The queue is flushed once it holds `flush_size`
+    operations or its oldest one is `flush_interval` seconds old. Adding
+    to a queue that holds `max_size` operations blocks until the worker
+    made room.
+
+    Items elastic search rejects because it is overloaded or failing are
+    sent again up to `retries` times and recorded with `dead_letter` if
+    they keep failing. Operations not sent because elastic search could
+    not be reached are queued again and sent after a capped exponential
+    backoff.
+    '''
+
+    def __init__(self, conn, flush_size=500, flush_interval=1.0,
+                 max_size=10000, bulk_size=50,
+                 bulk_max_bytes=10 * 1024 * 1024, retries=3,
+                 backoff_max=30.0):
+        self.conn = conn
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.bulk_size = bulk_size
+        self.bulk_max_bytes = bulk_max_bytes
+        self.retries = retries
+        self.backoff_max = backoff_max
+        self.failures = 0
+        # (index name, doc type, uid) -> [op_type, source]
+        self.pending = OrderedDict()
+        self.oldest = None
+        self.condition = threading.Condition()
+        self.worker = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def _merge(self, key, op_type, source):
+        current = self.pending.get(key)
+        if current is None or op_type != 'update':
+            self.pending[key] = [op_type, source]
+        elif current[0] == 'index':
+            current[1].update(source['doc'])
+        elif current[0] == 'update':
+            current[1]['doc'].update(source['doc'])
+        # an update does not resurrect a deleted document
+
+    def put(self, index_name, doc_type, op_type, uid, source):
+        with self.condition:
+            key = (index_name, doc_type, uid)
+            while len(self.pending) >= self.max_size and \
+                    key not in self.pending:
+                # backpressure, wait for the worker to make room
+                self._ensure_worker()
+                self.condition.notify_all()
+                self.condition.wait(self.flush_interval)
+            self._merge(key, op_type, source)
+            if self.oldest is None:
+                self.oldest = time.time()
+            self._ensure_worker()
+            if len(self.pending) >= self.flush_size:
+                self.condition.notify_all()
+
+    def _ensure_worker(self):
+        if self.worker is None or not self.worker.is_alive():
+            self.worker = threading.Thread(target=self._run,
+                                           name='elasticsearch-index-queue')
+            self.worker.daemon = True
+            self.worker.start()
+
+    def _take(self):
+        pending = self.pending
+        self.pending = OrderedDict()
+        self.oldest = None
+        return pending
+
+    def _requeue(self, pending):
+        '''
+        put operations that could not be sent back in front of the ones
+        queued since, which are merged into them like any later operation
+        '''
+        queued = self.pending
+        self.pending = pending
+        for key, (op_type, source) in queued.items():
+            self._merge(key, op_type, source)
+        self.oldest = time.time()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self._due():
+                    self.condition.wait(self.flush_interval)
+                pending = self._take()
+            try:
+                self.send(pending)
+            except Exception:
+                delay = backoff(self.failures, self.backoff_max)
+                self.failures += 1
+                logger.warn('Error sending index queue, retrying in %.1fs'
+                            % delay, exc_info=True)
+                with self.condition:
+                    self._requeue(pending)
+                time.sleep(delay)
+            else:
+                self.failures = 0
+            with self.condition:
+                # wake up writers waiting for room
+                self.condition.notify_all()
+
+    def _due(self):
+        if not self.pending:
+            return False
+        if len(self.pending) >= self.flush_size:
+            return True
+        return time.time() - self.oldest >= self.flush_interval
+
+    def send(self, pending):
+        '''
+        Send the `pending` operations, removing them once elastic search
+        accepted or refused them. The items of a request that keeps
+        failing are recorded with `dead_letter` by `_send_chunk_retrying`,
+        the operations not sent after it are left to be queued again.
+        '''
+        grouped = OrderedDict()
+        for (index_name, doc_type, uid), (op_type, source) in pending.items():
+            grouped.setdefault((index_name, doc_type), []).append(
+                (op_type, uid, source))
+        for (index_name, doc_type), actions in grouped.items():
+            errors = []
+            fingerprints = {}
+            try:
+                for chunk, lines in _chunk_actions(
+                        fingerprint.collect(actions, fingerprints),
+                        self.conn.transport.serializer, index_name,
+                        doc_type, self.bulk_size, self.bulk_max_bytes):
+                    try:
+                        result = _send_chunk_retrying(
+                            self.conn, index_name, doc_type, chunk, lines,
+                            self.retries + 1, self.backoff_max)
+                    except Exception as ex:
+                        for op_type, uid in chunk:
+                            del pending[(index_name, doc_type, uid)]
+                        if isinstance(ex, TransportError) and \
+                                not _retryable(ex):
+                            # refused for good, go on with the others
+                            continue
+                        raise
+                    for op_type, uid in chunk:
+                        del pending[(index_name, doc_type, uid)]
+                    fingerprint.remember(index_name, chunk, result,
+                                         fingerprints)
+                    errors.extend(result)
+            finally:
+                log_errors(errors)
+                dead_letter(index_name, [e for e in errors
+                                         if _retryable_status(e['status'])])
+
+    def flush(self):
+        '''
+        send everything pending from the calling thread
+        '''
+        with self.condition:
+            pending = self._take()
+        try:
+            self.send(pending)
+        except Exception:
+            with self.condition:
+                self._requeue(pending)
+            raise
+
+
+# connection -> IndexQueue
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_queue(es):
+    conn = es.connection
+    settings = es.settings
+    with _queues_lock:
+        queue = _queues.get(conn)
+        if queue is None:
+            queue = _queues[conn] = IndexQueue(conn)
+    queue.flush_size = settings.queue_flush_size
+    queue.flush_interval = settings.queue_flush_interval
+    queue.max_size = settings.queue_max_size
+    queue.bulk_size = settings.bulk_size
+    queue.bulk_max_bytes = settings.bulk_max_bytes
+    queue.retries = settings.bulk_retries
+    queue.backoff_max = settings.bulk_backoff_max
+    return queue
+
+
+@atexit.register
+def flush_queues():
+    for queue in _queues.values():
+        try:
+            queue.flush()
+        except Exception:
+            logger.warn('Could not flush index queue', exc_info=True)
@@ -28,6 +28,21 @@ class IQueryAssembler(Interface):
         pass
 
 
+class ITimingSink(Interface):
+    def __call__(settings, timings):
+        '''
+        report `timings`, a mapping of phase name to the summed up
+        count, seconds and sizes recorded for it
+        '''
+
+
+class ISearchRouter(Interface):
+    def __call__(query):
+        '''
+        return True if the query should be run on elastic search
+        '''
+
+
 class IElasticSettings(Interface):
 
     hosts = schema.List(
@@ -57,6 +72,18 @@ class IElasticSettings(Interface):
         title=u'Retry on timeout',
         default=True)
 
+    pool_maxsize = schema.Int(
+        title=u'Connection pool size',
+        description=u'Number of connections kept open to each host. '
+                    u'The client is shared by all threads of the process '
+                    u'so this should be at least the number of threads.',
+        default=10)
+
+    keep_alive = schema.Bool(
+        title=u'Keep alive',
+        description=u'Reuse connections to elastic search between requests',
+        default=True)
+
     timeout = schema.Float(
         title=u'Read timeout',
         description=u'how long before timeout connecting to elastic search',
@@ -74,3 +101,199 @@ class IElasticSettings(Interface):
         title=u'Bulk Size',
         description=u'bulk size for elastic queries',
         default=50)
+
+    routing_mode = schema.Choice(
+        title=u'Query routing',
+        description=u'Which catalog queries are run on elastic search. '
+                    u'"text": only full text queries, '
+                    u'"indexes": also queries on the routed indexes or sort keys, '
+                    u'"all": every query.',
+        values=(u'text', u'indexes', u'all'),
+        default=u'text')
+
+    routing_indexes = schema.List(
+        title=u'Routed indexes',
+        description=u'Queries using any of these indexes are run on '
+                    u'elastic search when routing is "indexes"',
+        default=[],
+        value_type=schema.TextLine(title=u'Index'))
+
+    routing_sort_keys = schema.List(
+        title=u'Routed sort keys',
+        description=u'Queries sorting on any of these indexes are run on '
+                    u'elastic search when routing is "indexes"',
+        default=[],
+        value_type=schema.TextLine(title=u'Index'))
+
+    bulk_threads = schema.Int(
+        title=u'Bulk threads',
+        description=u'Number of concurrent bulk requests used '
+                    u'to send indexing operations',
+        default=1)
+
+    bulk_max_bytes = schema.Int(
+        title=u'Bulk max bytes',
+        description=u'Maximum size of a single bulk request in bytes',
+        default=10 * 1024 * 1024)
+
+    bulk_retries = schema.Int(
+        title=u'Bulk retries',
+        description=u'Number of times items elastic search rejects because '
+                    u'it is overloaded or failing(408, 429, 5xx) are sent '
+                    u'again. Items that keep failing, or could not be sent '
+                    u'because the bulk request kept failing, are logged to '
+                    u'the collective.elasticsearch.deadletter logger.',
+        default=3)
+
+    bulk_backoff_max = schema.Float(
+        title=u'Bulk backoff max',
+        description=u'Maximum number of seconds to wait before retrying.',
+        default=30.0)
+
+    skip_unchanged = schema.Bool(
+        title=u'Skip unchanged documents',
+        description=u'Store a fingerprint of the indexed data and do not '
+                    u'send documents whose data did not change.',
+        default=False)
+
+    fingerprint_cache_size = schema.Int(
+        title=u'Fingerprint cache size',
+        description=u'Number of document fingerprints kept in memory. '
+                    u'The cache does not see changes sent by other ZEO '
+                    u'clients, with more than one client turn on checking '
+                    u'fingerprints in elastic search.',
+        default=10000)
+
+    fingerprint_check_elastic = schema.Bool(
+        title=u'Check fingerprints in elastic search',
+        description=u'Compare with the fingerprint stored in elastic search '
+                    u'instead of trusting the local cache, needed when '
+                    u'several ZEO clients index the same documents. '
+                    u'Costs one request per bulk chunk.',
+        default=False)
+
+    zero_downtime_rebuild = schema.Bool(
+        title=u'Zero downtime rebuild',
+        description=u'Rebuild into a new index version while searches keep '
+                    u'using the current one and swap the index alias once '
+                    u'the rebuild is done.',
+        default=False)
+
+    cursor_pagination = schema.Bool(
+        title=u'Cursor pagination',
+        description=u'Page through results sequentially with search_after '
+                    u'and iterate over full result sets with the scroll api '
+                    u'so deep pages are as cheap as the first one.',
+        default=False)
+
+    native_brains = schema.Bool(
+        title=u'Elastic search brains',
+        description=u'Store catalog metadata in elastic search and build '
+                    u'result brains from it instead of looking them up '
+                    u'in the catalog. Rebuild the catalog after enabling.',
+        default=False)
+
+    prefetch_pages = schema.Int(
+        title=u'Prefetch pages',
+        description=u'Number of pages to read ahead, in the same request, '
+                    u'when results are accessed sequentially.',
+        default=1)
+
+    result_cache = schema.Bool(
+        title=u'Request result cache',
+        description=u'Reuse the results of identical searches run in the '
+                    u'same request.',
+        default=True)
+
+    result_cache_size = schema.Int(
+        title=u'Process result cache size',
+        description=u'Number of searches whose results are shared by all '
+                    u'requests of the process. 0 disables the cache.',
+        default=0)
+
+    result_cache_ttl = schema.Float(
+        title=u'Process result cache TTL',
+        description=u'Seconds results stay in the process cache. Changes '
+                    u'committed by other instances are only seen once they '
+                    u'expired.',
+        default=60.0)
+
+    index_queue = schema.Bool(
+        title=u'Index queue',
+        description=u'Send index operations from a background thread. '
+                    u'Operations on the same document are coalesced across '
+                    u'transactions so only the last one is sent.',
+        default=False)
+
+    queue_flush_size = schema.Int(
+        title=u'Queue flush size',
+        description=u'Number of queued operations that triggers a flush.',
+        default=500)
+
+    queue_flush_interval = schema.Float(
+        title=u'Queue flush interval',
+        description=u'Maximum number of seconds an operation waits in the '
+                    u'queue.',
+        default=1.0)
+
+    celery_batch_size = schema.Int(
+        title=u'Celery batch size',
+        description=u'Group the operations of several transactions into '
+                    u'celery tasks of this many documents. 0 schedules one '
+                    u'task per transaction.',
+        default=0)
+
+    celery_batch_window = schema.Float(
+        title=u'Celery batch window',
+        description=u'Maximum number of seconds operations wait for a '
+                    u'batch to fill up before their task is scheduled.',
+        default=1.0)
+
+    queue_max_size = schema.Int(
+        title=u'Queue max size',
+        description=u'Number of queued operations after which committing '
+                    u'transactions wait for the queue to be sent.',
+        default=10000)
+
+    timing = schema.Bool(
+        title=u'Timing',
+        description=u'Record how long searches, result pages, brains, '
+                    u'index data and bulk requests take and report it to '
+                    u'the timing sinks. In debug mode responses get an '
+                    u'X-ES-Timing header.',
+        default=False)
+
+    timing_sinks = schema.List(
+        title=u'Timing sinks',
+        description=u'Names of the ITimingSink utilities timings are '
+                    u'reported to, `log` and `statsd` are provided.',
+        default=[u'log'],
+        value_type=schema.TextLine(title=u'Sink'))
+
+    statsd_address = schema.TextLine(
+        title=u'Statsd address',
+        description=u'host:port the statsd sink sends to.',
+        default=u'localhost:8125')
+
+    statsd_prefix = schema.TextLine(
+        title=u'Statsd prefix',
+        default=u'collective.elasticsearch')
+
+    slow_query_threshold = schema.Float(
+        title=u'Slow query threshold',
+        description=u'Searches taking longer than this many seconds are '
+                    u'logged with their query and shown in the control '
+                    u'panel. 0 disables the slow query log.',
+        default=0.0)
+
+    slow_query_log_size = schema.Int(
+        title=u'Slow query log size',
+        description=u'Number of slow searches kept per instance.',
+        default=50)
+
+    slow_query_profile_rate = schema.Float(
+        title=u'Slow query profile rate',
+        description=u'Fraction, between 0 and 1, of slow searches run '
+                    u'again with profiling to record where elastic search '
+                    u'spent the time per shard.',
+        default=0.0)
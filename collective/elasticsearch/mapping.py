@@ -1,5 +1,7 @@
 from zope.interface import implements
-from collective.elasticsearch.indexes import getIndex
+from collective.elasticsearch.brain import METADATA_FIELD
+from collective.elasticsearch.fingerprint import FINGERPRINT_FIELD
+from collective.elasticsearch.indexes import get_index_plan
 from collective.elasticsearch.interfaces import IMappingProvider
 
 
@@ -9,7 +11,10 @@ class MappingAdapter(object):
     _default_mapping = {
         'SearchableText': {'store': False, 'type': 'string', 'index': 'analyzed'},
         'Title': {'store': False, 'type': 'string', 'index': 'analyzed'},
-        'Description': {'store': False, 'type': 'string', 'index': 'analyzed'}
+        'Description': {'store': False, 'type': 'string', 'index': 'analyzed'},
+        # only kept in _source to build brains from
+        METADATA_FIELD: {'type': 'object', 'enabled': False},
+        FINGERPRINT_FIELD: {'type': 'string', 'index': 'no', 'store': False}
     }
 
     def __init__(self, request, es):
@@ -19,13 +24,12 @@ class MappingAdapter(object):
 
     def __call__(self):
         properties = self._default_mapping.copy()
-        for name in self.catalog.indexes.keys():
-            index = getIndex(self.catalog, name)
-            if index is not None:
-                properties[name] = index.create_mapping(name)
-            else:
-                raise Exception('Can not locate index for %s' % (
-                    name))
+        plan = get_index_plan(self.catalog)
+        if plan.missing:
+            raise Exception('Can not locate index for %s' % (
+                plan.missing[0]))
+        for name, index in plan.items:
+            properties[name] = index.create_mapping(name)
 
         conn = self.es.connection
         index_name = self.es.index_name
@@ -0,0 +1,247 @@
+from App.config import getConfiguration
+from collective.elasticsearch import fingerprint
+from collective.elasticsearch.bulk import _chunk_actions
+from collective.elasticsearch.bulk import _chunk_errors
+from collective.elasticsearch.bulk import _retryable
+from collective.elasticsearch.bulk import _retryable_status
+from collective.elasticsearch.bulk import _send_chunk
+from collective.elasticsearch.bulk import dead_letter
+from collective.elasticsearch.bulk import log_errors
+from elasticsearch.exceptions import TransportError
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+
+logger = logging.getLogger('collective.elasticsearch')
+
+# the outbox file is configured per instance, with this environment
+# variable or an `outbox_path` key in the product-config section of
+# zope.conf
+ENVIRON_KEY = 'COLLECTIVE_ELASTICSEARCH_OUTBOX'
+PRODUCT_CONFIG = 'collective.elasticsearch'
+
+# seconds to wait before draining again after elastic search failed,
+# doubled for every consecutive failure
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 300.0
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outbox (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    index_name TEXT NOT NULL,
+    doc_type TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    op_type TEXT NOT NULL,
+    source TEXT,
+    UNIQUE (index_name, doc_type, uid)
+)
+'''
+
+
+class Outbox(object):
+    '''
+    Durable log of the index operations of committed transactions.
+
+    Operations are stored in a SQLite file, one row per document, and
+    drained by a background thread so elastic search being slow or down
+    does not lose them. Rows are only removed once elastic search accepted
+    them, giving at-least-once delivery.
+    '''
+
+    def __init__(self, path, conn, bulk_size=50,
+                 bulk_max_bytes=10 * 1024 * 1024):
+        self.path = path
+        self.conn = conn
+        self.bulk_size = bulk_size
+        self.bulk_max_bytes = bulk_max_bytes
+        self.failures = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.worker = None
+        db = self._db()
+        try:
+            db.execute(SCHEMA)
+        finally:
+            db.close()
+
+    def _db(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.text_factory = str
+        return db
+
+    def __len__(self):
+        db = self._db()
+        try:
+            return db.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+        finally:
+            db.close()
+
+    def add(self, actions):
+        '''
+        store (index name, doc type, op_type, uid, source) actions,
+        replacing or merging into pending operations of the same document
+        '''
+        dumps = self.conn.transport.serializer.dumps
+        with self.lock:
+            db = self._db()
+            try:
+                with db:
+                    for index_name, doc_type, op_type, uid, source in actions:
+                        key = (index_name, doc_type, uid)
+                        if op_type == 'update':
+                            row = db.execute(
+                                'SELECT op_type, source FROM outbox WHERE '
+                                'index_name=? AND doc_type=? AND uid=?',
+                                key).fetchone()
+                            if row is not None:
+                                if row[0] == 'delete':
+                                    # does not resurrect a deleted document
+                                    continue
+                                current = json.loads(row[1])
+                                if row[0] == 'index':
+                                    current.update(source['doc'])
+                                else:
+                                    current['doc'].update(source['doc'])
+                                op_type = row[0]
+                                source = current
+                        if source is not None:
+                            source = dumps(source)
+                        # replacing moves the document to the end of the log
+                        db.execute(
+                            'INSERT OR REPLACE INTO outbox (index_name, '
+                            'doc_type, uid, op_type, source) '
+                            'VALUES (?, ?, ?, ?, ?)',
+                            key + (op_type, source))
+            finally:
+                db.close()
+        self._ensure_worker()
+        self.wakeup.set()
+
+    def _ensure_worker(self):
+        if self.worker is None or not self.worker.is_alive():
+            self.worker = threading.Thread(target=self._run,
+                                           name='elasticsearch-outbox')
+            self.worker.daemon = True
+            self.worker.start()
+
+    def _run(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                self.drain()
+            except Exception:
+                self.failures += 1
+                delay = min(BACKOFF_BASE * 2 ** (self.failures - 1),
+                            BACKOFF_MAX)
+                logger.warn('Error draining outbox, retrying in %.1fs' % delay,
+                            exc_info=True)
+                # new operations do not cut the backoff short
+                threading.Event().wait(delay)
+                continue
+            self.failures = 0
+            self.wakeup.wait()
+
+    def _pending(self, db):
+        return db.execute(
+            'SELECT seq, index_name, doc_type, uid, op_type, source '
+            'FROM outbox ORDER BY seq LIMIT ?',
+            (self.bulk_size * 10,)).fetchall()
+
+    def drain(self):
+        '''
+        send stored operations until the outbox is empty, raises when
+        elastic search could not be reached
+        '''
+        db = self._db()
+        try:
+            while True:
+                rows = self._pending(db)
+                if not rows:
+                    return
+                retry = self._send(rows)
+                done = [(row[0],) for row in rows if row[3] not in retry]
+                with db:
+                    # rows replaced while sending have a new seq and stay
+                    db.executemany('DELETE FROM outbox WHERE seq=?', done)
+                if retry:
+                    raise IOError('%i operations rejected by elastic search'
+                                  % len(retry))
+        finally:
+            db.close()
+
+    def _send(self, rows):
+        '''
+        Returns uids elastic search asked to send again. Operations it
+        refuses for good with a client error, like malformed or too large
+        requests, are recorded with `dead_letter` instead. Any other error
+        is raised so the operations are sent again.
+        '''
+        grouped = {}
+        for seq, index_name, doc_type, uid, op_type, source in rows:
+            if source is not None:
+                source = json.loads(source)
+            grouped.setdefault((index_name, doc_type), []).append(
+                (op_type, uid, source))
+        retry = set()
+        for (index_name, doc_type), actions in grouped.items():
+            errors = []
+            fingerprints = {}
+            for chunk, lines in _chunk_actions(
+                    fingerprint.collect(actions, fingerprints),
+                    self.conn.transport.serializer, index_name,
+                    doc_type, self.bulk_size, self.bulk_max_bytes):
+                try:
+                    result = _send_chunk(self.conn, index_name, doc_type,
+                                         chunk, lines)
+                except TransportError as ex:
+                    if _retryable(ex):
+                        raise
+                    # sending them again fails the same way forever
+                    logger.error('Error sending outbox operations',
+                                 exc_info=True)
+                    dead_letter(index_name, _chunk_errors(chunk, ex))
+                    continue
+                fingerprint.remember(index_name, chunk, result, fingerprints)
+                errors.extend(result)
+            failed = [e for e in errors
+                      if not _retryable_status(e['status'])]
+            log_errors(failed)
+            dead_letter(index_name, failed)
+            retry.update([e['uid'] for e in errors
+                          if _retryable_status(e['status'])])
+        return retry
+
+
+# path -> Outbox
+_outboxes = {}
+_outboxes_lock = threading.Lock()
+
+
+def get_outbox_path():
+    '''
+    the outbox file of this instance, empty when operations are sent
+    directly. Every ZEO client needs a file of its own.
+    '''
+    path = os.environ.get(ENVIRON_KEY)
+    if path:
+        return path
+    config = getattr(getConfiguration(), 'product_config', None) or {}
+    return config.get(PRODUCT_CONFIG, {}).get('outbox_path', '')
+
+
+def get_outbox(es):
+    path = get_outbox_path()
+    with _outboxes_lock:
+        outbox = _outboxes.get(path)
+        if outbox is None:
+            outbox = _outboxes[path] = Outbox(path, es.connection)
+            # operations left over by a previous run
+            outbox._ensure_worker()
+    outbox.conn = es.connection
+    outbox.bulk_size = es.settings.bulk_size
+    outbox.bulk_max_bytes = es.settings.bulk_max_bytes
+    return outbox
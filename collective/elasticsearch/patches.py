@@ -51,24 +51,25 @@ def unindexObject(self, ob):
 
 def moveObjectsByDelta(self, ids, delta, subset_ids=None,
                        suppress_events=False):
+    es = ElasticSearchCatalog(api.portal.get_tool('portal_catalog'))
+    if es.enabled:
+        before = list(self.idsInOrder())
     res = self._old_moveObjectsByDelta(ids, delta, subset_ids=subset_ids,
                                        suppress_events=suppress_events)
-    es = ElasticSearchCatalog(api.portal.get_tool('portal_catalog'))
     if es.enabled:
-        if subset_ids is None:
-            subset_ids = self.idsInOrder()
-        hook.index_positions(self.context, subset_ids)
+        hook.index_positions(
+            self.context, hook.changed_positions(before, self.idsInOrder()))
     return res
 
 
 def PloneSite_moveObjectsByDelta(self, ids, delta, subset_ids=None,
                                  suppress_events=False):
+    es = ElasticSearchCatalog(api.portal.get_tool('portal_catalog'))
+    if es.enabled:
+        before = list(self.objectIds())
     res = self._old_moveObjectsByDelta(ids, delta, subset_ids=subset_ids,
                                        suppress_events=suppress_events)
-    es = ElasticSearchCatalog(api.portal.get_tool('portal_catalog'))
     if es.enabled:
-        if subset_ids is None:
-            objects = list(self._objects)
-            subset_ids = self.getIdsSubset(objects)
-        hook.index_positions(self, subset_ids)
+        hook.index_positions(
+            self, hook.changed_positions(before, self.objectIds()))
     return res
@@ -1,6 +1,6 @@
 from collective.elasticsearch.interfaces import IQueryAssembler
 from zope.interface import implements
-from collective.elasticsearch.indexes import getIndex
+from collective.elasticsearch.indexes import get_index_plan
 from collective.elasticsearch.indexes import EZCTextIndex
 
 
@@ -36,35 +36,32 @@ class QueryAssembler(object):
 
     def __call__(self, dquery):
         filters = []
+        matches = []
         catalog = self.catalogtool._catalog
-        idxs = catalog.indexes.keys()
-        query = {'match_all': {}}
+        indexes = get_index_plan(catalog).indexes
         for key, value in dquery.items():
-            if key not in idxs and key not in ('SearchableText', 'Title', 'Description'):
-                continue
-
-            index = getIndex(catalog, key)
+            index = indexes.get(key)
             qq = None
             if index is None and key in ('SearchableText', 'Title', 'Description'):
                 # deleted index for plone performance but still need on ES
                 index = EZCTextIndex(catalog, key)
+            if index is None:
+                continue
 
             qq = index.get_query(key, value)
             if qq is None:
                 continue
 
-            if index is not None and index.filter_query:
+            if index.filter_query:
+                # filter context does not score and is cached by elastic
                 filters.append(qq)
             else:
-                query = qq
-        if len(filters) == 0:
-            return query
-        else:
-            return {
-                'filtered': {
-                    'filter': {
-                        'and': filters
-                    },
-                    'query': query
-                }
-            }
+                matches.append(qq)
+        if len(filters) == 0 and len(matches) == 0:
+            return {'match_all': {}}
+        query = {'bool': {}}
+        if matches:
+            query['bool']['must'] = matches
+        if filters:
+            query['bool']['filter'] = filters
+        return query
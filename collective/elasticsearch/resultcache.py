@@ -0,0 +1,134 @@
+from collections import OrderedDict
+from DateTime import DateTime
+from zope.annotation.interfaces import IAnnotations
+from zope.globalrequest import getRequest
+
+import json
+import threading
+import time
+
+
+REQUEST_KEY = 'collective.elasticsearch.results'
+# searches for what is effective now are rounded down to this many
+# seconds so they are not all different searches
+EFFECTIVE_ROUNDING = 60
+# seconds elastic search takes to make sent changes searchable, its
+# default refresh interval. Searches run this soon after an invalidation
+# may miss the changes and are not stored in the process cache.
+REFRESH_WINDOW = 1.0
+
+
+class ResultCache(object):
+    '''
+    thread safe LRU whose entries expire `ttl` seconds after they were set
+    '''
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                expires, value = self.data.pop(key)
+            except KeyError:
+                return None
+            if expires < time.time():
+                return None
+            self.data[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = (time.time() + self.ttl, value)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+cache = ResultCache(0, 0)
+
+# bumped whenever index operations are committed or sent so entries
+# cached before, including those of other requests, are not used anymore
+generation = 0
+invalidated = 0
+_generation_lock = threading.Lock()
+
+
+def invalidate():
+    global generation, invalidated
+    with _generation_lock:
+        generation += 1
+        invalidated = time.time()
+    cache.clear()
+
+
+def enabled(es):
+    settings = es.settings
+    return settings.result_cache or settings.result_cache_size > 0
+
+
+def round_effective(query):
+    '''
+    round the `effectiveRange` the catalog adds for users that can not
+    see inactive content down to EFFECTIVE_ROUNDING seconds
+    '''
+    value = query.get('effectiveRange')
+    if isinstance(value, DateTime):
+        seconds = value.timeTime()
+        query['effectiveRange'] = DateTime(
+            seconds - seconds % EFFECTIVE_ROUNDING)
+
+
+def make_key(es, body):
+    '''
+    The search body holds the query, sort and, for searches that check
+    permissions, the principals of the user.
+    '''
+    return (generation, es.index_name, es.settings.bulk_size,
+            json.dumps(body, sort_keys=True, default=str))
+
+
+def _request_cache(es):
+    if not es.settings.result_cache:
+        return None
+    request = getRequest()
+    if request is None:
+        return None
+    annotations = IAnnotations(request, None)
+    if annotations is None:
+        return None
+    return annotations.setdefault(REQUEST_KEY, {})
+
+
+def get(es, key):
+    '''
+    Return the (count, pages) cached for `key` by this request or,
+    if enabled, by the process
+    '''
+    results = _request_cache(es)
+    if results is not None and key in results:
+        return results[key]
+    settings = es.settings
+    cache.size = settings.result_cache_size
+    cache.ttl = settings.result_cache_ttl
+    value = cache.get(key)
+    if value is not None and results is not None:
+        results[key] = value
+    return value
+
+
+def store(es, key, value):
+    results = _request_cache(es)
+    if results is not None:
+        results[key] = value
+    if time.time() - invalidated >= REFRESH_WINDOW:
+        cache.set(key, value)
@@ -0,0 +1,65 @@
+from collective.elasticsearch.indexes import get_index_plan
+from collective.elasticsearch.interfaces import ISearchRouter
+from zope.interface import implements
+
+
+# query key integrators can use to force a query on(True)
+# or off(False) elastic search
+ROUTING_HINT = '_es'
+
+TEXT_INDEXES = ('SearchableText', 'Title', 'Description')
+
+
+class SearchRouter(object):
+    '''
+    decide if a catalog query is run on elastic search
+    or on the catalog, depending on the `routing_mode` setting:
+
+    text
+        only full text queries
+    indexes
+        full text queries and queries using any of the `routing_indexes`
+        or sorting on any of the `routing_sort_keys`
+    all
+        every query
+
+    Queries using or sorting on indexes of a type the query assembler can
+    not translate always run on the catalog.
+    '''
+    implements(ISearchRouter)
+
+    def __init__(self, request, es):
+        self.request = request
+        self.es = es
+
+    def __call__(self, query):
+        hint = query.get(ROUTING_HINT)
+        if hint is not None:
+            return bool(hint)
+
+        sort_on = query.get('sort_on')
+        if isinstance(sort_on, basestring):
+            sort_on = sort_on.split(',')
+        sort_on = sort_on or ()
+
+        missing = get_index_plan(self.es.catalog).missing
+        for name in missing:
+            if name in query or name in sort_on:
+                return False
+
+        settings = self.es.settings
+        if settings.routing_mode == 'all':
+            return True
+
+        for name in TEXT_INDEXES:
+            if name in query:
+                return True
+
+        if settings.routing_mode == 'indexes':
+            for name in settings.routing_indexes:
+                if name in query:
+                    return True
+            for name in sort_on:
+                if name in settings.routing_sort_keys:
+                    return True
+        return False
@@ -0,0 +1,79 @@
+from collections import namedtuple
+
+from collective.elasticsearch.interfaces import IElasticSettings
+from plone.registry.interfaces import IRegistry
+from zope.component import queryUtility
+from zope.schema import getFieldNamesInOrder
+
+import transaction
+import weakref
+
+
+PREFIX = IElasticSettings.__identifier__
+# persistent counter on the registry bumped whenever our records change,
+# ZODB invalidation makes every client see the new value
+SERIAL_ATTR = '_elasticsettingsserial'
+
+# catalog path -> (serial, ElasticSettings)
+_cache = {}
+# transactions that changed our records. Their snapshots hold values that
+# may still be aborted, so they are not cached.
+_changing = weakref.WeakKeyDictionary()
+
+
+class ElasticSettings(namedtuple('ElasticSettings',
+                                 getFieldNamesInOrder(IElasticSettings))):
+    '''
+    Immutable snapshot of the IElasticSettings registry records so reading
+    a setting on the hot path is a plain attribute lookup.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def from_registry(cls, registry):
+        values = {}
+        for name in cls._fields:
+            value = None
+            if registry is not None:
+                value = registry.get('%s.%s' % (PREFIX, name), None)
+            if value is None:
+                # record not registered yet(profile not re-applied)
+                value = IElasticSettings[name].default
+            if isinstance(value, list):
+                value = tuple(value)
+            values[name] = value
+        return cls(**values)
+
+
+def get_settings(catalogtool):
+    '''
+    Return the settings snapshot for the site the catalog belongs to. The
+    snapshot is rebuilt once the registry serial changed, which happens
+    when the records are changed by this or any other client.
+    '''
+    registry = queryUtility(IRegistry)
+    serial = getattr(registry, SERIAL_ATTR, None)
+    key = catalogtool.getPhysicalPath()
+    cached = _cache.get(key)
+    if cached is not None and cached[0] == serial:
+        return cached[1]
+    settings = ElasticSettings.from_registry(registry)
+    if transaction.get() not in _changing:
+        _cache[key] = (serial, settings)
+    return settings
+
+
+def on_record_event(event):
+    '''
+    Bump the registry serial when any of our registry records change so
+    every client rebuilds its snapshot once the change is committed. An
+    abort rolls the serial back along with the values.
+    '''
+    record = getattr(event, 'record', None)
+    name = getattr(record, '__name__', None) or ''
+    if not name.startswith(PREFIX + '.'):
+        return
+    _changing[transaction.get()] = True
+    registry = queryUtility(IRegistry)
+    if registry is not None:
+        setattr(registry, SERIAL_ATTR, getattr(registry, SERIAL_ATTR, 0) + 1)
@@ -0,0 +1,125 @@
+from collections import deque
+
+import json
+import logging
+import random
+import threading
+import time
+
+
+logger = logging.getLogger('collective.elasticsearch.slowlog')
+
+
+class SlowQueryLog(object):
+    '''
+    thread safe ring buffer of the last slow searches of this process
+    '''
+
+    def __init__(self, size):
+        self.entries = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def resize(self, size):
+        if size == self.entries.maxlen:
+            return
+        with self.lock:
+            self.entries = deque(self.entries, maxlen=max(size, 0))
+
+    def add(self, entry):
+        with self.lock:
+            self.entries.append(entry)
+
+    def get(self):
+        '''
+        entries, newest first
+        '''
+        with self.lock:
+            return list(reversed(self.entries))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+log = SlowQueryLog(50)
+
+
+def record(es, kind, query, sort, body, response, seconds):
+    '''
+    Log a search that took longer than `slow_query_threshold` seconds and
+    keep it in the ring buffer shown in the control panel. A sample of
+    them is run again with profiling in the background.
+    '''
+    settings = es.settings
+    threshold = settings.slow_query_threshold
+    if not threshold or seconds < threshold:
+        return
+    entry = {
+        'time': time.time(),
+        'index': es.index_name,
+        'kind': kind,
+        'query': repr(query),
+        'sort': sort,
+        'body': json.dumps(body, sort_keys=True, default=str),
+        'took': response.get('took'),
+        'seconds': seconds,
+        'hits': response['hits']['total'],
+        'profile': None
+    }
+    logger.warn(json.dumps(entry, sort_keys=True))
+    log.resize(settings.slow_query_log_size)
+    log.add(entry)
+    if random.random() < settings.slow_query_profile_rate:
+        thread = threading.Thread(target=profile, args=(
+            es.connection, es.index_name, es.doc_type, body, entry))
+        thread.daemon = True
+        thread.start()
+
+
+def profile(conn, index_name, doc_type, body, entry):
+    '''
+    run the search of `entry` again with profiling and store the time
+    spent per shard
+    '''
+    body = dict(body, profile=True)
+    try:
+        result = conn.search(index=index_name, doc_type=doc_type, body=body)
+    except Exception:
+        logger.warn('Error profiling %s' % entry['body'], exc_info=True)
+        return
+    entry['profile'] = summarize_profile(result.get('profile', {}))
+
+
+def _nanos(node):
+    if 'time_in_nanos' in node:
+        return node['time_in_nanos']
+    # elastic search 2 reports a string with unit
+    value = node.get('time', '0ms')
+    return float(value.rstrip('ms') or 0) * 1e6
+
+
+def _node_lines(node, depth, lines):
+    lines.append('%s%s %s: %.3fms' % (
+        '  ' * depth, node.get('type', node.get('name')),
+        node.get('description', node.get('reason', '')),
+        _nanos(node) / 1e6))
+    for child in node.get('children', []):
+        _node_lines(child, depth + 1, lines)
+
+
+def summarize_profile(profile):
+    '''
+    one line per query node, rewrite and collector with its time, per shard
+    '''
+    shards = []
+    for shard in profile.get('shards', []):
+        lines = []
+        for search in shard.get('searches', []):
+            for node in search.get('query', []):
+                _node_lines(node, 0, lines)
+            lines.append('rewrite: %.3fms' % (
+                search.get('rewrite_time', 0) / 1e6))
+            for node in search.get('collector', []):
+                _node_lines(node, 0, lines)
+        shards.append({'id': shard.get('id'), 'breakdown': lines})
+    return shards
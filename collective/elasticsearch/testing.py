@@ -1,4 +1,6 @@
 from Products.CMFCore.utils import getToolByName
+from collective.elasticsearch.fakeserver import FakeElasticServer
+from collective.elasticsearch.interfaces import IElasticSettings
 from plone.app.testing import FunctionalTesting
 from plone.app.testing import IntegrationTesting
 from plone.app.testing import PLONE_FIXTURE
@@ -8,7 +10,9 @@ from plone.app.testing import TEST_USER_NAME
 from plone.app.testing import TEST_USER_PASSWORD
 from plone.app.testing import applyProfile
 from plone.app.testing import setRoles
+from plone.registry.interfaces import IRegistry
 from plone.testing import z2
+from zope.component import getUtility
 from zope.configuration import xmlconfig
 
 
@@ -59,6 +63,27 @@ ElasticSearch_FUNCTIONAL_TESTING = FunctionalTesting(
     bases=(ElasticSearch_FIXTURE,), name='ElasticSearch:Functional')
 
 
+class FakeElasticSearch(PloneSandboxLayer):
+    '''
+    talk to an in-process fake server instead of elastic search
+    '''
+    defaultBases = (ElasticSearch_FIXTURE, )
+
+    def setUpPloneSite(self, portal):
+        self['elasticserver'] = server = FakeElasticServer().start()
+        settings = getUtility(IRegistry).forInterface(IElasticSettings)
+        settings.hosts = [unicode(server.url)]
+
+    def tearDownPloneSite(self, portal):
+        self['elasticserver'].stop()
+        del self['elasticserver']
+
+
+FakeElasticSearch_FIXTURE = FakeElasticSearch()
+FakeElasticSearch_FUNCTIONAL_TESTING = FunctionalTesting(
+    bases=(FakeElasticSearch_FIXTURE,), name='FakeElasticSearch:Functional')
+
+
 def browserLogin(portal, browser, username=None, password=None):
     handleErrors = browser.handleErrors
     try:
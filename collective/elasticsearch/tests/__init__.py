@@ -45,11 +45,13 @@ class BaseTest(unittest.TestCase):
         _hook = hook.getHook(self.es)
         _hook.remove = []
         _hook.index = {}
+        _hook.idxs = {}
 
     def tearDown(self):
         super(BaseTest, self).tearDown()
         self.es.connection.indices.delete(index=self.es.index_name)
         self.clearTransactionEntries()
+        hook._rebuild_indexes.clear()
 
 
 class BaseFunctionalTest(BaseTest):
@@ -0,0 +1,128 @@
+'''
+Helpers to time the pure python hot paths, used by test_microbench.
+
+Every case reports the best time per operation over several rounds and
+the number of memory blocks allocated per operation, as counted by
+`tracemalloc`. Python 2 does not have it, there the allocations are
+approximated by the container objects the garbage collector counts as
+allocated and not freed per operation. Set MICROBENCH_SAVE to a file name
+to save the results as a baseline and MICROBENCH_COMPARE to a saved
+baseline to print the change.
+'''
+import gc
+import json
+import os
+import sys
+import time
+
+try:
+    import tracemalloc
+    ALLOCS_LABEL = 'allocs/op'
+except ImportError:
+    tracemalloc = None
+    ALLOCS_LABEL = 'gc objs/op'
+
+
+def _loops(func, min_time):
+    '''
+    number of calls that take at least `min_time` seconds
+    '''
+    loops = 1
+    while True:
+        started = time.time()
+        for _ in xrange(loops):
+            func()
+        if time.time() - started >= min_time:
+            return loops
+        loops *= 2
+
+
+def _gc_allocations(func, loops):
+    '''
+    container objects allocated and not freed again per call
+    '''
+    func()
+    enabled = gc.isenabled()
+    # starts the count of the youngest generation at 0
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in xrange(loops):
+            func()
+        count = gc.get_count()[0]
+    finally:
+        if enabled:
+            gc.enable()
+    return count / float(loops)
+
+
+def _allocations(func, loops):
+    '''
+    memory blocks allocated per call, freed or not
+    '''
+    if tracemalloc is None:
+        return _gc_allocations(func, loops)
+    func()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        for _ in xrange(loops):
+            func()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    return sum([max(stat.count_diff, 0) for stat in stats]) / float(loops)
+
+
+def measure(func, rounds=5, min_time=0.1):
+    loops = _loops(func, min_time)
+    best = None
+    for _ in range(rounds):
+        started = time.time()
+        for _ in xrange(loops):
+            func()
+        elapsed = (time.time() - started) / loops
+        if best is None or elapsed < best:
+            best = elapsed
+    return {
+        'ns_per_op': best * 1e9,
+        'allocs_per_op': _allocations(func, min(loops, 100))
+    }
+
+
+class Report(object):
+
+    def __init__(self):
+        self.results = {}
+
+    def add(self, name, func, **kwargs):
+        self.results[name] = result = measure(func, **kwargs)
+        return result
+
+    def format(self, baseline=None):
+        lines = ['%-40s %14s %12s' % ('case', 'ns/op', ALLOCS_LABEL)]
+        for name, result in sorted(self.results.items()):
+            allocs = result['allocs_per_op']
+            line = '%-40s %14.0f %12s' % (
+                name, result['ns_per_op'],
+                allocs is None and '-' or '%.1f' % allocs)
+            previous = (baseline or {}).get(name)
+            if previous:
+                line += ' %+7.1f%%' % (
+                    (result['ns_per_op'] - previous['ns_per_op']) * 100.0 /
+                    previous['ns_per_op'])
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def finish(self, out=sys.stdout):
+        baseline = None
+        path = os.environ.get('MICROBENCH_COMPARE')
+        if path:
+            with open(path) as fi:
+                baseline = json.load(fi)
+        out.write('\n' + self.format(baseline) + '\n')
+        path = os.environ.get('MICROBENCH_SAVE')
+        if path:
+            with open(path, 'w') as fi:
+                json.dump(self.results, fi, indent=2, sort_keys=True)
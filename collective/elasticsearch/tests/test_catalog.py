@@ -1,5 +1,30 @@
+from collective.elasticsearch import fingerprint
+from collective.elasticsearch import hook
+from collective.elasticsearch.bulk import deadletter
+from collective.elasticsearch.es import ElasticSearchCatalog
+from collective.elasticsearch.fingerprint import FINGERPRINT_FIELD
+from collective.elasticsearch.indexes import get_index_plan
+from collective.elasticsearch.indexqueue import get_queue
+from collective.elasticsearch.indexqueue import IndexQueue
+from collective.elasticsearch.outbox import ENVIRON_KEY
+from collective.elasticsearch.outbox import get_outbox
+from collective.elasticsearch.settings import SERIAL_ATTR
+from collective.elasticsearch.interfaces import IElasticSettings
 from collective.elasticsearch.tests import BaseFunctionalTest
+from collective.elasticsearch.tests import BaseTest
 from collective.elasticsearch.testing import createObject
+from elasticsearch.exceptions import ConnectionError
+from elasticsearch.exceptions import TransportError
+from plone.registry.interfaces import IRegistry
+from plone.uuid.interfaces import IUUID
+from zope.component import getUtility
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import transaction
 import unittest2 as unittest
 
 
@@ -17,5 +42,655 @@ class TestQueries(BaseFunctionalTest):
         self.assertEqual(current_length, len(self.catalog._catalog.uids))
 
 
+class TestBulkIndexing(BaseFunctionalTest):
+
+    def test_parallel_bulk(self):
+        settings = getUtility(IRegistry).forInterface(IElasticSettings)
+        settings.bulk_threads = 3
+        settings.bulk_size = 2
+        for idx in range(9):
+            createObject(self.portal, 'Document', 'page%i' % idx,
+                         title='Page %i' % idx)
+        self.commit()
+        self.es.connection.indices.flush()
+        self.assertEqual(len(self.catalog(Title='Page')), 9)
+
+    def test_rejected_items_retried(self):
+        settings = getUtility(IRegistry).forInterface(IElasticSettings)
+        settings.bulk_backoff_max = 0.01
+        bulk = self.es.connection.bulk
+        bodies = []
+
+        def rejecting(index, doc_type, body):
+            bodies.append(body)
+            result = bulk(index=index, doc_type=doc_type, body=body)
+            if len(bodies) == 1:
+                # pretend the second item was rejected
+                result['errors'] = True
+                result['items'][1]['index'].update({
+                    'status': 429, 'error': 'rejected'})
+            return result
+        self.es.connection.bulk = rejecting
+        try:
+            errors = hook.send_actions(self.es, [
+                ('index', 'foo', {'Title': 'Foo'}),
+                ('index', 'bar', {'Title': 'Bar'})])
+        finally:
+            self.es.connection.bulk = bulk
+        self.assertEqual(errors, [])
+        self.assertEqual(len(bodies), 2)
+        self.assertTrue('"bar"' in bodies[1])
+        self.assertFalse('"foo"' in bodies[1])
+
+    def test_failed_requests_dead_lettered(self):
+        settings = getUtility(IRegistry).forInterface(IElasticSettings)
+        settings.bulk_retries = 1
+        settings.bulk_backoff_max = 0.01
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        bulk = self.es.connection.bulk
+
+        def failing(index, doc_type, body):
+            raise ConnectionError('N/A', 'connection refused', None)
+        self.es.connection.bulk = failing
+        deadletter.addHandler(handler)
+        try:
+            self.assertRaises(ConnectionError, hook.send_actions, self.es, [
+                ('index', 'foo', {'Title': 'Foo'}),
+                ('delete', 'bar', None)])
+        finally:
+            self.es.connection.bulk = bulk
+            deadletter.removeHandler(handler)
+        self.assertEqual(
+            sorted([json.loads(r.getMessage())['uid'] for r in records]),
+            ['bar', 'foo'])
+
+    def test_errors_reported(self):
+        errors = hook.send_actions(self.es, [
+            ('update', 'missing-uid', {'doc': {'Title': 'foobar'}})])
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0]['uid'], 'missing-uid')
+        self.assertEqual(errors[0]['status'], 404)
+
+
+class TestPartialUpdates(BaseFunctionalTest):
+
+    def _get_doc(self, obj):
+        return self.es.connection.get(
+            index=self.es.index_name, doc_type=self.es.doc_type,
+            id=IUUID(obj))['_source']
+
+    def test_idxs_merged_per_uid(self):
+        page = createObject(self.portal, 'Document', 'page', title='Page')
+        self.commit()
+        hook.add_object(self.es, page, ['review_state'])
+        hook.add_object(self.es, page, ['allowedRolesAndUsers'])
+        _hook = hook.getHook(self.es)
+        self.assertEqual(sorted(_hook.partial[IUUID(page)]),
+                         ['allowedRolesAndUsers', 'review_state'])
+        hook.add_object(self.es, page)
+        self.assertEqual(_hook.partial, {})
+
+    def test_partial_update(self):
+        page = createObject(self.portal, 'Document', 'page', title='Page')
+        self.commit()
+        page.title = u'Changed'
+        self.catalog.catalog_object(page, idxs=['review_state'])
+        self.commit()
+        self.assertEqual(self._get_doc(page)['Title'], 'Page')
+        self.catalog.catalog_object(page)
+        self.commit()
+        self.assertEqual(self._get_doc(page)['Title'], 'Changed')
+
+    def test_partial_update_of_missing_document(self):
+        page = createObject(self.portal, 'Document', 'page', title='Page')
+        self.commit()
+        self.es.connection.delete(
+            index=self.es.index_name, doc_type=self.es.doc_type,
+            id=IUUID(page))
+        self.catalog.catalog_object(page, idxs=['review_state'])
+        self.commit()
+        self.assertEqual(self._get_doc(page)['Title'], 'Page')
+
+
+class TestSkipUnchanged(BaseFunctionalTest):
+
+    def test_unchanged_documents_skipped(self):
+        settings = getUtility(IRegistry).forInterface(IElasticSettings)
+        settings.skip_unchanged = True
+        page = createObject(self.portal, 'Document', 'page', title='Page')
+        self.commit()
+        doc = self.es.connection.get(
+            index=self.es.index_name, doc_type=self.es.doc_type,
+            id=IUUID(page))
+        self.assertTrue(FINGERPRINT_FIELD in doc['_source'])
+
+        skipped = fingerprint.cache.skipped
+        self.catalog.catalog_object(page)
+        self.commit()
+        self.assertEqual(fingerprint.cache.skipped, skipped + 1)
+        doc2 = self.es.connection.get(
+            index=self.es.index_name, doc_type=self.es.doc_type,
+            id=IUUID(page))
+        self.assertEqual(doc['_version'], doc2['_version'])
+
+        page.title = u'Changed'
+        self.catalog.catalog_object(page)
+        self.commit()
+        self.assertEqual(fingerprint.cache.skipped, skipped + 1)
+
+    def test_fingerprint_cached_once_accepted(self):
+        settings = getUtility(IRegistry).forInterface(IElasticSettings)
+        settings.skip_unchanged = True
+        key = (self.es.index_name, 'foo')
+        bulk = self.es.connection.bulk
+
+        def failing(index, doc_type, body):
+            return {'errors': True, 'items': [{'index': {
+                'status': 400, 'error': 'mapper_parsing_exception'}}]}
+        self.es.connection.bulk = failing
+        try:
+            errors = hook.send_actions(self.es, fingerprint.filter_unchanged(
+                self.es, [('index', 'foo', {'Title': 'Foo'})]))
+        finally:
+            self.es.connection.bulk = bulk
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(fingerprint.cache.get(key), None)
+
+        errors = hook.send_actions(self.es, fingerprint.filter_unchanged(
+            self.es, [('index', 'foo', {'Title': 'Foo'})]))
+        self.assertEqual(errors, [])
+        self.assertNotEqual(fingerprint.cache.get(key), None)
+
+    def test_elastic_fingerprint_trusted_over_cache(self):
+        settings = getUtility(IRegistry).forInterface(IElasticSettings)
+        settings.skip_unchanged = True
+        settings.fingerprint_check_elastic = True
+        page = createObject(self.portal, 'Document', 'page', title='Page')
+        self.commit()
+        # another client changed the document since
+        self.es.connection.index(
+            index=self.es.index_name, doc_type=self.es.doc_type,
+            id=IUUID(page), body={'Title': 'Changed'})
+        self.catalog.catalog_object(page)
+        self.commit()
+        doc = self.es.connection.get(
+            index=self.es.index_name, doc_type=self.es.doc_type,
+            id=IUUID(page))
+        self.assertEqual(doc['_source']['Title'], 'Page')
+
+    def test_partial_update_clears_fingerprint(self):
+        settings = getUtility(IRegistry).forInterface(IElasticSettings)
+        settings.skip_unchanged = True
+        page = createObject(self.portal, 'Document', 'page', title='Page')
+        self.commit()
+        self.catalog.catalog_object(page, idxs=['review_state'])
+        self.commit()
+        doc = self.es.connection.get(
+            index=self.es.index_name, doc_type=self.es.doc_type,
+            id=IUUID(page))
+        self.assertEqual(doc['_source'][FINGERPRINT_FIELD], None)
+
+
+class TestPositions(BaseFunctionalTest):
+
+    def _position(self, obj):
+        return self.es.connection.get(
+            index=self.es.index_name, doc_type=self.es.doc_type,
+            id=IUUID(obj))['_source']['getObjPositionInParent']
+
+    def test_changed_positions(self):
+        self.assertEqual(
+            hook.changed_positions(['a', 'b', 'c', 'd'], ['a', 'c', 'b', 'd']),
+            {'c': 1, 'b': 2})
+        self.assertEqual(hook.changed_positions(['a', 'b'], ['a', 'b']), {})
+
+    def test_move_updates_positions(self):
+        folder = createObject(self.portal, 'Folder', 'folder', title='Folder')
+        pages = [createObject(folder, 'Document', 'page%i' % idx,
+                              title='Page %i' % idx) for idx in range(4)]
+        self.commit()
+        folder.moveObjectsToTop(['page2'])
+        _hook = hook.getHook(self.es)
+        self.assertEqual(_hook.positions, {
+            '/plone/folder': {'page2': 0, 'page0': 1, 'page1': 2}})
+        self.commit()
+        self.assertEqual(
+            [self._position(page) for page in pages], [1, 2, 0, 3])
+
+
+class TestRebuild(BaseFunctionalTest):
+
+    def test_zero_downtime_rebuild(self):
+        settings = getUtility(IRegistry).forInterface(IElasticSettings)
+        settings.zero_downtime_rebuild = True
+        createObject(self.portal, 'Event', 'event', title='Some Event')
+        self.commit()
+        version = self.es.index_version
+        old_index = self.es.real_index_name
+
+        self.catalog.manage_catalogRebuild()
+        self.commit()
+        es = ElasticSearchCatalog(self.catalog)
+        self.assertEqual(es.index_version, version + 1)
+        conn = es.connection
+        self.assertEqual(
+            conn.indices.get_alias(name=es.index_name).keys(),
+            [es.real_index_name])
+        self.assertFalse(conn.indices.exists(old_index))
+        settings = conn.indices.get_settings(index=es.real_index_name)
+        self.assertNotEqual(
+            settings[es.real_index_name]['settings']['index'].get(
+                'refresh_interval'), '-1')
+        self.assertEqual(len(self.catalog(Title='Some Event')), 1)
+
+    def test_swap_waits_for_commit(self):
+        settings = getUtility(IRegistry).forInterface(IElasticSettings)
+        settings.zero_downtime_rebuild = True
+        self.commit()
+        old_index = self.es.real_index_name
+        conn = self.es.connection
+        self.catalog.manage_catalogRebuild()
+        self.assertEqual(
+            conn.indices.get_alias(name=self.es.index_name).keys(),
+            [old_index])
+        self.assertTrue(hook.get_rebuild_index(self.es) is not None)
+        transaction.abort()
+        self.assertEqual(
+            conn.indices.get_alias(name=self.es.index_name).keys(),
+            [old_index])
+        self.assertTrue(hook.get_rebuild_index(self.es) is None)
+
+    def test_changes_committed_during_rebuild_kept(self):
+        settings = getUtility(IRegistry).forInterface(IElasticSettings)
+        settings.zero_downtime_rebuild = True
+        event = createObject(self.portal, 'Event', 'event', title='Old Title')
+        self.commit()
+        es = ElasticSearchCatalog(self.catalog)
+        original = self.catalog._old_manage_catalogRebuild
+
+        def rebuild(*args, **kwargs):
+            # another client commits a change while the rebuild still sees
+            # the object as it was when it started
+            event.title = 'New Title'
+            hook.index_batch([], {IUUID(event): event}, {}, es)
+            event.title = 'Old Title'
+            return original(*args, **kwargs)
+        self.catalog._old_manage_catalogRebuild = rebuild
+        try:
+            self.catalog.manage_catalogRebuild()
+        finally:
+            del self.catalog._old_manage_catalogRebuild
+        self.commit()
+        doc = es.connection.get(index=es.index_name, doc_type=es.doc_type,
+                                id=IUUID(event))
+        self.assertEqual(doc['_source']['Title'], 'New Title')
+
+    def test_rebuild_index_lookup_cached(self):
+        indices = self.es.connection.indices
+        calls = []
+
+        def failing(*args, **kwargs):
+            calls.append(kwargs)
+            raise ConnectionError('N/A', 'connection refused', None)
+        indices.get_alias = failing
+        try:
+            self.assertEqual(hook.get_rebuild_index(self.es), None)
+            self.assertEqual(hook.get_rebuild_index(self.es), None)
+        finally:
+            del indices.get_alias
+        self.assertEqual(len(calls), 1)
+
+    def _index_settings(self):
+        conn = self.es.connection
+        settings = conn.indices.get_settings(index=self.es.index_name)
+        return settings.values()[0]['settings']['index']
+
+    def test_rebuild_restores_index_settings(self):
+        createObject(self.portal, 'Event', 'event', title='Some Event')
+        self.catalog.manage_catalogRebuild()
+        self.commit()
+        settings = self._index_settings()
+        self.assertNotEqual(settings.get('refresh_interval'), '-1')
+        self.assertNotEqual(settings.get('translog', {}).get('durability'),
+                            'async')
+        self.es.connection.indices.flush()
+        self.assertEqual(len(self.catalog(Title='Some Event')), 1)
+
+    def test_failed_rebuild_restores_index_settings(self):
+        def failing(*args, **kwargs):
+            raise ValueError('rebuild failed')
+        self.catalog._old_manage_catalogRebuild = failing
+        try:
+            self.assertRaises(ValueError, self.catalog.manage_catalogRebuild)
+        finally:
+            del self.catalog._old_manage_catalogRebuild
+        self.assertNotEqual(self._index_settings().get('refresh_interval'),
+                            '-1')
+
+
+    def test_rebuild_survives_failed_merge(self):
+        createObject(self.portal, 'Event', 'event', title='Some Event')
+        indices = self.es.connection.indices
+
+        def failing(*args, **kwargs):
+            raise ConnectionError('N/A', 'read timed out', None)
+        indices.forcemerge = failing
+        try:
+            self.catalog.manage_catalogRebuild()
+        finally:
+            del indices.forcemerge
+        self.commit()
+        self.es.connection.indices.flush()
+        self.assertEqual(len(self.catalog(Title='Some Event')), 1)
+
+
+class TestIndexPlan(BaseTest):
+
+    def test_plan_cached(self):
+        catalog = self.catalog._catalog
+        plan = get_index_plan(catalog)
+        self.assertTrue(get_index_plan(catalog) is plan)
+        self.assertTrue('portal_type' in plan.indexes)
+
+    def test_plan_rebuilt_when_indexes_change(self):
+        catalog = self.catalog._catalog
+        plan = get_index_plan(catalog)
+        self.catalog.addIndex('foobar', 'FieldIndex')
+        self.assertTrue('foobar' in get_index_plan(catalog).indexes)
+        self.assertTrue(get_index_plan(catalog) is not plan)
+        self.catalog.delIndex('foobar')
+        self.assertFalse('foobar' in get_index_plan(catalog).indexes)
+
+
+    def test_text_indexer_values_decoded(self):
+        page = createObject(self.portal, 'Document', 'page',
+                            title=u'Caf\xe9')
+        self.catalog.delIndex('SearchableText')
+        data = hook.get_index_data(IUUID(page), page, self.es)
+        self.assertTrue(isinstance(data['SearchableText'], unicode))
+        self.assertTrue(u'Caf\xe9' in data['SearchableText'])
+
+
+class TestConnection(BaseTest):
+
+    def test_connection_is_shared(self):
+        es = ElasticSearchCatalog(self.catalog)
+        self.assertTrue(es.connection is self.es.connection)
+
+    def test_connection_rebuilt_on_settings_change(self):
+        conn = self.es.connection
+        settings = getUtility(IRegistry).forInterface(IElasticSettings)
+        settings.pool_maxsize = 20
+        es = ElasticSearchCatalog(self.catalog)
+        self.assertTrue(es.connection is not conn)
+        self.assertTrue(
+            ElasticSearchCatalog(self.catalog).connection is es.connection)
+
+
+class TestSettings(BaseTest):
+
+    def test_settings_are_cached(self):
+        es = ElasticSearchCatalog(self.catalog)
+        self.assertTrue(
+            es.settings is ElasticSearchCatalog(self.catalog).settings)
+
+    def test_settings_invalidated_on_change(self):
+        settings = getUtility(IRegistry).forInterface(IElasticSettings)
+        settings.bulk_size = 25
+        es = ElasticSearchCatalog(self.catalog)
+        self.assertEqual(es.settings.bulk_size, 25)
+        self.assertTrue(es.settings is not self.es.settings)
+
+    def test_uncommitted_settings_not_cached(self):
+        bulk_size = ElasticSearchCatalog(self.catalog).settings.bulk_size
+        settings = getUtility(IRegistry).forInterface(IElasticSettings)
+        settings.bulk_size = bulk_size + 1
+        es = ElasticSearchCatalog(self.catalog)
+        self.assertEqual(es.settings.bulk_size, bulk_size + 1)
+        transaction.abort()
+        es = ElasticSearchCatalog(self.catalog)
+        self.assertEqual(es.settings.bulk_size, bulk_size)
+
+    def test_settings_rebuilt_when_serial_changes(self):
+        # what a change committed by another client looks like
+        es = ElasticSearchCatalog(self.catalog)
+        registry = getUtility(IRegistry)
+        setattr(registry, SERIAL_ATTR, getattr(registry, SERIAL_ATTR, 0) + 1)
+        self.assertTrue(
+            ElasticSearchCatalog(self.catalog).settings is not es.settings)
+
+
+class TestIndexQueue(BaseFunctionalTest):
+
+    def test_operations_coalesced(self):
+        queue = IndexQueue(self.es.connection, flush_size=100,
+                           flush_interval=60)
+        args = (self.es.index_name, self.es.doc_type)
+        queue.put(*(args + ('index', 'a', {'Title': 'One'})))
+        queue.put(*(args + ('update', 'a', {'doc': {'Title': 'Two'}})))
+        queue.put(*(args + ('update', 'b', {'doc': {'Title': 'B'}})))
+        queue.put(*(args + ('delete', 'b', None)))
+        queue.put(*(args + ('update', 'b', {'doc': {'Title': 'C'}})))
+        self.assertEqual(len(queue), 2)
+        key = args + ('a',)
+        self.assertEqual(queue.pending[key], ['index', {'Title': 'Two'}])
+        key = args + ('b',)
+        self.assertEqual(queue.pending[key], ['delete', None])
+        queue.flush()
+        self.assertEqual(len(queue), 0)
+
+    def test_requeued_operations_merged(self):
+        queue = IndexQueue(self.es.connection, flush_size=100,
+                           flush_interval=60)
+        args = (self.es.index_name, self.es.doc_type)
+        queue.put(*(args + ('index', 'a', {'Title': 'One', 'id': 'a'})))
+        queue.put(*(args + ('index', 'b', {'Title': 'B'})))
+        pending = queue._take()
+        # queued while the failed batch was being sent
+        queue.put(*(args + ('update', 'a', {'doc': {'Title': 'Two'}})))
+        queue.put(*(args + ('update', 'b', {'doc': {'Title': 'C'}})))
+        queue.put(*(args + ('delete', 'b', None)))
+        queue._requeue(pending)
+        self.assertEqual(queue.pending.items(), [
+            (args + ('a',), ['index', {'Title': 'Two', 'id': 'a'}]),
+            (args + ('b',), ['delete', None])])
+
+    def test_rejected_items_dead_lettered(self):
+        queue = IndexQueue(self.es.connection, flush_size=100,
+                           flush_interval=60, retries=1, backoff_max=0.01)
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        bulk = self.es.connection.bulk
+        bodies = []
+
+        def rejecting(index, doc_type, body):
+            bodies.append(body)
+            result = bulk(index=index, doc_type=doc_type, body=body)
+            result['errors'] = True
+            result['items'][0]['index'].update({
+                'status': 429, 'error': 'rejected'})
+            return result
+        args = (self.es.index_name, self.es.doc_type)
+        queue.put(*(args + ('index', 'foo', {'Title': 'Foo'})))
+        self.es.connection.bulk = rejecting
+        deadletter.addHandler(handler)
+        try:
+            queue.flush()
+        finally:
+            self.es.connection.bulk = bulk
+            deadletter.removeHandler(handler)
+        self.assertEqual(len(bodies), 2)
+        self.assertEqual(len(queue), 0)
+        self.assertEqual([json.loads(r.getMessage())['uid']
+                          for r in records], ['foo'])
+
+    def test_unsent_operations_requeued(self):
+        queue = IndexQueue(self.es.connection, flush_size=100,
+                           flush_interval=60, bulk_size=1, retries=0)
+        bulk = self.es.connection.bulk
+        bodies = []
+
+        def failing(index, doc_type, body):
+            bodies.append(body)
+            if len(bodies) > 1:
+                raise ConnectionError('N/A', 'connection refused', None)
+            return bulk(index=index, doc_type=doc_type, body=body)
+        args = (self.es.index_name, self.es.doc_type)
+        for uid in ('a', 'b', 'c'):
+            queue.put(*(args + ('index', uid, {'Title': uid})))
+        self.es.connection.bulk = failing
+        try:
+            self.assertRaises(ConnectionError, queue.flush)
+        finally:
+            self.es.connection.bulk = bulk
+        # sent, dead lettered, requeued
+        self.assertEqual(queue.pending.keys(), [args + ('c',)])
+
+    def test_queued_indexing(self):
+        settings = getUtility(IRegistry).forInterface(IElasticSettings)
+        settings.index_queue = True
+        page = createObject(self.portal, 'Document', 'page', title='Page')
+        self.commit()
+        page.title = u'Changed'
+        self.catalog.catalog_object(page)
+        self.commit()
+        get_queue(self.es).flush()
+        doc = self.es.connection.get(
+            index=self.es.index_name, doc_type=self.es.doc_type,
+            id=IUUID(page))
+        self.assertEqual(doc['_source']['Title'], 'Changed')
+
+
+class TestOutbox(BaseFunctionalTest):
+
+    def setUp(self):
+        super(TestOutbox, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        os.environ[ENVIRON_KEY] = os.path.join(self.tmpdir, 'outbox.sqlite')
+
+    def tearDown(self):
+        super(TestOutbox, self).tearDown()
+        del os.environ[ENVIRON_KEY]
+        shutil.rmtree(self.tmpdir)
+
+    def test_operations_sent_from_outbox(self):
+        page = createObject(self.portal, 'Document', 'page', title='Page')
+        self.commit()
+        outbox = get_outbox(self.es)
+        outbox.drain()
+        self.assertEqual(len(outbox), 0)
+        doc = self.es.connection.get(
+            index=self.es.index_name, doc_type=self.es.doc_type,
+            id=IUUID(page))
+        self.assertEqual(doc['_source']['Title'], 'Page')
+
+    def test_operations_kept_while_elastic_is_down(self):
+        outbox = get_outbox(self.es)
+
+        def failing(*args, **kwargs):
+            raise IOError('down')
+        bulk = self.es.connection.bulk
+        self.es.connection.bulk = failing
+        try:
+            outbox.add([(self.es.index_name, self.es.doc_type, 'index',
+                         'foo', {'Title': 'Foo'})])
+            self.assertRaises(IOError, outbox.drain)
+            self.assertEqual(len(outbox), 1)
+        finally:
+            self.es.connection.bulk = bulk
+        outbox.drain()
+        self.assertEqual(len(outbox), 0)
+
+    def test_refused_operations_dead_lettered(self):
+        outbox = get_outbox(self.es)
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+
+        def failing(*args, **kwargs):
+            raise TransportError(413, 'request entity too large')
+        bulk = self.es.connection.bulk
+        self.es.connection.bulk = failing
+        deadletter.addHandler(handler)
+        try:
+            outbox.add([(self.es.index_name, self.es.doc_type, 'index',
+                         'foo', {'Title': 'Foo'})])
+            outbox.drain()
+        finally:
+            self.es.connection.bulk = bulk
+            deadletter.removeHandler(handler)
+        self.assertEqual(len(outbox), 0)
+        self.assertEqual(
+            set([json.loads(r.getMessage())['uid'] for r in records]),
+            set(['foo']))
+
+    def test_server_errors_retried(self):
+        outbox = get_outbox(self.es)
+
+        def failing(*args, **kwargs):
+            raise TransportError(502, 'bad gateway')
+        bulk = self.es.connection.bulk
+        self.es.connection.bulk = failing
+        try:
+            outbox.add([(self.es.index_name, self.es.doc_type, 'index',
+                         'foo', {'Title': 'Foo'})])
+            self.assertRaises(TransportError, outbox.drain)
+            self.assertEqual(len(outbox), 1)
+        finally:
+            self.es.connection.bulk = bulk
+        outbox.drain()
+        self.assertEqual(len(outbox), 0)
+
+    def test_refused_items_dead_lettered(self):
+        outbox = get_outbox(self.es)
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        deadletter.addHandler(handler)
+        try:
+            outbox.add([(self.es.index_name, self.es.doc_type, 'update',
+                         'missing-uid', {'doc': {'Title': 'Foo'}})])
+            outbox.drain()
+        finally:
+            deadletter.removeHandler(handler)
+        self.assertEqual(len(outbox), 0)
+        self.assertEqual([json.loads(r.getMessage())['status']
+                          for r in records], [404])
+
+
+class TestCeleryBatching(BaseTest):
+
+    def test_resolve_uids(self):
+        page = createObject(self.portal, 'Document', 'page', title='Page')
+        objects = hook.resolve_uids([IUUID(page), 'missing'], self.es)
+        self.assertTrue(objects[IUUID(page)].aq_base is page.aq_base)
+        self.assertEqual(objects['missing'], None)
+
+    def test_operations_coalesced(self):
+        settings = getUtility(IRegistry).forInterface(IElasticSettings)
+        settings.celery_batch_size = 100
+        settings.celery_batch_window = 60.0
+        batcher = hook.CeleryBatcher()
+        _hook = hook.CommitHook(self.es)
+        _hook.index = {'a': None, 'b': None}
+        _hook.idxs = {'a': set(['Title']), 'b': None}
+        batcher.add(_hook, self.es.settings)
+        _hook = hook.CommitHook(self.es)
+        _hook.remove = ['b']
+        _hook.index = {'a': None}
+        _hook.idxs = {'a': set(['Description'])}
+        batcher.add(_hook, self.es.settings)
+        batcher.timer.cancel()
+        self.assertEqual(batcher.batches.keys(),
+                         [self.portal.getPhysicalPath()])
+        batch = batcher.batches[self.portal.getPhysicalPath()]
+        self.assertEqual(batch.index, set(['a']))
+        self.assertEqual(batch.remove, set(['b']))
+        self.assertEqual(batch.idxs, {'a': set(['Title', 'Description'])})
+
+
 def test_suite():
     return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,80 @@
+from collective.elasticsearch import hook
+from collective.elasticsearch.es import ElasticLazyMap
+from collective.elasticsearch.interfaces import IElasticSettings
+from collective.elasticsearch.tests import BaseFunctionalTest
+from collective.elasticsearch.testing import createObject
+from collective.elasticsearch.testing import \
+    FakeElasticSearch_FUNCTIONAL_TESTING
+from plone.registry.interfaces import IRegistry
+from zope.component import getUtility
+import unittest2 as unittest
+
+
+class TestFakeServer(BaseFunctionalTest):
+
+    layer = FakeElasticSearch_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        super(TestFakeServer, self).setUp()
+        self.server = self.layer['elasticserver']
+
+    def tearDown(self):
+        super(TestFakeServer, self).tearDown()
+        self.server.reject_rate = 0
+        self.server.failure_rate = 0
+
+    def test_index_and_search(self):
+        createObject(self.portal, 'Event', 'event', title='Some Event')
+        self.commit()
+        results = self.catalog(Title='Some Event')
+        self.assertTrue(isinstance(results, ElasticLazyMap))
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0].getId, 'event')
+
+    def test_rejected_items_reported(self):
+        settings = getUtility(IRegistry).forInterface(IElasticSettings)
+        settings.bulk_retries = 1
+        settings.bulk_backoff_max = 0.01
+        self.server.reject_rate = 1
+        sent = len(self.server.requests)
+        errors = hook.send_actions(self.es, [
+            ('index', 'foo', {'Title': 'Foo'})])
+        self.assertEqual([e['status'] for e in errors], [429])
+        # sent once and retried once
+        self.assertEqual(len([r for r in self.server.requests[sent:]
+                              if r[1].endswith('_bulk')]), 2)
+
+    def test_external_versions(self):
+        errors = hook.send_actions(self.es, [
+            ('index', 'foo', {'Title': 'Foo'})], version=10)
+        self.assertEqual(errors, [])
+        errors = hook.send_actions(self.es, [
+            ('index', 'foo', {'Title': 'Older'})], version=5)
+        self.assertEqual([e['status'] for e in errors], [409])
+        errors = hook.send_actions(self.es, [
+            ('delete', 'foo', None)], version=20)
+        self.assertEqual(errors, [])
+        # deleted documents keep their version
+        errors = hook.send_actions(self.es, [
+            ('index', 'foo', {'Title': 'Foo'})], version=15)
+        self.assertEqual([e['status'] for e in errors], [409])
+
+    def test_search_after_compares_sort_values(self):
+        conn = self.es.connection
+        for title in ('a', 'b', 'c'):
+            conn.index(index=self.es.index_name, doc_type=self.es.doc_type,
+                       id=title, body={'Title': title})
+        result = conn.search(
+            index=self.es.index_name, doc_type=self.es.doc_type,
+            body={'sort': [{'Title': 'asc'}], 'search_after': ['aa']})
+        self.assertEqual([h['_id'] for h in result['hits']['hits']],
+                         ['b', 'c'])
+        result = conn.search(
+            index=self.es.index_name, doc_type=self.es.doc_type,
+            body={'sort': [{'Title': 'desc'}], 'search_after': ['bb']})
+        self.assertEqual([h['_id'] for h in result['hits']['hits']],
+                         ['b', 'a'])
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
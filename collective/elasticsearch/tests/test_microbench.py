@@ -0,0 +1,106 @@
+from DateTime import DateTime
+from Products.CMFCore.utils import getToolByName
+from collective.elasticsearch.brain import BrainFactory
+from collective.elasticsearch.brain import ElasticBrainFactory
+from collective.elasticsearch.brain import METADATA_FIELD
+from collective.elasticsearch.brain import get_metadata
+from collective.elasticsearch.es import ElasticSearchCatalog
+from collective.elasticsearch.hook import get_index_data
+from collective.elasticsearch.interfaces import IQueryAssembler
+from collective.elasticsearch.testing import ElasticSearch_INTEGRATION_TESTING
+from collective.elasticsearch.testing import createObject
+from collective.elasticsearch.tests.microbench import Report
+from plone.app.textfield.value import RichTextValue
+from plone.uuid.interfaces import IUUID
+from zope.component import getMultiAdapter
+import unittest2 as unittest
+
+
+TEXT = u'<p>%s</p>' % u' '.join([u'lorem ipsum dolor sit amet'] * 40)
+
+
+class TestMicrobenchmarks(unittest.TestCase):
+    '''
+    Times the pure python hot paths against a fixed catalog, elastic
+    search is not used. Only run when asked for:
+
+        bin/test -a 3 -t microbench
+    '''
+
+    layer = ElasticSearch_INTEGRATION_TESTING
+    level = 3
+
+    @classmethod
+    def setUpClass(cls):
+        cls.report = Report()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.report.finish()
+
+    def setUp(self):
+        self.portal = self.layer['portal']
+        self.request = self.layer['request']
+        self.catalog = getToolByName(self.portal, 'portal_catalog')
+        self.es = ElasticSearchCatalog(self.catalog)
+        folder = createObject(self.portal, 'Folder', 'bench', title='Bench')
+        self.objects = []
+        for idx in range(25):
+            self.objects.append(createObject(
+                folder, 'Document', 'page%i' % idx,
+                title='Page %i' % idx, description='A page to time',
+                text=RichTextValue(TEXT, 'text/html', 'text/x-html-safe')))
+            self.objects.append(createObject(
+                folder, 'Event', 'event%i' % idx, title='Event %i' % idx,
+                description='An event to time'))
+
+    def test_get_index_data(self):
+        page, event = self.objects[:2]
+        for name, obj in (('document', page), ('event', event)):
+            uid = IUUID(obj)
+            self.report.add(
+                'get_index_data.%s' % name,
+                lambda: get_index_data(uid, obj, self.es))
+        self.report.add(
+            'get_index_data.partial',
+            lambda: get_index_data(IUUID(page), page, self.es,
+                                   idxs=['Title', 'review_state']))
+
+    def test_query_assembler(self):
+        assembler = getMultiAdapter((self.request, self.es), IQueryAssembler)
+        query = {
+            'portal_type': ['Document', 'Event'],
+            'path': {'query': '/plone/bench', 'depth': 1},
+            'SearchableText': 'lorem ipsum',
+            'review_state': 'published',
+            'effective': {'query': DateTime('2016/01/01'), 'range': 'max'},
+            'allowedRolesAndUsers': ['Anonymous', 'user:admin'],
+            'sort_on': 'effective',
+            'sort_order': 'reverse',
+            'b_start': 0,
+            'b_size': 20
+        }
+        self.report.add('query.normalize',
+                        lambda: assembler.normalize(dict(query)))
+        normalized, _ = assembler.normalize(dict(query))
+        self.report.add('query.assemble', lambda: assembler(normalized))
+
+    def test_brain_factories(self):
+        catalog = self.catalog._catalog
+        hits = []
+        for obj in self.objects:
+            hits.append({
+                '_score': 1.0,
+                'fields': {'path.path': ['/'.join(obj.getPhysicalPath())]},
+                '_source': {METADATA_FIELD: get_metadata(catalog, obj)}
+            })
+        factory = BrainFactory(catalog)
+        self.report.add('brains.catalog_page',
+                        lambda: [factory(hit) for hit in hits])
+        factory = ElasticBrainFactory(self.catalog)
+        self.report.add('brains.elastic_page',
+                        lambda: [factory(hit) for hit in hits])
+        self.report.add(
+            'brains.elastic_page_render',
+            lambda: [(brain.Title, brain.getPath())
+                     for brain in [factory(hit) for hit in hits]])
@@ -1,7 +1,26 @@
+from App.config import getConfiguration
+from collective.elasticsearch import resultcache
+from collective.elasticsearch import slowlog
+from collective.elasticsearch import timing
+from collective.elasticsearch.brain import ElasticBrain
+from collective.elasticsearch.brain import decode_value
+from collective.elasticsearch.brain import encode_value
+from collective.elasticsearch.es import ElasticLazyMap
+from collective.elasticsearch.indexes import get_index_plan
+from collective.elasticsearch.interfaces import IElasticSettings
+from collective.elasticsearch.interfaces import IQueryAssembler
 from collective.elasticsearch.tests import BaseFunctionalTest
+from collective.elasticsearch.tests import BaseTest
 from collective.elasticsearch.testing import createObject
+from plone.registry.interfaces import IRegistry
+from zope.component import getMultiAdapter
+from zope.annotation.interfaces import IAnnotations
+from zope.component import getUtility
+from ZPublisher.pubevents import PubBeforeCommit
 import unittest2 as unittest
 from DateTime import DateTime
+from elasticsearch.exceptions import TransportError
+from Missing import MV
 import time
 
 
@@ -153,5 +172,344 @@ class TestQueries(BaseFunctionalTest):
         self.assertEqual(brain.getPath(), '/plone/event')
 
 
+class TestQueryAssembler(BaseTest):
+
+    def test_filters_and_matches(self):
+        qassembler = getMultiAdapter((self.request, self.es), IQueryAssembler)
+        query = qassembler({
+            'portal_type': ['Event', 'Document'],
+            'review_state': 'published',
+            'SearchableText': 'foobar'
+        })
+        self.assertEqual(len(query['bool']['must']), 1)
+        self.assertTrue(
+            {'terms': {'portal_type': ['Event', 'Document']}} in
+            query['bool']['filter'])
+        self.assertTrue(
+            {'term': {'review_state': 'published'}} in query['bool']['filter'])
+
+    def test_match_all(self):
+        qassembler = getMultiAdapter((self.request, self.es), IQueryAssembler)
+        self.assertEqual(qassembler({}), {'match_all': {}})
+
+
+class TestPagination(BaseFunctionalTest):
+
+    def setUp(self):
+        super(TestPagination, self).setUp()
+        settings = getUtility(IRegistry).forInterface(IElasticSettings)
+        settings.bulk_size = 2
+        settings.cursor_pagination = True
+        for idx in range(7):
+            createObject(self.portal, 'Document', 'page%i' % idx,
+                         title='Page %i' % idx)
+        self.commit()
+        self.es.connection.indices.flush()
+
+    def test_count_does_not_load_hits(self):
+        results = self.catalog(Title='Page')
+        self.assertEqual(len(results), 7)
+        self.assertEqual(results.actual_result_count, 7)
+        self.assertEqual(results._seq.results, {})
+        results[0]
+        self.assertEqual(results._seq.results.keys(), [0])
+
+    def test_sequential_access(self):
+        results = self.catalog(Title='Page', sort_on='getObjPositionInParent')
+        self.assertEqual(len(results), 7)
+        ids = [results[idx].getId for idx in range(len(results))]
+        self.assertEqual(len(set(ids)), 7)
+
+    def test_iteration(self):
+        results = self.catalog(Title='Page', sort_on='getObjPositionInParent')
+        ids = [b.getId for b in results]
+        self.assertEqual(len(ids), 7)
+        self.assertEqual(len(set(ids)), 7)
+
+    def test_slices(self):
+        results = self.catalog(Title='Page', sort_on='getObjPositionInParent')
+        ids = [b.getId for b in results]
+        result = results._seq
+        self.assertEqual(len(result[1:6]), 5)
+        self.assertEqual(len(result[::3]), 3)
+        self.assertEqual(len(result[-2:]), 2)
+        self.assertEqual(result[-1]['_id'], result[6]['_id'])
+        self.assertEqual(
+            [ids[0], ids[3], ids[6]],
+            [results._func(r).getId for r in result[::3]])
+
+    def test_page_errors_served_from_catalog(self):
+        results = self.catalog(Title='Page', sort_on='getObjPositionInParent')
+        expected = [b.getId for b in results]
+        resultcache.invalidate()
+        results = self.catalog(Title='Page', sort_on='getObjPositionInParent')
+        conn = self.es.connection
+
+        def failing(*args, **kwargs):
+            raise TransportError(500, 'search_phase_execution_exception')
+        conn.search = conn.msearch = conn.scroll = failing
+        try:
+            self.assertEqual(results[0].getId, expected[0])
+            self.assertEqual([b.getId for b in results], expected)
+        finally:
+            del conn.search, conn.msearch, conn.scroll
+
+    def test_page_after_catalog_page(self):
+        results = self.catalog(Title='Page', sort_on='getObjPositionInParent')
+        expected = [b.getId for b in results]
+        resultcache.invalidate()
+        results = self.catalog(Title='Page', sort_on='getObjPositionInParent')
+        conn = self.es.connection
+
+        def failing(*args, **kwargs):
+            raise TransportError(500, 'search_phase_execution_exception')
+        conn.search = conn.msearch = failing
+        try:
+            self.assertEqual(results[0].getId, expected[0])
+        finally:
+            del conn.search, conn.msearch
+        # the next page can not continue after catalog hits
+        self.assertEqual(results[2].getId, expected[2])
+
+
+class TestRouting(BaseFunctionalTest):
+
+    def setUp(self):
+        super(TestRouting, self).setUp()
+        createObject(self.portal, 'Event', 'event', title='Some Event')
+        self.commit()
+        self.es.connection.indices.flush()
+        self.settings = getUtility(IRegistry).forInterface(IElasticSettings)
+
+    def test_text_queries_only_by_default(self):
+        self.assertTrue(isinstance(
+            self.catalog(Title='Some Event'), ElasticLazyMap))
+        self.assertFalse(isinstance(
+            self.catalog(portal_type='Event'), ElasticLazyMap))
+
+    def test_hint(self):
+        results = self.catalog(portal_type='Event', _es=True)
+        self.assertTrue(isinstance(results, ElasticLazyMap))
+        self.assertEqual(len(results), 1)
+        results = self.catalog(Title='Some Event', _es=False)
+        self.assertFalse(isinstance(results, ElasticLazyMap))
+        self.assertEqual(len(results), 1)
+
+    def test_routed_indexes(self):
+        self.settings.routing_mode = u'indexes'
+        self.settings.routing_indexes = [u'portal_type']
+        self.settings.routing_sort_keys = [u'effective']
+        self.assertTrue(isinstance(
+            self.catalog(portal_type='Event'), ElasticLazyMap))
+        self.assertTrue(isinstance(
+            self.catalog(sort_on='effective'), ElasticLazyMap))
+        self.assertFalse(isinstance(
+            self.catalog(review_state='private'), ElasticLazyMap))
+
+    def test_route_all(self):
+        self.settings.routing_mode = u'all'
+        results = self.catalog(portal_type='Event')
+        self.assertTrue(isinstance(results, ElasticLazyMap))
+        self.assertEqual(len(results), 1)
+
+    def test_untranslatable_indexes_use_catalog(self):
+        self.settings.routing_mode = u'all'
+        catalog = self.catalog._catalog
+        # as if portal_type was an index of a type we do not support
+        get_index_plan(catalog).missing = ('portal_type',)
+        try:
+            self.assertFalse(isinstance(
+                self.catalog(portal_type='Event', Title='Some Event'),
+                ElasticLazyMap))
+            self.assertFalse(isinstance(
+                self.catalog(Title='Some Event', sort_on='portal_type'),
+                ElasticLazyMap))
+            self.assertTrue(isinstance(
+                self.catalog(Title='Some Event'), ElasticLazyMap))
+        finally:
+            catalog._v_elasticindexplan = None
+
+
+class TestNativeBrains(BaseFunctionalTest):
+
+    def setUp(self):
+        super(TestNativeBrains, self).setUp()
+        settings = getUtility(IRegistry).forInterface(IElasticSettings)
+        settings.native_brains = True
+
+    def test_brains_from_elastic(self):
+        event = createObject(self.portal, 'Event', 'event', title='Some Event')
+        self.commit()
+        self.es.connection.indices.flush()
+        el_results = self.catalog(portal_type='Event', Title='Some Event')
+        brain = el_results[0]
+        self.assertTrue(isinstance(brain.aq_base, ElasticBrain))
+        self.assertEqual(brain.Title, 'Some Event')
+        self.assertEqual(brain.portal_type, 'Event')
+        self.assertEqual(brain.modified, event.modified())
+        self.assertEqual(brain.getObject(), event)
+        self.assertEqual(brain.getURL(), 'http://nohost/plone/event')
+        self.assertEqual(brain.getPath(), '/plone/event')
+        self.assertEqual(brain.getRID(),
+                         self.catalog._catalog.uids['/plone/event'])
+
+    def test_metadata_values_round_trip(self):
+        now = DateTime()
+        self.assertEqual(decode_value(encode_value(now)), now)
+        self.assertEqual(decode_value(encode_value(now)).micros(),
+                         now.micros())
+        self.assertTrue(decode_value(encode_value(MV)) is MV)
+        self.assertTrue(decode_value(encode_value(object())) is MV)
+        self.assertEqual(decode_value(encode_value(['a', MV])), ('a', MV))
+
+
+class TestResultCache(BaseFunctionalTest):
+
+    def setUp(self):
+        super(TestResultCache, self).setUp()
+        createObject(self.portal, 'Event', 'event', title='Some Event')
+        self.commit()
+        self.es.connection.indices.flush()
+
+    def test_results_shared_in_request(self):
+        results = self.catalog(Title='Some Event')
+        self.assertEqual(len(results), 1)
+        results[0]
+        results2 = self.catalog(Title='Some Event')
+        self.assertTrue(results2._seq.results is results._seq.results)
+
+    def test_commit_invalidates(self):
+        results = self.catalog(Title='Some Event')
+        self.assertEqual(len(results), 1)
+        createObject(self.portal, 'Event', 'event2', title='Some Event')
+        self.commit()
+        self.es.connection.indices.flush()
+        results2 = self.catalog(Title='Some Event')
+        self.assertTrue(results2._seq.results is not results._seq.results)
+        self.assertEqual(len(results2), 2)
+
+    def test_process_cache(self):
+        settings = getUtility(IRegistry).forInterface(IElasticSettings)
+        settings.result_cache = False
+        settings.result_cache_size = 10
+        # elastic search refreshed since the commit in setUp
+        resultcache.invalidated -= resultcache.REFRESH_WINDOW
+        results = self.catalog(Title='Some Event')
+        results2 = self.catalog(Title='Some Event')
+        self.assertTrue(results2._seq.results is results._seq.results)
+
+    def test_process_cache_skipped_before_refresh(self):
+        settings = getUtility(IRegistry).forInterface(IElasticSettings)
+        settings.result_cache = False
+        settings.result_cache_size = 10
+        resultcache.invalidate()
+        results = self.catalog(Title='Some Event')
+        results2 = self.catalog(Title='Some Event')
+        self.assertTrue(results2._seq.results is not results._seq.results)
+
+    def test_effective_range_rounded(self):
+        # one second into the current minute
+        now = DateTime(DateTime().timeTime() // 60 * 60 + 1)
+        results = self.catalog(Title='Some Event', effectiveRange=now)
+        results2 = self.catalog(Title='Some Event',
+                                effectiveRange=now + 30.0 / 86400)
+        self.assertTrue(results2._seq.results is results._seq.results)
+
+    def test_effective_range_kept_without_cache(self):
+        settings = getUtility(IRegistry).forInterface(IElasticSettings)
+        settings.result_cache = False
+        settings.result_cache_size = 0
+        now = DateTime(DateTime().timeTime() // 60 * 60 + 1)
+        results = self.catalog(Title='Some Event', effectiveRange=now)
+        self.assertEqual(results._seq.catalog_query['effectiveRange'], now)
+
+
+class TestTiming(BaseFunctionalTest):
+
+    def setUp(self):
+        super(TestTiming, self).setUp()
+        settings = getUtility(IRegistry).forInterface(IElasticSettings)
+        settings.timing = True
+        settings.result_cache = False
+        createObject(self.portal, 'Event', 'event', title='Some Event')
+        self.commit()
+        self.es.connection.indices.flush()
+
+    def get_timings(self):
+        return IAnnotations(self.request)[timing.REQUEST_KEY]
+
+    def test_search_phases(self):
+        IAnnotations(self.request).pop(timing.REQUEST_KEY, None)
+        results = self.catalog(Title='Some Event')
+        results[0]
+        phases = self.get_timings().phases
+        for phase in ('query', 'search', 'search.count', 'search.page',
+                      'brains'):
+            self.assertIn(phase, phases)
+        self.assertEqual(phases['search.count']['hits'], 1)
+        self.assertEqual(phases['search.page']['hits'], 1)
+        self.assertTrue(phases['search.page']['bytes'] > 0)
+        self.assertIn('took', phases['search.page'])
+
+    def test_indexing_phases(self):
+        phases = self.get_timings().phases
+        self.assertIn('index_data.Title', phases)
+        self.assertEqual(phases['bulk']['errors'], 0)
+        self.assertTrue(phases['bulk']['items'] > 0)
+
+    def test_header_in_debug_mode(self):
+        self.catalog(Title='Some Event')
+        config = getConfiguration()
+        debug_mode = config.debug_mode
+        config.debug_mode = True
+        try:
+            timing.set_header(PubBeforeCommit(self.request))
+        finally:
+            config.debug_mode = debug_mode
+        header = self.request.response.getHeader(timing.HEADER)
+        self.assertIn('search.count;count=1;', header)
+
+
+class TestSlowQueryLog(BaseFunctionalTest):
+
+    def setUp(self):
+        super(TestSlowQueryLog, self).setUp()
+        createObject(self.portal, 'Event', 'event', title='Some Event')
+        self.commit()
+        self.es.connection.indices.flush()
+        slowlog.log.clear()
+
+    def test_slow_queries_logged(self):
+        settings = getUtility(IRegistry).forInterface(IElasticSettings)
+        settings.slow_query_threshold = 0.000001
+        results = self.catalog(Title='Some Event', sort_on='created')
+        results[0]
+        entries = slowlog.log.get()
+        self.assertEqual([e['kind'] for e in entries], ['page', 'count'])
+        self.assertEqual(entries[1]['hits'], 1)
+        self.assertIn("'sort_on': 'created'", entries[1]['query'])
+        self.assertIn('created', entries[1]['sort'])
+        self.assertIn('"query"', entries[0]['body'])
+        self.assertTrue(entries[0]['took'] is not None)
+
+    def test_fast_queries_not_logged(self):
+        self.catalog(Title='Some Event')[0]
+        self.assertEqual(slowlog.log.get(), [])
+
+    def test_log_is_bounded(self):
+        log = slowlog.SlowQueryLog(2)
+        for idx in range(3):
+            log.add({'idx': idx})
+        self.assertEqual(log.get(), [{'idx': 2}, {'idx': 1}])
+
+    def test_profile(self):
+        entry = {'body': ''}
+        slowlog.profile(self.es.connection, self.es.index_name,
+                        self.es.doc_type, {'query': {'match_all': {}}},
+                        entry)
+        self.assertTrue(len(entry['profile']) > 0)
+        self.assertTrue(len(entry['profile'][0]['breakdown']) > 0)
+
+
 def test_suite():
     return unittest.defaultTestLoader.loadTestsFromName(__name__)
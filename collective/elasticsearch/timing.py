@@ -0,0 +1,205 @@
+from App.config import getConfiguration
+from collective.elasticsearch.interfaces import ITimingSink
+from contextlib import contextmanager
+from zope.annotation.interfaces import IAnnotations
+from zope.component import queryUtility
+from zope.globalrequest import getRequest
+from zope.interface import implements
+
+import json
+import logging
+import socket
+import threading
+import time
+
+
+logger = logging.getLogger('collective.elasticsearch.timing')
+
+REQUEST_KEY = 'collective.elasticsearch.timing'
+HEADER = 'X-ES-Timing'
+# timings recorded outside of a request are reported this often
+FLUSH_INTERVAL = 10.0
+
+_local = threading.local()
+
+
+class Timings(object):
+    '''
+    count, seconds and summed up numbers, like bytes, hits and `took`,
+    recorded per phase
+    '''
+
+    def __init__(self):
+        self.phases = {}
+        self.settings = None
+        self.started = time.time()
+
+    def add(self, phase, seconds, data):
+        stats = self.phases.get(phase)
+        if stats is None:
+            stats = self.phases[phase] = {'count': 0, 'seconds': 0.0}
+        stats['count'] += 1
+        stats['seconds'] += seconds
+        for name, value in data.items():
+            stats[name] = stats.get(name, 0) + value
+
+    def header(self):
+        '''
+        phase;count=1;dur=12.3 entries like the Server-Timing header
+        '''
+        entries = []
+        for phase, stats in sorted(self.phases.items()):
+            entry = ['%s;count=%i;dur=%.1f' % (
+                phase, stats['count'], stats['seconds'] * 1000)]
+            entry.extend(['%s=%s' % (name, value)
+                          for name, value in sorted(stats.items())
+                          if name not in ('count', 'seconds')])
+            entries.append(';'.join(entry))
+        return ', '.join(entries)
+
+
+def _collector():
+    request = getRequest()
+    if request is not None:
+        annotations = IAnnotations(request, None)
+        if annotations is not None:
+            timings = annotations.get(REQUEST_KEY)
+            if timings is None:
+                timings = annotations[REQUEST_KEY] = Timings()
+            return timings, False
+    timings = getattr(_local, 'timings', None)
+    if timings is None:
+        timings = _local.timings = Timings()
+    return timings, True
+
+
+def record(es, phase, seconds, **data):
+    '''
+    Add a measurement to the timings of the current request, which are
+    reported when it ends. Outside of a request they are reported every
+    FLUSH_INTERVAL seconds.
+    '''
+    if not es.settings.timing:
+        return
+    timings, detached = _collector()
+    timings.settings = es.settings
+    timings.add(phase, seconds, data)
+    if detached and timings.started + FLUSH_INTERVAL < time.time():
+        _local.timings = None
+        report(timings)
+
+
+@contextmanager
+def timed(es, phase):
+    '''
+    time the block as `phase`. Yields a dictionary the block can add
+    sizes to or None when timing is disabled
+    '''
+    if not es.settings.timing:
+        yield None
+        return
+    data = {}
+    started = time.time()
+    try:
+        yield data
+    finally:
+        record(es, phase, time.time() - started, **data)
+
+
+def size(body):
+    return len(json.dumps(body, default=str))
+
+
+def describe(data, body, response, hits=None):
+    '''
+    add the request size, `took` and number of hits of a search to the
+    data of a timed block
+    '''
+    if data is None:
+        return
+    if hits is None:
+        hits = len(response['hits']['hits'])
+    data['bytes'] = data.get('bytes', 0) + size(body)
+    data['took'] = data.get('took', 0) + response.get('took', 0)
+    data['hits'] = data.get('hits', 0) + hits
+
+
+def timed_factory(es, factory):
+    '''
+    wrap a brain factory to time building brains
+    '''
+    def factory_wrapper(result):
+        started = time.time()
+        try:
+            return factory(result)
+        finally:
+            record(es, 'brains', time.time() - started)
+    return factory_wrapper
+
+
+def report(timings):
+    if not timings.phases or timings.settings is None:
+        return
+    for name in timings.settings.timing_sinks:
+        sink = queryUtility(ITimingSink, name=name)
+        if sink is None:
+            logger.warn('No timing sink named %s' % name)
+            continue
+        try:
+            sink(timings.settings, timings.phases)
+        except Exception:
+            logger.warn('Error reporting timings to %s' % name,
+                        exc_info=True)
+
+
+def set_header(event):
+    '''
+    expose the timings of the page in debug mode, before the transaction
+    is committed so indexing is not part of it
+    '''
+    timings = IAnnotations(event.request, {}).get(REQUEST_KEY)
+    if timings is not None and getConfiguration().debug_mode:
+        event.request.response.setHeader(HEADER, timings.header())
+
+
+def report_request(event):
+    timings = IAnnotations(event.request, {}).pop(REQUEST_KEY, None)
+    if timings is not None:
+        report(timings)
+
+
+class LogSink(object):
+    implements(ITimingSink)
+
+    def __call__(self, settings, timings):
+        logger.info(' '.join([
+            '%s:%s' % (phase, json.dumps(stats, sort_keys=True))
+            for phase, stats in sorted(timings.items())]))
+
+
+class StatsdSink(object):
+    '''
+    Sends the time of every phase as a statsd timer and the other numbers
+    as counters, in one udp packet
+    '''
+    implements(ITimingSink)
+
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, settings, timings):
+        host, _, port = settings.statsd_address.partition(':')
+        lines = []
+        for phase, stats in sorted(timings.items()):
+            name = '%s.%s' % (settings.statsd_prefix, phase)
+            lines.append('%s:%.3f|ms' % (name, stats['seconds'] * 1000))
+            for key, value in sorted(stats.items()):
+                if key == 'seconds':
+                    continue
+                if key == 'took':
+                    lines.append('%s.took:%s|ms' % (name, value))
+                else:
+                    lines.append('%s.%s:%s|c' % (name, key, value))
+        self.socket.sendto('\n'.join(lines).encode('utf-8'),
+                           (host, int(port or 8125)))
+
@@ -0,0 +1,342 @@
+'''
+Reproducible throughput benchmark, run with
+
+    bin/instance run scripts/benchmark.py [--count 1000] [--fake]
+
+Builds a seeded synthetic corpus of Documents, Events and Folders in a
+folder of the site and reports, as json, how fast it was indexed on
+commit, how long a full catalog rebuild takes, search latencies and deep
+result iteration speed. `--fake` runs against the in-process fake elastic
+search server, `--compare` prints the change against an earlier report.
+'''
+from datetime import datetime
+from datetime import timedelta
+
+from AccessControl.SecurityManagement import newSecurityManager
+from AccessControl.SecurityManager import setSecurityPolicy
+from Products.CMFCore.tests.base.security import OmnipotentUser
+from Products.CMFCore.tests.base.security import PermissiveSecurityPolicy
+from Testing.makerequest import makerequest
+from collective.elasticsearch.es import ElasticSearchCatalog
+from collective.elasticsearch.fakeserver import FakeElasticServer
+from collective.elasticsearch.indexqueue import get_queue
+from collective.elasticsearch.interfaces import IElasticSettings
+from collective.elasticsearch.outbox import get_outbox
+from collective.elasticsearch.outbox import get_outbox_path
+from plone import api
+from plone.app.textfield.value import RichTextValue
+from plone.registry.interfaces import IRegistry
+from zope.component import getUtility
+from zope.component.hooks import setSite
+
+import argparse
+import json
+import math
+import random
+import resource
+import sys
+import time
+import transaction
+
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'ta', 'vo', 'shi', 'den', 'gar',
+             'pol', 'ix', 'um', 'bre', 'sto', 'fin', 'qua', 'zel']
+
+
+def spoofRequest(app):
+    """
+    Make REQUEST variable to be available on the Zope application server.
+
+    This allows acquisition to work properly
+    """
+    _policy = PermissiveSecurityPolicy()
+    setSecurityPolicy(_policy)
+    newSecurityManager(None, OmnipotentUser().__of__(app.acl_users))
+    return makerequest(app)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--site', default='Plone')
+    parser.add_argument('--count', type=int, default=1000,
+                        help='number of content objects to create')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--depth', type=int, default=6,
+                        help='maximum folder nesting')
+    parser.add_argument('--batch', type=int, default=50,
+                        help='objects created per transaction')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--fake', action='store_true',
+                        help='use the in-process fake elastic search server')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds the fake server delays every request')
+    parser.add_argument('--output', help='write the report to this file')
+    parser.add_argument('--compare', help='earlier report to compare with')
+    return parser.parse_args(argv)
+
+
+class Corpus(object):
+    '''
+    seeded generator of content: the same seed always produces the same
+    tree, titles and texts
+    '''
+
+    def __init__(self, seed, depth):
+        self.random = random.Random(seed)
+        self.depth = depth
+        self.words = sorted(set([
+            ''.join(self.random.sample(SYLLABLES, self.random.randint(2, 4)))
+            for _ in range(2000)]))
+        self.random.shuffle(self.words)
+
+    def word(self):
+        # a few words are much more common than the rest, like in text
+        return self.words[int(len(self.words) * self.random.random() ** 3)]
+
+    def sentence(self, low=6, high=18):
+        words = [self.word() for _ in range(self.random.randint(low, high))]
+        return ' '.join(words).capitalize() + '.'
+
+    def title(self):
+        return self.sentence(2, 6)[:-1]
+
+    def html(self):
+        parts = []
+        for _ in range(self.random.randint(2, 8)):
+            kind = self.random.random()
+            if kind < 0.15:
+                parts.append('<h2>%s</h2>' % self.title())
+            elif kind < 0.3:
+                parts.append('<ul>%s</ul>' % ''.join([
+                    '<li>%s</li>' % self.sentence(3, 8)
+                    for _ in range(self.random.randint(2, 6))]))
+            else:
+                sentences = [self.sentence()
+                             for _ in range(self.random.randint(2, 10))]
+                if self.random.random() < 0.3:
+                    sentences.append('<a href="http://example.com/%s">%s</a>'
+                                     % (self.word(), self.title()))
+                parts.append('<p>%s</p>' % ' '.join(sentences))
+        return '\n'.join(parts)
+
+    def items(self, count):
+        '''
+        yield (parent index, portal_type, data) where parent index refers to
+        the folders yielded before, -1 being the benchmark root
+        '''
+        folders = [0]  # depths of the folders, the root first
+        for _ in range(count):
+            parent = self.random.randrange(len(folders))
+            kind = self.random.random()
+            if kind < 0.15 and folders[parent] < self.depth:
+                folders.append(folders[parent] + 1)
+                yield parent - 1, 'Folder', {'title': self.title()}
+                continue
+            data = {
+                'title': self.title(),
+                'description': self.sentence(),
+            }
+            if kind < 0.4:
+                start = datetime(2016, 1, 1) + timedelta(
+                    hours=self.random.randint(0, 24 * 365))
+                data.update({
+                    'start': start,
+                    'end': start + timedelta(
+                        hours=self.random.randint(1, 48)),
+                    'text': self.richtext()
+                })
+                yield parent - 1, 'Event', data
+            else:
+                data['text'] = self.richtext()
+                yield parent - 1, 'Document', data
+
+    def richtext(self):
+        return RichTextValue(self.html(), mimeType='text/html',
+                             outputMimeType='text/x-html-safe')
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def rank(pct):
+        idx = int(math.ceil(pct / 100.0 * len(values))) - 1
+        return values[max(0, min(idx, len(values) - 1))]
+    return {
+        'p50': rank(50),
+        'p95': rank(95),
+        'p99': rank(99),
+        'max': values[-1]
+    }
+
+
+def flush_background(es):
+    if get_outbox_path():
+        get_outbox(es).drain()
+    elif es.settings.index_queue:
+        get_queue(es).flush()
+
+
+def bench_indexing(app, site, es, corpus, options):
+    root_id = 'benchmark-%i' % options.seed
+    if root_id in site.objectIds():
+        site.manage_delObjects([root_id])
+        transaction.commit()
+    root = api.content.create(type='Folder', id=root_id, title='Benchmark',
+                              container=site)
+    transaction.commit()
+
+    folders = []
+    commits = []
+    created = 0
+    started = time.time()
+    for parent, portal_type, data in corpus.items(options.count):
+        container = parent == -1 and root or folders[parent]
+        obj = api.content.create(type=portal_type, container=container,
+                                 id='%s%i' % (portal_type.lower(), created),
+                                 **data)
+        if portal_type == 'Folder':
+            folders.append(obj)
+        created += 1
+        if created % options.batch == 0:
+            commit_started = time.time()
+            transaction.commit()
+            commits.append(time.time() - commit_started)
+            app._p_jar.cacheMinimize()
+    commit_started = time.time()
+    transaction.commit()
+    flush_background(es)
+    commits.append(time.time() - commit_started)
+    seconds = time.time() - started
+    return root, {
+        'documents': created,
+        'seconds': seconds,
+        'docs_per_sec': created / seconds,
+        'commit_seconds': sum(commits),
+        'commit_latency': percentiles(commits)
+    }
+
+
+def bench_rebuild(site, es):
+    catalog = es.catalogtool
+    started = time.time()
+    catalog.manage_catalogRebuild()
+    transaction.commit()
+    flush_background(es)
+    seconds = time.time() - started
+    documents = len(catalog._catalog.uids)
+    return {
+        'documents': documents,
+        'seconds': seconds,
+        'docs_per_sec': documents / seconds
+    }
+
+
+def bench_search(es, corpus, options):
+    catalog = es.catalogtool
+    if options.fake:
+        es.connection.indices.refresh(index=es.index_name)
+    latencies = []
+    hits = 0
+    for _ in range(options.queries):
+        text = corpus.word()
+        if corpus.random.random() < 0.3:
+            text = '%s %s' % (text, corpus.word())
+        started = time.time()
+        results = catalog.searchResults(SearchableText=text)
+        hits += len(results)
+        # what a listing renders
+        for brain in results[:20]:
+            brain.getURL()
+        latencies.append(time.time() - started)
+    return {
+        'queries': options.queries,
+        'hits': hits,
+        'latency': percentiles(latencies)
+    }
+
+
+def bench_iteration(root, es):
+    catalog = es.catalogtool
+    path = '/'.join(root.getPhysicalPath())
+    started = time.time()
+    results = catalog.unrestrictedSearchResults(path=path, _es=True)
+    count = 0
+    for brain in results:
+        brain.getPath()
+        count += 1
+    seconds = time.time() - started
+
+    started = time.time()
+    results = catalog.unrestrictedSearchResults(path=path, _es=True)
+    if len(results):
+        results[len(results) - 1].getPath()
+    return {
+        'results': count,
+        'seconds': seconds,
+        'brains_per_sec': count / (seconds or 1),
+        'last_item_seconds': time.time() - started
+    }
+
+
+def compare(report, baseline, prefix=''):
+    for key, value in sorted(report.items()):
+        other = baseline.get(key)
+        if isinstance(value, dict) and isinstance(other, dict):
+            compare(value, other, prefix + key + '.')
+        elif isinstance(value, (int, float)) and \
+                isinstance(other, (int, float)) and other:
+            print '%-40s %12.4f %12.4f %+7.1f%%' % (
+                prefix + key, other, value, (value - other) * 100.0 / other)
+
+
+def main(app, argv):
+    options = parse_args(argv)
+    app = spoofRequest(app)
+    site = app[options.site]
+    setSite(site)
+
+    server = None
+    settings = getUtility(IRegistry).forInterface(IElasticSettings)
+    original = (settings.hosts, settings.enabled)
+    if options.fake:
+        server = FakeElasticServer(latency=options.latency).start()
+        settings.hosts = [unicode(server.url)]
+    settings.enabled = True
+    es = ElasticSearchCatalog(api.portal.get_tool('portal_catalog'))
+    if server is not None or not es.catalog_converted:
+        es.convertToElastic()
+    transaction.commit()
+
+    corpus = Corpus(options.seed, options.depth)
+    root, indexing = bench_indexing(app, site, es, corpus, options)
+    report = {
+        'options': vars(options),
+        'indexing': indexing,
+        'rebuild': bench_rebuild(site, es),
+        'search': bench_search(es, corpus, options),
+        'iteration': bench_iteration(root, es),
+        # kilobytes on linux
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+    site.manage_delObjects([root.getId()])
+    transaction.commit()
+    if server is not None:
+        settings.hosts, settings.enabled = original
+        transaction.commit()
+        server.stop()
+
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as fi:
+            fi.write(data)
+    else:
+        print data
+    if options.compare:
+        with open(options.compare) as fi:
+            compare(report, json.load(fi))
+
+
+main(app, sys.argv[1:])  # noqa